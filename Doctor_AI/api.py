@@ -0,0 +1,254 @@
+# JSON/HTTP API for the consultation engine
+#
+# For backend services that run consultations in bulk: requests go straight
+# to engine.py, without Gradio's queue, its event protocol or a file served
+# per answer. server.py mounts the routes under /v1 next to the UI, or run
+# the API on its own (no UI at all) with `python api.py`.
+#
+#   POST /v1/consultations         multipart audio + image -> JSON answer
+#                                  (add ?voice=false to skip the doctor's voice)
+#   POST /v1/consultations/audio   multipart audio + image -> the doctor's
+#                                  voice streamed as audio/mpeg, sentence by
+#                                  sentence, the transcript in X-Transcript
+#
+# e.g. curl -F audio=@patient.wav -F image=@rash.jpg localhost:7860/v1/consultations
+#
+# Multipart bodies are parsed as they stream in and spooled to disk, an
+# upload is never held in memory as a whole. An image over
+# IMAGE_MAX_UPLOAD_BYTES is answered with 413 before the audio is even
+# copied (server.py already refused bodies over MAX_REQUEST_BYTES by their
+# Content-Length). Consultations beyond
+# API_MAX_CONCURRENCY, while the upstream queues are longer than
+# SCHEDULER_MAX_WAIT or while the LLM circuit is open, are turned away with
+# 503 and Retry-After right away.
+
+import os
+import base64
+import shutil
+import asyncio
+import tempfile
+import urllib.parse
+
+import metrics
+import scheduler
+from startup import lazy_import
+
+API_MAX_CONCURRENCY = int(os.getenv("API_MAX_CONCURRENCY", "64"))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# The stages whose failure fails the consultation (see engine.py)
+PIPELINE_STAGES = ("stt", "image", "llm", "tts")
+
+REJECTED = metrics.register(metrics.Counter(
+    "doctor_api_rejected_total", "API consultations turned away with 503."))
+TOO_LARGE = metrics.register(metrics.Counter(
+    "doctor_api_too_large_total", "API consultations turned away with 413, the image was over the limit."))
+
+
+def _copy_upload(source, destination, max_bytes):
+    """shutil.copyfileobj that gives up past max_bytes. Returns False when it did."""
+    copied = 0
+    for chunk in iter(lambda: source.read(UPLOAD_CHUNK_SIZE), b""):
+        copied += len(chunk)
+        if max_bytes is not None and copied > max_bytes:
+            return False
+        destination.write(chunk)
+    return True
+
+
+async def _save_upload(upload, directory, name, max_bytes=None):
+    """
+    Copy an UploadFile to directory in chunks.
+
+    Returns:
+        str: The path, or None when the upload is over max_bytes
+    """
+    extension = os.path.splitext(upload.filename or "")[1].lower()
+    path = os.path.join(directory, name + extension)
+    try:
+        # Starlette knows the size once the part is parsed, no need to copy it
+        size = getattr(upload, "size", None)
+        if max_bytes is not None and size is not None and size > max_bytes:
+            return None
+        with open(path, "wb") as destination:
+            if not await asyncio.to_thread(_copy_upload, upload.file, destination, max_bytes):
+                return None
+    finally:
+        await upload.close()
+    return path
+
+
+def _read_voice(voice):
+    """The engine hands over MP3 bytes, or a file path with IN_MEMORY_AUDIO=0."""
+    if voice is None or isinstance(voice, bytes):
+        return voice
+    with open(voice, "rb") as audio_file:
+        return audio_file.read()
+
+
+def _errors(transcript, stages):
+    errors = {
+        stage: "failed" for stage in PIPELINE_STAGES
+        if stages.get(stage, {}).get("outcome") == "error"
+    }
+    # transcribe_with_groq reports failures as text
+    if transcript.lower().startswith("error"):
+        errors["stt"] = transcript
+    return errors
+
+
+class _Slots:
+    """Admission control: a consultation either gets a slot now or a 503."""
+
+    def __init__(self, size):
+        self.free = size
+
+    def busy(self):
+        """Seconds to suggest in Retry-After, or None when the consultation may start."""
+        # There is no fallback for the LLM, don't start what can't finish
+        retry_in = scheduler.UPSTREAMS["llm"].breaker.retry_in()
+        if retry_in > 0:
+            return retry_in
+        if self.free <= 0:
+            return max(1.0, scheduler.expected_wait())
+        wait = scheduler.expected_wait()
+        if wait > scheduler.SCHEDULER_MAX_WAIT:
+            return wait
+        return None
+
+
+def create_router():
+    """
+    Build the API routes. engine (and with it Groq and the TTS engines) is
+    imported on first use of this function, not when server.py is imported.
+
+    Returns:
+        fastapi.APIRouter: Mount it with app.include_router(router, prefix="/v1")
+    """
+    fastapi = lazy_import("fastapi")
+    responses = lazy_import("fastapi.responses")
+    concurrency = lazy_import("starlette.concurrency")
+    engine = lazy_import("engine")
+    # engine imported it already
+    brain = lazy_import("brain_of_the_doctor")
+
+    router = fastapi.APIRouter()
+    slots = _Slots(API_MAX_CONCURRENCY)
+
+    def _busy_response(wait):
+        REJECTED.inc(route="consultations")
+        return responses.JSONResponse(
+            {"status": "busy", "error": "The doctor is busy, please try again shortly.",
+             "retry_after": round(wait, 1)},
+            status_code=503, headers={"Retry-After": str(int(wait + 0.999))},
+        )
+
+    def _too_large_response():
+        TOO_LARGE.inc(route="consultations")
+        return responses.JSONResponse(
+            {"status": "error",
+             "error": f"The image is over the {brain.IMAGE_MAX_UPLOAD_BYTES} byte limit."},
+            status_code=413,
+        )
+
+    @router.post("/consultations")
+    async def consultation(audio: fastapi.UploadFile, image: fastapi.UploadFile, voice: bool = True):
+        wait = slots.busy()
+        if wait is not None:
+            return _busy_response(wait)
+        slots.free -= 1
+        directory = tempfile.mkdtemp(prefix="api_")
+        try:
+            # The image first, so an oversized one is turned away before the audio is copied
+            image_path = await _save_upload(image, directory, "image", brain.IMAGE_MAX_UPLOAD_BYTES)
+            if image_path is None:
+                await audio.close()
+                return _too_large_response()
+            audio_path = await _save_upload(audio, directory, "audio")
+            with metrics.request_scope("api") as timing:
+                transcript, answer, doctor_voice, _, _ = await engine.consult_async(
+                    audio_path, image_path, speak=voice,
+                )
+                doctor_voice = await asyncio.to_thread(_read_voice, doctor_voice)
+        finally:
+            slots.free += 1
+            shutil.rmtree(directory, ignore_errors=True)
+
+        errors = _errors(transcript, timing["stages"])
+        body = {
+            "status": "error" if errors else "ok",
+            "transcript": transcript,
+            "answer": answer,
+            "audio": base64.b64encode(doctor_voice).decode("ascii") if doctor_voice else None,
+            "audio_format": "mp3" if doctor_voice else None,
+            "errors": errors,
+            "stages": timing["stages"],
+            "total_seconds": timing["total_seconds"],
+        }
+        return responses.JSONResponse(body, status_code=502 if errors else 200)
+
+    @router.post("/consultations/audio")
+    async def consultation_audio(audio: fastapi.UploadFile, image: fastapi.UploadFile):
+        wait = slots.busy()
+        if wait is not None:
+            return _busy_response(wait)
+        slots.free -= 1
+        directory = tempfile.mkdtemp(prefix="api_")
+
+        def release():
+            slots.free += 1
+            shutil.rmtree(directory, ignore_errors=True)
+
+        try:
+            image_path = await _save_upload(image, directory, "image", brain.IMAGE_MAX_UPLOAD_BYTES)
+            if image_path is None:
+                await audio.close()
+                release()
+                return _too_large_response()
+            audio_path = await _save_upload(audio, directory, "audio")
+            updates = metrics.timed_request("api_stream")(engine.stream_consultation)(audio_path, image_path)
+            # The first update carries the transcript, it becomes a header
+            transcript = (await asyncio.to_thread(next, updates))[0]
+        except BaseException:
+            release()
+            raise
+
+        if transcript.lower().startswith("error"):
+            await asyncio.to_thread(updates.close)
+            release()
+            return responses.JSONResponse(
+                {"status": "error", "transcript": transcript, "errors": {"stt": transcript}}, status_code=502,
+            )
+
+        async def body():
+            try:
+                async for update in concurrency.iterate_in_threadpool(updates):
+                    chunk = update[2]
+                    if isinstance(chunk, str):
+                        chunk = await asyncio.to_thread(_read_voice, chunk)
+                    # None while the next sentence is still being spoken
+                    if chunk:
+                        yield chunk
+            finally:
+                await asyncio.to_thread(updates.close)
+                release()
+
+        return responses.StreamingResponse(
+            body(), media_type="audio/mpeg",
+            headers={"X-Transcript": urllib.parse.quote(transcript)},
+        )
+
+    return router
+
+
+# Headless mode: the API and /metrics without the Gradio UI
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    from server import serve
+    from startup import startup_report, warm_up
+
+    print(startup_report())
+    warm_up()
+    serve(None, server_port=int(os.getenv("PORT", "7860")))
@@ -1,167 +1,162 @@
-import gradio as gr
-import os
-import time
-from dotenv import load_dotenv
-
-# Attempt to load environment variables from .env if present
-load_dotenv()
-
-# Import core functions from other modules
-from brain_of_the_doctor import encode_image, analyze_image_with_query
-from voice_of_the_patient import transcribe_with_groq
-from voice_of_the_doctor import get_doctor_voice_for_ui
-
-# --- Configuration ---
-# Create a dedicated folder for audio outputs
-OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "audio_outputs")
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-# System prompt for the doctor
-system_prompt ="""You have to act as a professional doctor, i know you are not but this is for learning purpose. 
-            What's in this image?. Do you find anything wrong with it medically? 
-            If you make a differential, suggest some remedies for them. Donot add any numbers or special characters in 
-            your response. Your response should be in one long paragraph. Also always answer as if you are answering to a real person.
-            Donot say 'In the image I see' but say 'With what I see, I think you have ....'
-            Dont respond as an AI model in markdown, your answer should mimic that of an actual doctor not an AI bot, 
-            Keep your answer concise (max 5 sentences). No preamble, start your answer right away please"""
-
-
-# --- Core Processing Logic ---
-def process_input(audio_filepath, image_filepath):
-    """
-    Process the patient's audio and image inputs and generate a doctor's response
-    """
-    # Create a timestamp for unique filenames
-    timestamp = int(time.time())
-    
-    # Ensure we have valid inputs
-    if not audio_filepath:
-        return "No audio input detected.", "Please record your question for the doctor. I need to hear your symptoms to provide an assessment.", None, None
-
-    if not image_filepath:
-        return "Audio detected, but no image uploaded.", "I need both your audio description and a medical image to provide an accurate diagnosis. Please upload an image for me to analyze.", None, None
-    
-    # Convert patient's speech to text
-    try:
-        speech_to_text_output = transcribe_with_groq(audio_filepath)
-    except Exception as e:
-        print(f"Error transcribing speech: {e}")
-        speech_to_text_output = "Error transcribing your speech. Please try again."
-    
-    # Handle the image input and generate doctor's response
-    try:
-        if image_filepath:
-            doctor_response = analyze_image_with_query(
-                query=system_prompt + speech_to_text_output,
-                encoded_image=encode_image(image_filepath),
-                model="meta-llama/llama-4-scout-17b-16e-instruct"
-            )
-        else:
-            doctor_response = "No image provided for me to analyze. Please upload an image for a proper diagnosis."
-    except Exception as e:
-        print(f"Error generating doctor response: {e}")
-        doctor_response = "I apologize, but I encountered an error while analyzing your image. Please try again."
-    
-    # Generate the doctor's voice response using our deep male voice
-    try:
-        # Create a unique filename for this response
-        audio_output_path = os.path.join(OUTPUT_DIR, f"doctor_response_{timestamp}.mp3")
-        
-        # Generate the voice
-        get_doctor_voice_for_ui(
-            text=doctor_response,
-            output_filepath=audio_output_path
-        )
-        
-        # Check if file was created successfully
-        if os.path.exists(audio_output_path):
-            return speech_to_text_output, doctor_response, audio_output_path, image_filepath
-        else:
-            print("Warning: Audio file not created")
-            return speech_to_text_output, doctor_response, None, image_filepath
-            
-    except Exception as e:
-        print(f"Error generating voice: {e}")
-        return speech_to_text_output, doctor_response, None, image_filepath
-
-# Create the Gradio interface
-def create_gradio_interface():
-    """Creates and returns the Gradio interface for MedMind AI"""
-    
-    # CSS for styling
-    css = """
-    body { font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; background-color: #f0f2f5; }
-    .main-container { display: flex; flex-direction: row; gap: 2rem; padding: 1rem; }
-    .panel { border-radius: 12px; box-shadow: 0 4px 12px rgba(0,0,0,0.08); padding: 1.5rem; background-color: white; flex: 1; }
-    .panel-header { font-size: 1.5rem; font-weight: 600; color: #1a73e8; margin-bottom: 0.5rem; display: flex; align-items: center; gap: 0.5rem; }
-    .panel-subheader { font-size: 0.9rem; color: #5f6368; margin-bottom: 1.5rem; }
-    .input-group { margin-bottom: 1.5rem; }
-    .label { font-weight: 500; margin-bottom: 0.5rem; }
-    #audio_input, .image-uploader { border: 2px dashed #d0d0d0; border-radius: 8px; }
-    .submit-button { background-color: #1a73e8 !important; color: white !important; font-weight: 600 !important; border-radius: 8px !important; padding: 0.75rem 1.5rem !important; }
-    """
-    
-    with gr.Blocks(css=css) as iface:
-        gr.Markdown("# MedMind AI: Virtual Doctor with Eyes and Ears")
-        
-        with gr.Row(elem_classes="main-container"):
-            # Left Panel for Patient Inputs
-            with gr.Column(elem_classes="panel"):
-                gr.HTML("""<div class="panel-header">🧑‍⚕️ Patient Input</div>
-                           <p class="panel-subheader">Record your symptoms and upload a medical image.</p>""")
-                
-                with gr.Column(elem_classes="input-group"):
-                    gr.Markdown("**1. Record your symptoms**", elem_classes="label")
-                    audio_input = gr.Audio(
-                        sources=["microphone", "upload"],
-                        type="filepath",
-                        label="Record or upload your symptoms",
-                        elem_id="audio_input"
-                    )
-                
-                with gr.Column(elem_classes="input-group"):
-                    gr.Markdown("**2. Upload a clear medical image**", elem_classes="label")
-                    image_input = gr.Image(
-                        type="filepath",
-                        label="Upload image for diagnosis",
-                        elem_classes="image-uploader"
-                    )
-                
-                submit_btn = gr.Button("Get Doctor's Diagnosis", elem_classes="submit-button")
-            
-            # Right Panel for Doctor's Consultation
-            with gr.Column(elem_classes="panel"):
-                gr.HTML("""<div class="panel-header">👨‍⚕️ Doctor's Consultation</div>
-                           <p class="panel-subheader">Review the analysis and listen to the audio consultation.</p>""")
-                
-                with gr.Column():
-                    gr.Markdown("**Analyzed Image**")
-                    analyzed_image = gr.Image(label="")
-                    
-                    gr.Markdown("**Your Symptoms (Transcribed)**")
-                    speech_output = gr.Textbox(label="", lines=3)
-                    
-                    gr.Markdown("**Doctor's Analysis**")
-                    doctor_response = gr.Textbox(label="", lines=5)
-                    
-                    gr.Markdown("**Audio Consultation**")
-                    voice_output = gr.Audio(label="", autoplay=True)
-        
-        # Event handlers
-        submit_btn.click(
-            fn=process_input,
-            inputs=[audio_input, image_input],
-            outputs=[speech_output, doctor_response, voice_output, analyzed_image]
-        )
-        
-    return iface
-
-# Create and launch the interface
-demo = create_gradio_interface()
-
-# Launch with share enabled for Hugging Face Spaces
-if __name__ == "__main__":
-    demo.launch(share=True, server_name="0.0.0.0")
-else:
-    # This is the part used by Hugging Face Spaces
-    app = demo
+import os
+from dotenv import load_dotenv
+
+# Gradio, Groq and the TTS engines are imported on first use to keep cold start short
+from startup import lazy_import, timed, startup_report, warm_up
+
+# Attempt to load environment variables from .env if present
+load_dotenv()
+
+# The pipeline itself lives in engine.py, shared with the JSON API (api.py).
+# process_input and system_prompt stay importable from app.
+with timed("import doctor modules"):
+    from engine import (process_input, process_input_async, process_input_streaming,
+                        system_prompt, OUTPUT_STORE, LIVE_TRANSCRIPTION)
+    import live_transcription
+    from server import SERVE_METRICS, MAX_REQUEST_BYTES, serve
+
+# --- Configuration ---
+# Stream the doctor's answer and voice sentence by sentence (set STREAMING_MODE=0 to disable)
+STREAMING_MODE = os.getenv("STREAMING_MODE", "1") == "1"
+
+# How many consultations may run at the same time (async handlers share one event loop)
+CONCURRENCY_LIMIT = int(os.getenv("CONCURRENCY_LIMIT", "64"))
+# Consultations Gradio keeps waiting before it turns new ones away.
+# Calls to Groq and Edge-TTS are limited per upstream in scheduler.py.
+QUEUE_MAX_SIZE = int(os.getenv("QUEUE_MAX_SIZE", "256"))
+
+
+# Create the Gradio interface
+def create_gradio_interface():
+    """Creates and returns the Gradio interface for MedMind AI"""
+    gr = lazy_import("gradio")
+    
+    # CSS for styling
+    css = """
+    body { font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; background-color: #f0f2f5; }
+    .main-container { display: flex; flex-direction: row; gap: 2rem; padding: 1rem; }
+    .panel { border-radius: 12px; box-shadow: 0 4px 12px rgba(0,0,0,0.08); padding: 1.5rem; background-color: white; flex: 1; }
+    .panel-header { font-size: 1.5rem; font-weight: 600; color: #1a73e8; margin-bottom: 0.5rem; display: flex; align-items: center; gap: 0.5rem; }
+    .panel-subheader { font-size: 0.9rem; color: #5f6368; margin-bottom: 1.5rem; }
+    .input-group { margin-bottom: 1.5rem; }
+    .label { font-weight: 500; margin-bottom: 0.5rem; }
+    #audio_input, .image-uploader { border: 2px dashed #d0d0d0; border-radius: 8px; }
+    .submit-button { background-color: #1a73e8 !important; color: white !important; font-weight: 600 !important; border-radius: 8px !important; padding: 0.75rem 1.5rem !important; }
+    """
+    
+    with gr.Blocks(css=css) as iface:
+        gr.Markdown("# MedMind AI: Virtual Doctor with Eyes and Ears")
+        
+        with gr.Row(elem_classes="main-container"):
+            # Left Panel for Patient Inputs
+            with gr.Column(elem_classes="panel"):
+                gr.HTML("""<div class="panel-header">🧑‍⚕️ Patient Input</div>
+                           <p class="panel-subheader">Record your symptoms and upload a medical image.</p>""")
+                
+                with gr.Column(elem_classes="input-group"):
+                    gr.Markdown("**1. Record your symptoms**", elem_classes="label")
+                    if LIVE_TRANSCRIPTION:
+                        # Chunks reach the server while the patient is still speaking
+                        audio_input = gr.Audio(
+                            sources=["microphone"],
+                            type="numpy",
+                            streaming=True,
+                            label="Record your symptoms",
+                            elem_id="audio_input"
+                        )
+                    else:
+                        audio_input = gr.Audio(
+                            sources=["microphone", "upload"],
+                            type="filepath",
+                            label="Record or upload your symptoms",
+                            elem_id="audio_input"
+                        )
+                    # The session's LiveTranscriber (live_transcription.py)
+                    live_state = gr.State(None)
+                
+                with gr.Column(elem_classes="input-group"):
+                    gr.Markdown("**2. Upload a clear medical image**", elem_classes="label")
+                    image_input = gr.Image(
+                        type="filepath",
+                        label="Upload image for diagnosis",
+                        elem_classes="image-uploader"
+                    )
+                    # Follow-up questions about the same image continue this conversation (consultation.py)
+                    consultation_state = gr.State(None)
+                
+                submit_btn = gr.Button("Get Doctor's Diagnosis", elem_classes="submit-button")
+            
+            # Right Panel for Doctor's Consultation
+            with gr.Column(elem_classes="panel"):
+                gr.HTML("""<div class="panel-header">👨‍⚕️ Doctor's Consultation</div>
+                           <p class="panel-subheader">Review the analysis and listen to the audio consultation.</p>""")
+                
+                with gr.Column():
+                    gr.Markdown("**Analyzed Image**")
+                    analyzed_image = gr.Image(label="")
+                    
+                    gr.Markdown("**Your Symptoms (Transcribed)**")
+                    speech_output = gr.Textbox(label="", lines=3)
+                    
+                    gr.Markdown("**Doctor's Analysis**")
+                    doctor_response = gr.Textbox(label="", lines=5)
+                    
+                    gr.Markdown("**Audio Consultation**")
+                    voice_output = gr.Audio(label="", autoplay=True, streaming=STREAMING_MODE)
+        
+        # Event handlers
+        if LIVE_TRANSCRIPTION:
+            # A new recording starts a new transcript. Every session streams its own
+            # microphone, so these don't share Gradio's default single worker.
+            audio_input.start_recording(fn=live_transcription.reset, inputs=live_state, outputs=live_state,
+                                        concurrency_limit=CONCURRENCY_LIMIT)
+            audio_input.clear(fn=live_transcription.reset, inputs=live_state, outputs=live_state,
+                              concurrency_limit=CONCURRENCY_LIMIT)
+            audio_input.stream(
+                fn=live_transcription.stream_chunk,
+                inputs=[audio_input, live_state],
+                outputs=live_state,
+                show_progress="hidden",
+                concurrency_limit=CONCURRENCY_LIMIT,
+            )
+
+        submit_btn.click(
+            fn=process_input_streaming if STREAMING_MODE else process_input_async,
+            inputs=[audio_input, image_input, live_state, consultation_state],
+            outputs=[speech_output, doctor_response, voice_output, analyzed_image, consultation_state],
+            concurrency_limit=CONCURRENCY_LIMIT,
+        )
+        
+    iface.queue(max_size=QUEUE_MAX_SIZE)
+    return iface
+
+# The interface is built on first access instead of at import time
+_demo = None
+
+def get_demo():
+    """Returns the Gradio interface, building it on first use."""
+    global _demo
+    if _demo is None:
+        with timed("build Gradio interface"):
+            _demo = create_gradio_interface()
+    return _demo
+
+def __getattr__(name):
+    # This is the part used by Hugging Face Spaces, which looks up `demo` / `app`
+    if name in ("demo", "app"):
+        return get_demo()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Launch with share enabled for Hugging Face Spaces
+if __name__ == "__main__":
+    demo = get_demo()
+    print(startup_report())
+    # Import the TTS engines and open the Groq pool while the server starts
+    warm_up()
+    # The output store may live outside the working directory (tmpfs backend)
+    if SERVE_METRICS:
+        # Gradio mounted next to /metrics (SERVE_METRICS=0 for a share link instead)
+        serve(demo, server_name="0.0.0.0", server_port=int(os.getenv("PORT", "7860")), allowed_paths=[OUTPUT_STORE.root])
+    else:
+        demo.launch(share=True, server_name="0.0.0.0", allowed_paths=[OUTPUT_STORE.root],
+                    max_file_size=MAX_REQUEST_BYTES)
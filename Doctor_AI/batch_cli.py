@@ -0,0 +1,271 @@
+"""
+Batch mode for MedMind AI
+=========================
+Runs many consultations through the STT -> LLM -> TTS pipeline without the UI,
+for offline evaluation runs and backfills.
+
+Input is either a directory or a manifest:
+- directory: every audio file is paired with the image that has the same name
+  (case_001.wav + case_001.jpg), or a folder holding exactly one audio file
+  and one image is one consultation
+- manifest: a .jsonl file with {"id", "audio", "image"} per line, or a .csv
+  file with id,audio,image columns (paths relative to the manifest)
+
+Every finished consultation is appended to the output JSONL with its per-stage
+timings and where the answer came from. The LLM response cache and the
+near-duplicate image index are off unless --caches is given, so every case
+gets its own answer. Running the same command again skips the ids already completed, so
+an interrupted run simply resumes.
+
+Usage:
+    python batch_cli.py cases/ --output results.jsonl --workers 8
+    python batch_cli.py manifest.csv --output results.jsonl --no-tts
+    python batch_cli.py cases/ --caches   # reuse answers of identical or similar cases
+"""
+
+import os
+import csv
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import metrics
+import scheduler
+from brain_of_the_doctor import prepare_image, diagnose_with_source
+from voice_of_the_patient import transcribe_with_groq
+from voice_of_the_doctor import get_doctor_voice_for_ui
+from pipeline import run_stages, run_stage
+
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".m4a", ".flac", ".ogg", ".opus", ".webm")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+DEFAULT_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"
+
+
+# --- Finding the consultations ---
+def find_cases(root):
+    """
+    Pair audio files and images found under a directory.
+
+    Returns:
+        list: (case id, audio path, image path) tuples sorted by id
+    """
+    cases = {}
+    for folder, _, files in os.walk(root):
+        audio = {os.path.splitext(f)[0]: f for f in files if f.lower().endswith(AUDIO_EXTENSIONS)}
+        images = {os.path.splitext(f)[0]: f for f in files if f.lower().endswith(IMAGE_EXTENSIONS)}
+        relative = os.path.relpath(folder, root)
+
+        paired = set(audio) & set(images)
+        for stem in paired:
+            case_id = stem if relative == "." else os.path.join(relative, stem)
+            cases[case_id] = (os.path.join(folder, audio[stem]), os.path.join(folder, images[stem]))
+
+        # A folder with one recording and one image, named differently
+        if not paired and len(audio) == 1 and len(images) == 1 and relative != ".":
+            cases[relative] = (os.path.join(folder, *audio.values()), os.path.join(folder, *images.values()))
+
+    return [(case_id, *cases[case_id]) for case_id in sorted(cases)]
+
+
+def read_manifest(path):
+    """
+    Read a .jsonl or .csv manifest of consultations.
+
+    Returns:
+        list: (case id, audio path, image path) tuples in manifest order
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, "r", encoding="utf-8", newline="") as manifest:
+        if path.lower().endswith(".csv"):
+            rows = list(csv.DictReader(manifest))
+        else:
+            rows = [json.loads(line) for line in manifest if line.strip()]
+
+    cases = []
+    for row in rows:
+        audio = os.path.join(base, row["audio"])
+        image = os.path.join(base, row["image"])
+        cases.append((row.get("id") or row["audio"], audio, image))
+    return cases
+
+
+def completed_ids(output_path):
+    """Ids that already have a successful result in the output file."""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "r", encoding="utf-8") as results:
+        for line in results:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by an interruption, that case is run again
+                continue
+            if record.get("status") == "ok":
+                done.add(record["id"])
+    return done
+
+
+def _ends_mid_line(path):
+    if not os.path.getsize(path):
+        return False
+    with open(path, "rb") as results:
+        results.seek(-1, os.SEEK_END)
+        return results.read(1) != b"\n"
+
+
+# --- Running one consultation ---
+def run_case(case_id, audio_path, image_path, system_prompt, model, audio_dir=None, caches=False):
+    """
+    Run one consultation through the pipeline.
+
+    Args:
+        caches (bool): Allow answers from the response cache and near-duplicate images
+
+    Returns:
+        dict: The result record written to the output JSONL
+    """
+    record = {"id": case_id, "audio": audio_path, "image": image_path}
+    errors = {}
+
+    # Fair queuing per consultation in the upstream scheduler
+    with metrics.request_scope("batch") as timing, scheduler.session(case_id):
+        prepared = run_stages({
+            "stt": (transcribe_with_groq, audio_path),
+            "image": (prepare_image, image_path),
+        })
+        transcript = prepared["stt"].value if prepared["stt"].ok else None
+        if transcript is None or transcript.startswith("ERROR"):
+            errors["stt"] = transcript or str(prepared["stt"].error)
+        if not prepared["image"].ok:
+            errors["image"] = str(prepared["image"].error)
+
+        answer = answer_source = None
+        if not errors:
+            analysis = run_stage("llm", diagnose_with_source, system_prompt, transcript,
+                                 prepared["image"].value, model, caches)
+            if analysis.ok:
+                answer, answer_source = analysis.value
+            else:
+                errors["llm"] = str(analysis.error)
+
+        audio_output = None
+        if answer and audio_dir:
+            audio_output = os.path.join(audio_dir, case_id.replace(os.sep, "__") + ".mp3")
+            voice = run_stage("tts", get_doctor_voice_for_ui, answer, audio_output)
+            if not voice.ok or not voice.value:
+                errors["tts"] = str(voice.error or "no audio generated")
+                audio_output = None
+
+    record.update({
+        "transcript": transcript,
+        "answer": answer,
+        "answer_source": answer_source,
+        "audio_output": audio_output,
+        "status": "error" if errors else "ok",
+        "errors": errors,
+        "stages": timing["stages"],
+        "bytes": timing["bytes"],
+        "total_seconds": timing["total_seconds"],
+    })
+    return record
+
+
+def run_batch(cases, output_path, workers=4, system_prompt=None, model=DEFAULT_MODEL, audio_dir=None,
+              caches=False):
+    """
+    Run every case not yet completed in output_path and append the results.
+
+    Returns:
+        dict: Counts of ok, failed and skipped cases
+    """
+    if system_prompt is None:
+        from engine import system_prompt
+    done = completed_ids(output_path)
+    pending = [case for case in cases if case[0] not in done]
+    summary = {"ok": 0, "failed": 0, "skipped": len(cases) - len(pending)}
+    if summary["skipped"]:
+        print(f"Skipping {summary['skipped']} consultations already in {output_path}")
+    if audio_dir:
+        os.makedirs(audio_dir, exist_ok=True)
+
+    write_lock = threading.Lock()
+    start = time.perf_counter()
+    with open(output_path, "a", encoding="utf-8") as results:
+        if _ends_mid_line(output_path):
+            # A run killed mid-write left a partial line, start on a fresh one
+            results.write("\n")
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch")
+        futures = {
+            pool.submit(run_case, case_id, audio, image, system_prompt, model, audio_dir, caches): case_id
+            for case_id, audio, image in pending
+        }
+        try:
+            for finished, future in enumerate(as_completed(futures), 1):
+                case_id = futures[future]
+                try:
+                    record = future.result()
+                except Exception as e:
+                    record = {"id": case_id, "status": "error", "errors": {"batch": str(e)}}
+                with write_lock:
+                    results.write(json.dumps(record) + "\n")
+                    # Flushed per line so an interrupted run loses nothing it finished
+                    results.flush()
+                summary["ok" if record["status"] == "ok" else "failed"] += 1
+                print(f"[{finished}/{len(pending)}] {case_id}: {record['status']} "
+                      f"({record.get('total_seconds', 0):.2f}s)")
+        except KeyboardInterrupt:
+            print("\nInterrupted, run the same command again to resume.")
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        pool.shutdown()
+
+    summary["seconds"] = round(time.perf_counter() - start, 2)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run MedMind AI consultations in batch")
+    parser.add_argument("input", help="Directory of consultations, or a .jsonl/.csv manifest")
+    parser.add_argument("--output", default="results.jsonl", help="JSONL file the results are appended to")
+    parser.add_argument("--workers", type=int, default=4, help="Consultations processed at the same time")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="Multimodal model for the analysis")
+    parser.add_argument("--audio-dir", help="Where to write the doctor's voice (default: <output>_audio)")
+    parser.add_argument("--no-tts", action="store_true", help="Skip generating the doctor's voice")
+    parser.add_argument("--prompt-file", help="Use this system prompt instead of the app's")
+    parser.add_argument("--caches", action="store_true",
+                        help="Reuse answers of identical or similar consultations (LLM response cache)")
+    args = parser.parse_args(argv)
+
+    if os.path.isdir(args.input):
+        cases = find_cases(args.input)
+    else:
+        cases = read_manifest(args.input)
+    if not cases:
+        print(f"No consultations found in {args.input}")
+        return 1
+
+    audio_dir = None
+    if not args.no_tts:
+        audio_dir = args.audio_dir or os.path.splitext(args.output)[0] + "_audio"
+
+    system_prompt = None
+    if args.prompt_file:
+        with open(args.prompt_file, "r", encoding="utf-8") as prompt:
+            system_prompt = prompt.read()
+
+    print(f"Found {len(cases)} consultations, running with {args.workers} workers")
+    try:
+        summary = run_batch(cases, args.output, args.workers, system_prompt, args.model, audio_dir, args.caches)
+    except KeyboardInterrupt:
+        return 130
+    print(f"\nDone in {summary['seconds']}s: {summary['ok']} ok, {summary['failed']} failed, "
+          f"{summary['skipped']} skipped. Results in {args.output}")
+    return 0 if summary["failed"] == 0 else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
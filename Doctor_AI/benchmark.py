@@ -0,0 +1,348 @@
+"""
+Offline end-to-end benchmark for the consultation pipeline
+=========================================================
+Runs process_input against local stand-ins, so every performance change can
+be measured on a machine with no network access:
+
+- a fake Groq HTTP server (transcriptions and chat completions, streaming
+  included) with configurable latency and jitter
+- a fake Edge-TTS engine that sleeps and writes a small MP3-sized payload
+
+N simulated patients are driven with the bundled acne.jpeg and
+patient_voice_test_for_patient.wav at a given concurrency, and the run
+reports throughput, latency percentiles and peak memory.
+
+Usage:
+    python benchmark.py --patients 50 --concurrency 10 --handler async
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import threading
+import tracemalloc
+import types
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_AUDIO = os.path.join(SCRIPT_DIR, "patient_voice_test_for_patient.wav")
+SAMPLE_IMAGE = os.path.join(SCRIPT_DIR, "acne.jpeg")
+
+FAKE_TRANSCRIPT = "I have had these red bumps on my face for about two weeks and they itch at night."
+FAKE_ANSWER = (
+    "With what I see, I think you have a mild case of acne with some inflammation around the cheeks. "
+    "Wash your face twice a day with a gentle cleanser and avoid picking at the spots. "
+    "A cream with benzoyl peroxide can help calm the redness. "
+    "If it does not improve in a few weeks, please see a dermatologist in person."
+)
+
+
+class Latency:
+    """Base delay plus uniform jitter, in seconds."""
+
+    def __init__(self, base, jitter):
+        self.base = base
+        self.jitter = jitter
+
+    def sleep(self):
+        time.sleep(max(0.0, self.base + random.uniform(-self.jitter, self.jitter)))
+
+    async def sleep_async(self):
+        await asyncio.sleep(max(0.0, self.base + random.uniform(-self.jitter, self.jitter)))
+
+
+# --- Fake Groq API ---
+class FakeGroqServer:
+    """A local HTTP server that answers like the Groq transcription and chat APIs."""
+
+    def __init__(self, stt_latency, llm_latency, token_delay=0.005, port=0):
+        self.stt_latency = stt_latency
+        self.llm_latency = llm_latency
+        self.token_delay = token_delay
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, payload):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.endswith("/models"):
+                    self._send_json({"object": "list", "data": []})
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", "0"))
+                raw = self.rfile.read(length)
+                server.requests += 1
+                if self.path.endswith("/audio/transcriptions"):
+                    server.stt_latency.sleep()
+                    self._send_json({"text": FAKE_TRANSCRIPT})
+                elif self.path.endswith("/chat/completions"):
+                    request = json.loads(raw or b"{}")
+                    server.llm_latency.sleep()
+                    if request.get("stream"):
+                        self._stream_completion(request.get("model", "fake"))
+                    else:
+                        self._send_json(_completion(request.get("model", "fake")))
+                else:
+                    self.send_error(404)
+
+            def _stream_completion(self, model):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                for word in FAKE_ANSWER.split(" "):
+                    chunk = _completion_chunk(model, word + " ")
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                    time.sleep(server.token_delay)
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.close_connection = True
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.httpd.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-groq", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _completion(model):
+    return {
+        "id": "chatcmpl-benchmark",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": FAKE_ANSWER},
+            "finish_reason": "stop",
+            "logprobs": None,
+        }],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+    }
+
+
+def _completion_chunk(model, text):
+    return {
+        "id": "chatcmpl-benchmark",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None, "logprobs": None}],
+    }
+
+
+# --- Fake TTS engine ---
+def install_fake_tts(latency, audio_bytes=24 * 1024):
+    """
+    Register a stand-in for the edge_tts module. voice_of_the_doctor imports
+    edge_tts lazily, so it picks this one up.
+    """
+    payload = b"\xff\xfb" + b"\x00" * (audio_bytes - 2)
+
+    class Communicate:
+        def __init__(self, text, voice, **kwargs):
+            self.text = text
+
+        async def stream(self):
+            await latency.sleep_async()
+            yield {"type": "audio", "data": payload}
+
+        async def save(self, output_filepath):
+            await latency.sleep_async()
+            with open(output_filepath, "wb") as audio_file:
+                audio_file.write(payload)
+
+    module = types.ModuleType("edge_tts")
+    module.Communicate = Communicate
+    sys.modules["edge_tts"] = module
+    return module
+
+
+# --- Load generation ---
+def percentile(values, pct):
+    """Nearest-rank percentile."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def _run_sync(handler, patients, concurrency):
+    def one(_):
+        start = time.perf_counter()
+        result = handler(SAMPLE_AUDIO, SAMPLE_IMAGE)
+        return time.perf_counter() - start, result[2] is not None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(one, range(patients)))
+
+
+def _run_streaming(handler, patients, concurrency):
+    def one(_):
+        start = time.perf_counter()
+        first_audio = None
+        got_audio = False
+        for update in handler(SAMPLE_AUDIO, SAMPLE_IMAGE):
+            if isinstance(update[2], (str, bytes)):
+                got_audio = True
+                if first_audio is None:
+                    first_audio = time.perf_counter() - start
+        return time.perf_counter() - start, got_audio, first_audio
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(one, range(patients)))
+
+
+def _run_async(handler, patients, concurrency):
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                start = time.perf_counter()
+                result = await handler(SAMPLE_AUDIO, SAMPLE_IMAGE)
+                return time.perf_counter() - start, result[2] is not None
+
+        return await asyncio.gather(*(one() for _ in range(patients)))
+
+    return asyncio.run(main())
+
+
+def run_benchmark(patients=20, concurrency=5, handler="sync", stt_latency=0.3, llm_latency=0.8,
+                  tts_latency=0.4, jitter=0.1, token_delay=0.005, caches=False):
+    """
+    Start the fake services, run the simulated patients and return a report.
+
+    Returns:
+        dict: Throughput, latency percentiles, errors and peak memory
+    """
+    server = FakeGroqServer(Latency(stt_latency, jitter), Latency(llm_latency, jitter), token_delay).start()
+
+    # Everything below must be configured before the app modules are imported
+    os.environ["GROQ_API_KEY"] = "benchmark"
+    os.environ["GROQ_BASE_URL"] = server.base_url
+    os.environ.setdefault("OUTPUT_BACKEND", "tmpfs")
+    os.environ.setdefault("DOCTOR_WARMUP", "0")
+    # Only the fake services: the sample clip is short enough for the local
+    # Whisper model, and a slow fake Edge TTS would start a real gTTS hedge
+    os.environ.setdefault("STT_BACKEND", "groq")
+    os.environ.setdefault("TTS_ENGINES", "edge")
+    if not caches:
+        for flag in ("TTS_CACHE", "RESPONSE_CACHE", "NEAR_DUPLICATE_CACHE", "TRANSCRIPT_CACHE"):
+            os.environ[flag] = "0"
+    install_fake_tts(Latency(tts_latency, jitter))
+
+    sys.path.insert(0, SCRIPT_DIR)
+    import engine
+
+    runners = {
+        "sync": (_run_sync, engine.process_input),
+        "async": (_run_async, engine.process_input_async),
+        # The engine's generator, without the Gradio wrapper
+        "streaming": (_run_streaming, engine.stream_consultation),
+    }
+    runner, fn = runners[handler]
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        outcomes = runner(fn, patients, concurrency)
+    finally:
+        elapsed = time.perf_counter() - start
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        server.stop()
+
+    latencies = [outcome[0] for outcome in outcomes]
+    report = {
+        "handler": handler,
+        "patients": patients,
+        "concurrency": concurrency,
+        "wall_seconds": round(elapsed, 3),
+        "throughput_per_second": round(patients / elapsed, 3) if elapsed else 0.0,
+        "latency_seconds": {
+            "p50": round(percentile(latencies, 50), 4),
+            "p95": round(percentile(latencies, 95), 4),
+            "p99": round(percentile(latencies, 99), 4),
+            "max": round(max(latencies), 4) if latencies else 0.0,
+        },
+        "responses_without_audio": sum(1 for outcome in outcomes if not outcome[1]),
+        "peak_traced_memory_mb": round(peak_traced / (1024 * 1024), 2),
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2),
+        "upstream_requests": server.requests,
+    }
+    if handler == "streaming":
+        first_audio = [outcome[2] for outcome in outcomes if outcome[2] is not None]
+        report["time_to_first_audio_seconds"] = {
+            "p50": round(percentile(first_audio, 50), 4),
+            "p95": round(percentile(first_audio, 95), 4),
+        }
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the MedMind AI pipeline")
+    parser.add_argument("--patients", type=int, default=20, help="Number of simulated consultations")
+    parser.add_argument("--concurrency", type=int, default=5, help="Consultations in flight at once")
+    parser.add_argument("--handler", choices=["sync", "async", "streaming"], default="sync")
+    parser.add_argument("--stt-latency", type=float, default=0.3, help="Fake Whisper latency in seconds")
+    parser.add_argument("--llm-latency", type=float, default=0.8, help="Fake LLM latency in seconds")
+    parser.add_argument("--tts-latency", type=float, default=0.4, help="Fake TTS latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Uniform jitter added to every latency")
+    parser.add_argument("--token-delay", type=float, default=0.005, help="Delay between streamed tokens")
+    parser.add_argument("--caches", action="store_true", help="Keep the TTS/LLM/STT caches enabled")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(
+        patients=args.patients, concurrency=args.concurrency, handler=args.handler,
+        stt_latency=args.stt_latency, llm_latency=args.llm_latency, tts_latency=args.tts_latency,
+        jitter=args.jitter, token_delay=args.token_delay, caches=args.caches,
+    )
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print("\n=== MedMind AI benchmark ===")
+    print(f"Handler:      {report['handler']} ({report['patients']} patients, concurrency {report['concurrency']})")
+    print(f"Throughput:   {report['throughput_per_second']} consultations/s in {report['wall_seconds']}s")
+    latency = report["latency_seconds"]
+    print(f"Latency:      p50 {latency['p50']}s  p95 {latency['p95']}s  p99 {latency['p99']}s  max {latency['max']}s")
+    if "time_to_first_audio_seconds" in report:
+        first_audio = report["time_to_first_audio_seconds"]
+        print(f"First audio:  p50 {first_audio['p50']}s  p95 {first_audio['p95']}s")
+    print(f"Peak memory:  {report['peak_traced_memory_mb']} MB traced, {report['peak_rss_mb']} MB RSS")
+    print(f"No audio:     {report['responses_without_audio']} responses")
+
+
+if __name__ == "__main__":
+    main()
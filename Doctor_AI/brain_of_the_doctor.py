@@ -1,75 +1,450 @@
-# step1: Setup GROQ API Key
-import os
-from dotenv import load_dotenv
-
-# Load environment variables from .env file
-# Try different methods to get the API key
-load_dotenv()
-GROQ_API_KEY = os.environ.get("GROQ_API_KEY") or os.environ.get("HF_GROQ_API_KEY")
-
-# If key is still not found and we're in development, try a fallback
-if not GROQ_API_KEY and os.path.exists(".env.local"):
-    with open(".env.local", "r") as f:
-        for line in f:
-            if line.startswith("GROQ_API_KEY="):
-                GROQ_API_KEY = line.split("=", 1)[1].strip().strip('"\'')
-                break
-
-
-# step2: Convert image to required format
-
-import base64
-
-# image_path="acne.jpeg"
-
-
-def encode_image(image_path):
-    image_file=open(image_path,"rb")
-    return base64.b64encode(image_file.read()).decode('utf-8')
-
-# step3: Setup Multimodal LLM
-from groq import Groq
-import httpx
-
-query="Is there is something wrong with my face?"
-model="meta-llama/llama-4-scout-17b-16e-instruct"
-
-# Explicitly create the httpx client to avoid proxy-related errors in Docker
-# This gives us more control over the network configuration.
-transport = httpx.HTTPTransport(retries=2)
-http_client = httpx.Client(transport=transport, trust_env=False)
-
-client = Groq(
-    api_key=GROQ_API_KEY,
-    http_client=http_client,
-)
-
-def analyze_image_with_query(query, encoded_image, model="meta-llama/llama-4-scout-17b-16e-instruct"):
-    message=[
-        {
-            "role":"user",
-            "content":[
-                {
-                    "type":"text",
-                    "text": query
-                },
-                {
-                    "type":"image_url",
-                    "image_url":{
-                        "url":f"data:image/jpeg;base64,{encoded_image}",
-
-                    },
-                },
-            ],
-        }
-    ]
-
-    chat_completion=client.chat.completions.create(
-        messages=message,
-        model=model,
-    )
-
-
-
-
-    return chat_completion.choices[0].message.content
+# step1: Setup GROQ API Key
+# The key and the clients live in groq_client, shared with voice_of_the_patient
+from groq_client import GROQ_API_KEY, get_client, get_async_client
+from startup import lazy_import
+
+
+# step2: Convert image to required format
+
+import io
+import os
+import time
+import base64
+import hashlib
+import logging
+import mimetypes
+
+import metrics
+import scheduler
+from image_similarity import dhash, NearDuplicateIndex
+
+logger = logging.getLogger(__name__)
+
+# image_path="acne.jpeg"
+
+# Preprocessing settings: longest side in pixels, output format and quality
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1024"))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()  # JPEG or WEBP
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+
+# Hard limits on the uploaded file (checked before it is read), its decoded
+# size in pixels (after JPEG draft scaling, checked before it is decoded) and,
+# when the image has to be sent as uploaded (no Pillow, or it can't be
+# decoded), the inline payload
+IMAGE_MAX_UPLOAD_BYTES = int(os.getenv("IMAGE_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(16 * 1000 * 1000)))
+# Groq takes base64 images of up to 4 MB in a request
+IMAGE_MAX_INLINE_BYTES = int(os.getenv("IMAGE_MAX_INLINE_BYTES", str(3 * 1024 * 1024)))
+
+# Read and base64 encoded in chunks of this size (a multiple of 3, so every
+# chunk encodes without padding)
+ENCODE_CHUNK_SIZE = 3 * 256 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _pillow():
+    """Import Pillow on first use, returns (Image, ImageOps) or None if it is missing."""
+    try:
+        return lazy_import("PIL.Image"), lazy_import("PIL.ImageOps")
+    except ImportError:
+        return None
+
+
+class ImageTooLargeError(ValueError):
+    """The uploaded image is over IMAGE_MAX_UPLOAD_BYTES, IMAGE_MAX_PIXELS or IMAGE_MAX_INLINE_BYTES."""
+
+
+def check_image_size(image_path):
+    """
+    Reject an oversized upload before any of it is read.
+
+    Returns:
+        int: The size of the file in bytes
+    """
+    size = os.path.getsize(image_path)
+    if size > IMAGE_MAX_UPLOAD_BYTES:
+        raise ImageTooLargeError(
+            f"Image is {size} bytes, the limit is {IMAGE_MAX_UPLOAD_BYTES} bytes."
+        )
+    return size
+
+
+def data_url(source, mime_type, size):
+    """
+    Base64 encode an image straight into a data URL, chunk by chunk. Only the
+    URL is held in memory, not the raw bytes, their base64 copy and the URL.
+
+    Args:
+        source: The image bytes, or a binary file to read them from
+        mime_type (str): MIME type for the URL
+        size (int): Length of the image in bytes
+
+    Returns:
+        str: "data:<mime_type>;base64,..."
+    """
+    prefix = f"data:{mime_type};base64,".encode("ascii")
+    url = bytearray(len(prefix) + 4 * ((size + 2) // 3))
+    url[:len(prefix)] = prefix
+    position = len(prefix)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        # BytesIO shares the bytes instead of copying them
+        source = io.BytesIO(source)
+    # Read into one reused buffer, only one chunk of base64 is in flight
+    buffer = bytearray(ENCODE_CHUNK_SIZE)
+    view = memoryview(buffer)
+    remaining = size
+    while remaining:
+        # Never more than size bytes, even if the file grew meanwhile
+        length = source.readinto(view[:min(remaining, ENCODE_CHUNK_SIZE)])
+        if not length:
+            break
+        encoded_length = 4 * ((length + 2) // 3)
+        url[position:position + encoded_length] = base64.b64encode(view[:length])
+        position += encoded_length
+        remaining -= length
+    view.release()
+    del buffer, url[position:]
+    return url.decode("ascii")
+
+
+def encode_image(image_path):
+    with open(image_path, "rb") as image_file:
+        return base64.b64encode(image_file.read()).decode('utf-8')
+
+
+def _file_sha256(path):
+    """SHA-256 of a file, read in chunks into one reused buffer."""
+    digest = hashlib.sha256()
+    buffer = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb") as file:
+        while (length := file.readinto(buffer)):
+            digest.update(view[:length])
+    return digest.hexdigest()
+
+
+class PreparedImage:
+    """An image ready to be sent to the LLM."""
+
+    def __init__(self, url, mime_type, original_bytes, encoded_bytes, content_hash=None, perceptual_hash=None):
+        self.url = url  # base64 data URL, sent as is with every request
+        self.mime_type = mime_type
+        self.original_bytes = original_bytes
+        self.encoded_bytes = encoded_bytes
+        self.content_hash = content_hash  # SHA-256 of the uploaded bytes
+        self.perceptual_hash = perceptual_hash  # 64-bit dHash, None without Pillow
+
+    @property
+    def data(self):
+        """The bare base64 data (a copy, send url instead)."""
+        return self.url.partition(",")[2]
+
+    def __repr__(self):
+        return f"PreparedImage({self.mime_type}, {self.original_bytes} -> {self.encoded_bytes} bytes)"
+
+
+def _reencode(image_path, Image, ImageOps):
+    """Downscale, drop metadata and re-encode. Returns (bytes, mime_type, perceptual hash)."""
+    # Pillow reads the file as it decodes, the upload is never in memory as a whole
+    with Image.open(image_path) as original:
+        # JPEGs are decoded straight at the smallest 1/2, 1/4 or 1/8 scale that
+        # still covers IMAGE_MAX_SIDE, not at full size
+        original.draft("RGB", (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+        width, height = original.size
+        if width * height > IMAGE_MAX_PIXELS:
+            raise ImageTooLargeError(
+                f"Image is {width}x{height} pixels, the limit is {IMAGE_MAX_PIXELS} pixels."
+            )
+        # Apply the EXIF orientation before the metadata is dropped
+        image = ImageOps.exif_transpose(original)
+        # thumbnail keeps the aspect ratio and never upscales
+        image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        perceptual_hash = dhash(image)
+
+        buffer = io.BytesIO()
+        # No exif= argument, so the metadata is not written back
+        image.save(buffer, format=IMAGE_FORMAT, quality=IMAGE_QUALITY)
+    mime_type = "image/webp" if IMAGE_FORMAT == "WEBP" else "image/jpeg"
+    return buffer.getvalue(), mime_type, perceptual_hash
+
+
+def prepare_image(image_path):
+    """
+    Decode the uploaded image, cap its longest side at IMAGE_MAX_SIDE, strip
+    EXIF and re-encode it before it is uploaded to the LLM.
+
+    Memory stays bounded by the prepared image, not the upload: the file is
+    hashed and decoded as it is read, and base64 goes straight into the data URL.
+
+    Args:
+        image_path (str): Path to the uploaded image
+
+    Returns:
+        PreparedImage: Data URL, real MIME type and before/after byte counts
+
+    Raises:
+        ImageTooLargeError: The upload is over one of the IMAGE_MAX_* limits
+    """
+    original_size = check_image_size(image_path)
+    content_hash = _file_sha256(image_path)
+
+    data, mime_type = None, mimetypes.guess_type(image_path)[0] or "image/jpeg"
+    perceptual_hash = None
+    pillow = _pillow()
+    # Without Pillow the image is sent as uploaded
+    if pillow is not None:
+        try:
+            data, mime_type, perceptual_hash = _reencode(image_path, *pillow)
+        except ImageTooLargeError:
+            raise
+        except Exception as e:
+            logger.warning(f"Could not preprocess image, sending it as uploaded: {e}")
+
+    if data is None:
+        if original_size > IMAGE_MAX_INLINE_BYTES:
+            raise ImageTooLargeError(
+                f"Image is {original_size} bytes and can't be downscaled, the limit is {IMAGE_MAX_INLINE_BYTES} bytes."
+            )
+        encoded_size = original_size
+        with open(image_path, "rb") as image_file:
+            url = data_url(image_file, mime_type, original_size)
+    else:
+        encoded_size = len(data)
+        url = data_url(data, mime_type, encoded_size)
+        del data
+
+    logger.info(f"Image prepared: {original_size} -> {encoded_size} bytes ({mime_type})")
+    metrics.record_bytes("image", "in", original_size)
+    metrics.record_bytes("image", "out", encoded_size)
+    return PreparedImage(
+        url, mime_type, original_size, encoded_size,
+        content_hash=content_hash,
+        perceptual_hash=perceptual_hash,
+    )
+
+# step3: Setup Multimodal LLM
+from result_cache import ResultCache
+
+query="Is there is something wrong with my face?"
+model="meta-llama/llama-4-scout-17b-16e-instruct"
+
+# Memoized answers for identical consultations (same image bytes, transcript, model and prompt)
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE", "1") == "1"
+response_cache = ResultCache(
+    max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "512")),
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL", "3600")),
+)
+
+# Reuse answers for visually equivalent images with a similar transcript
+NEAR_DUPLICATE_CACHE_ENABLED = os.getenv("NEAR_DUPLICATE_CACHE", "1") == "1"
+# Its entries expire with the response cache's
+near_duplicates = NearDuplicateIndex(ttl=response_cache.ttl) if NEAR_DUPLICATE_CACHE_ENABLED else None
+
+def _user_message(text, encoded_image=None, mime_type="image/jpeg"):
+    content = [{"type": "text", "text": text}]
+    if encoded_image is not None:
+        # A data URL (PreparedImage.url) is sent as is, base64 never contains ":"
+        if not encoded_image.startswith("data:"):
+            encoded_image = f"data:{mime_type};base64,{encoded_image}"
+        content.append({
+            "type": "image_url",
+            "image_url": {"url": encoded_image},
+        })
+    return {"role": "user", "content": content}
+
+def _build_messages(query, encoded_image, mime_type="image/jpeg", system_prompt=None):
+    # The doctor's instructions go in a real system message, not in front of the transcript
+    messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+    messages.append(_user_message(query, encoded_image, mime_type))
+    return messages
+
+def complete(messages, model="meta-llama/llama-4-scout-17b-16e-instruct"):
+    """
+    Send a prepared conversation to the LLM.
+
+    Args:
+        messages (list): Chat messages, system message first
+        model (str): The model to use
+
+    Returns:
+        str: The model's answer
+    """
+    # Queued behind the LLM concurrency and rate limits, 429s are retried there
+    chat_completion=scheduler.call("llm", lambda: get_client().chat.completions.create(
+        messages=messages,
+        model=model,
+    ))
+    return chat_completion.choices[0].message.content
+
+async def complete_async(messages, model="meta-llama/llama-4-scout-17b-16e-instruct"):
+    """Async version of complete, runs on the shared AsyncGroq pool."""
+    chat_completion=await scheduler.call_async("llm", lambda: get_async_client().chat.completions.create(
+        messages=messages,
+        model=model,
+    ))
+    return chat_completion.choices[0].message.content
+
+def stream_completion(messages, model="meta-llama/llama-4-scout-17b-16e-instruct"):
+    """
+    Same as complete but uses the streaming completion API.
+
+    Yields:
+        str: Pieces of the answer as soon as the model produces them
+    """
+    start=time.perf_counter()
+    first_token=True
+    with metrics.stage("llm_stream"):
+        # The LLM slot is held until the whole answer has streamed in
+        stream=scheduler.stream("llm", lambda: get_client().chat.completions.create(
+            messages=messages,
+            model=model,
+            stream=True,
+        ))
+
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta=chunk.choices[0].delta.content
+            if delta:
+                if first_token:
+                    metrics.record_stage("llm_first_token", time.perf_counter() - start)
+                    first_token=False
+                yield delta
+
+def analyze_image_with_query(query, encoded_image, model="meta-llama/llama-4-scout-17b-16e-instruct", mime_type="image/jpeg", system_prompt=None):
+    return complete(_build_messages(query, encoded_image, mime_type, system_prompt), model)
+
+async def analyze_image_with_query_async(query, encoded_image, model="meta-llama/llama-4-scout-17b-16e-instruct", mime_type="image/jpeg", system_prompt=None):
+    """Async version of analyze_image_with_query, runs on the shared AsyncGroq pool."""
+    return await complete_async(_build_messages(query, encoded_image, mime_type, system_prompt), model)
+
+def stream_image_analysis(query, encoded_image, model="meta-llama/llama-4-scout-17b-16e-instruct", mime_type="image/jpeg", system_prompt=None):
+    """
+    Same as analyze_image_with_query but uses the streaming completion API.
+
+    Yields:
+        str: Pieces of the doctor's answer as soon as the model produces them
+    """
+    yield from stream_completion(_build_messages(query, encoded_image, mime_type, system_prompt), model)
+
+# step4: Memoized consultations
+def normalize_transcript(transcript):
+    """Lower-case and collapse whitespace so trivial differences still match."""
+    return " ".join(transcript.lower().split())
+
+def consultation_key(system_prompt, transcript, image, model):
+    """
+    Cache key of a consultation: image content hash, normalized transcript,
+    model and a hash of the system prompt.
+    """
+    prompt_hash = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()
+    return (image.content_hash, normalize_transcript(transcript), model, prompt_hash)
+
+def _similar_answer(key, image):
+    """Answer of a prior near-duplicate consultation, or None."""
+    if near_duplicates is None or image.perceptual_hash is None:
+        return None
+    # key is (content hash, transcript, model, prompt hash)
+    return near_duplicates.find(image.perceptual_hash, key[1], key[2:])
+
+def _remember_similar(key, image, answer):
+    if near_duplicates is not None and image.perceptual_hash is not None:
+        near_duplicates.add(image.perceptual_hash, key[1], key[2:], answer)
+
+def _cacheable(transcript, image):
+    # Never remember answers given to a failed transcription
+    return RESPONSE_CACHE_ENABLED and image.content_hash and not transcript.lower().startswith("error")
+
+def diagnose(system_prompt, transcript, image, model="meta-llama/llama-4-scout-17b-16e-instruct"):
+    """
+    Memoized analyze_image_with_query for a whole consultation. Identical
+    submissions that arrive at the same time share one LLM call.
+
+    Args:
+        system_prompt (str): The doctor's instructions
+        transcript (str): What the patient said
+        image (PreparedImage): The prepared image
+        model (str): The multimodal model to use
+
+    Returns:
+        str: The doctor's answer
+    """
+    return diagnose_with_source(system_prompt, transcript, image, model)[0]
+
+def diagnose_with_source(system_prompt, transcript, image, model="meta-llama/llama-4-scout-17b-16e-instruct",
+                         caches=True):
+    """
+    Like diagnose, but also says where the answer came from.
+
+    Args:
+        caches (bool): False asks the model every time and remembers nothing
+
+    Returns:
+        tuple: (answer, source), source is "llm", "response_cache" or "near_duplicate"
+    """
+    if not caches or not _cacheable(transcript, image):
+        return analyze_image_with_query(transcript, image.url, model, image.mime_type, system_prompt), "llm"
+
+    key = consultation_key(system_prompt, transcript, image, model)
+    # Stays "response_cache" on a hit, or when another caller's computation is shared
+    source = "response_cache"
+
+    def compute():
+        nonlocal source
+        answer = _similar_answer(key, image)
+        if answer is None:
+            answer = analyze_image_with_query(transcript, image.url, model, image.mime_type, system_prompt)
+            _remember_similar(key, image, answer)
+            source = "llm"
+        else:
+            source = "near_duplicate"
+        return answer
+
+    answer = response_cache.get_or_compute(key, compute)
+    return answer, source
+
+async def diagnose_async(system_prompt, transcript, image, model="meta-llama/llama-4-scout-17b-16e-instruct"):
+    """Async version of diagnose."""
+    if not _cacheable(transcript, image):
+        return await analyze_image_with_query_async(transcript, image.url, model, image.mime_type, system_prompt)
+
+    key = consultation_key(system_prompt, transcript, image, model)
+
+    async def compute():
+        answer = _similar_answer(key, image)
+        if answer is None:
+            answer = await analyze_image_with_query_async(transcript, image.url, model, image.mime_type, system_prompt)
+            _remember_similar(key, image, answer)
+        return answer
+
+    return await response_cache.get_or_compute_async(key, compute)
+
+def stream_diagnosis(system_prompt, transcript, image, model="meta-llama/llama-4-scout-17b-16e-instruct"):
+    """
+    Streaming version of diagnose. A remembered answer is yielded in one piece,
+    otherwise the streamed answer is remembered once it is complete.
+
+    Yields:
+        str: Pieces of the doctor's answer
+    """
+    cacheable = _cacheable(transcript, image)
+    key = consultation_key(system_prompt, transcript, image, model) if cacheable else None
+    if cacheable:
+        cached = response_cache.get(key)
+        if cached is None:
+            cached = _similar_answer(key, image)
+        if cached is not None:
+            yield cached
+            return
+
+    pieces = []
+    for piece in stream_image_analysis(transcript, image.url, model, image.mime_type, system_prompt):
+        pieces.append(piece)
+        yield piece
+
+    if cacheable:
+        answer = "".join(pieces)
+        response_cache.put(key, answer)
+        _remember_similar(key, image, answer)
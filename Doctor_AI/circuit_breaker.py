@@ -0,0 +1,215 @@
+# Circuit breakers for the upstream services
+#
+# Every Upstream in scheduler.py has a CircuitBreaker. It watches the outcome
+# of the calls made in the last BREAKER_WINDOW seconds. Once at least
+# BREAKER_MIN_CALLS were made and BREAKER_FAILURE_RATE of them failed, the
+# circuit opens: calls fail right away with CircuitOpenError instead of
+# queueing behind a dead service and tying up worker threads. Callers with a
+# fallback (local Whisper for STT, the next TTS engine) switch to it at once.
+#
+# After BREAKER_OPEN_SECONDS the circuit is half-open and lets
+# BREAKER_HALF_OPEN_PROBES calls through. A successful probe closes it, a
+# failed one opens it again for twice as long (up to BREAKER_MAX_OPEN_SECONDS).
+# Calls that started before the circuit opened don't decide anything.
+#
+# Failures are transport errors (timeouts, refused or dropped connections)
+# and 5xx, 408 and 429 answers. Other 4xx answers mean the service is up. Any
+# other exception (a bug, bad input) says nothing about the service, the call
+# is not counted at all.
+
+import os
+import sys
+import time
+import threading
+from collections import deque
+
+# Seconds of calls the failure rate is computed over
+BREAKER_WINDOW = float(os.getenv("BREAKER_WINDOW", "30"))
+# Calls needed in the window before the failure rate can open the circuit
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "8"))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "15"))
+BREAKER_MAX_OPEN_SECONDS = float(os.getenv("BREAKER_MAX_OPEN_SECONDS", "120"))
+BREAKER_HALF_OPEN_PROBES = int(os.getenv("BREAKER_HALF_OPEN_PROBES", "1"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+# Numeric state for the /metrics gauge
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# Transport errors of the client libraries as (module, class). Looked up only
+# once the module is imported, an error can't come from a module that isn't.
+TRANSPORT_ERRORS = (
+    ("httpx", "TransportError"),            # timeouts, connect and network errors
+    ("groq", "APIConnectionError"),         # includes APITimeoutError
+    ("aiohttp", "ClientConnectionError"),   # Edge TTS, includes ServerTimeoutError
+    ("edge_tts.exceptions", "WebSocketError"),
+)
+
+
+class CircuitOpenError(RuntimeError):
+    """The upstream's circuit is open, the call was not made."""
+
+    def __init__(self, upstream, retry_in):
+        self.upstream = upstream
+        self.retry_in = retry_in
+        super().__init__(
+            f"The {upstream} service is unavailable, not trying again for {retry_in:.1f}s."
+        )
+
+
+def status_code(error):
+    """
+    Returns:
+        int: The HTTP status the upstream answered with, or None if it didn't answer
+    """
+    status = getattr(error, "status_code", None) or getattr(error, "status", None)
+    if status is None:
+        # httpx.HTTPStatusError keeps it on the response
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def _transport_errors():
+    types = [TimeoutError, ConnectionError]
+    for module_name, name in TRANSPORT_ERRORS:
+        error_type = getattr(sys.modules.get(module_name), name, None)
+        if error_type is not None:
+            types.append(error_type)
+    return tuple(types)
+
+
+def is_failure(error):
+    """True when error says the upstream is unhealthy (not that the request was refused)."""
+    status = status_code(error)
+    if status is not None:
+        # 408 Request Timeout is the service being slow, 429 is it being overloaded
+        return status >= 500 or status in (408, 429)
+    return isinstance(error, _transport_errors())
+
+
+class CircuitBreaker:
+    """
+    Failure-rate circuit breaker for one upstream.
+
+    Callers ask allow() before each call and report the outcome with record(),
+    or cancel() when the call was never made (e.g. the queue turned it away).
+    """
+
+    def __init__(self, name, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS,
+                 failure_rate=BREAKER_FAILURE_RATE, open_seconds=BREAKER_OPEN_SECONDS,
+                 max_open_seconds=BREAKER_MAX_OPEN_SECONDS, probes=BREAKER_HALF_OPEN_PROBES):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.probes = max(1, probes)
+        self.state = CLOSED
+        self.opened = 0             # times the circuit opened
+        self.rejected = 0           # calls failed fast while open
+        self.last_error = None
+        self._outcomes = deque()    # (monotonic time, ok)
+        self._failures = 0
+        self._open_until = 0.0
+        self._open_for = open_seconds
+        self._probing = 0
+        self._lock = threading.Lock()
+
+    def _prune_locked(self, now):
+        while self._outcomes and now - self._outcomes[0][0] > self.window:
+            _, ok = self._outcomes.popleft()
+            if not ok:
+                self._failures -= 1
+
+    def _open_locked(self, now):
+        self.state = OPEN
+        self.opened += 1
+        self._open_until = now + self._open_for
+        self._outcomes.clear()
+        self._failures = 0
+
+    def allow(self):
+        """
+        Ask to make a call. Raises CircuitOpenError while the circuit is open.
+
+        Returns:
+            bool: True when the call is a half-open probe
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN and now >= self._open_until:
+                self.state = HALF_OPEN
+                self._probing = 0
+            if self.state == CLOSED:
+                return False
+            if self.state == HALF_OPEN and self._probing < self.probes:
+                self._probing += 1
+                return True
+            self.rejected += 1
+            # Half-open with every probe in flight: wait for their outcome
+            raise CircuitOpenError(self.name, max(0.0, self._open_until - now))
+
+    def record(self, ok, probe=False, error=None):
+        """Report the outcome of a call allow() let through."""
+        with self._lock:
+            now = time.monotonic()
+            if not ok:
+                self.last_error = str(error) if error is not None else None
+            if probe:
+                self._probing -= 1
+            if self.state == HALF_OPEN:
+                # Only a probe decides, other calls started before the circuit opened
+                if probe and ok:
+                    self.state = CLOSED
+                    self._open_for = self.open_seconds
+                elif probe:
+                    self._open_for = min(self._open_for * 2, self.max_open_seconds)
+                    self._open_locked(now)
+                return
+            if self.state == OPEN:
+                # A call started before the circuit opened
+                return
+
+            self._outcomes.append((now, ok))
+            if not ok:
+                self._failures += 1
+            self._prune_locked(now)
+            calls = len(self._outcomes)
+            if calls >= self.min_calls and self._failures / calls >= self.failure_rate:
+                self._open_locked(now)
+
+    def cancel(self, probe=False):
+        """The call allow() let through was not made after all."""
+        if probe:
+            with self._lock:
+                self._probing -= 1
+
+    def is_open(self):
+        """True while calls would fail fast (half-open counts as closed, it lets probes through)."""
+        with self._lock:
+            return self.state == OPEN and time.monotonic() < self._open_until
+
+    def retry_in(self):
+        """Seconds until the circuit lets a probe through (0 when it is not open)."""
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self._open_until - time.monotonic())
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            self._prune_locked(now)
+            calls = len(self._outcomes)
+            return {
+                "state": self.state,
+                "calls": calls,
+                "failure_rate": round(self._failures / calls, 3) if calls else 0.0,
+                "retry_in": round(max(0.0, self._open_until - now), 3) if self.state == OPEN else 0.0,
+                "opened": self.opened,
+                "rejected": self.rejected,
+                "last_error": self.last_error,
+            }
@@ -0,0 +1,208 @@
+# Multi-turn consultations
+#
+# A Consultation is the conversation one patient has about one image. It is
+# kept in a gr.State, so a follow-up question ("is it contagious?") continues
+# the same conversation instead of starting a new full multimodal request:
+#
+# - the doctor's instructions are a real system message
+# - the image is prepared once and sent with the first question only, the
+#   doctor's first answer carries what was seen into the follow-ups
+#   (set CONSULTATION_RESEND_IMAGE=1 to attach it to every question). After
+#   the first answer the consultation lets go of the image's data URL.
+# - asking the first or the latest question again is a repeat: the same
+#   answer comes back without another LLM call or a new turn
+# - history is kept within CONSULTATION_TOKEN_BUDGET: once the turns outgrow
+#   it the oldest are folded into a short summary in the system message, so
+#   a long consultation doesn't grow the prompt (and its cost) without limit
+
+import os
+
+from brain_of_the_doctor import (
+    _user_message, complete, complete_async, stream_completion,
+    diagnose, diagnose_async, stream_diagnosis, normalize_transcript,
+)
+
+# Tokens of history (summary plus earlier turns) sent with a follow-up
+CONSULTATION_TOKEN_BUDGET = int(os.getenv("CONSULTATION_TOKEN_BUDGET", "1500"))
+# The summary of compacted turns is capped at this many tokens
+CONSULTATION_SUMMARY_TOKENS = int(os.getenv("CONSULTATION_SUMMARY_TOKENS", "400"))
+CONSULTATION_RESEND_IMAGE = os.getenv("CONSULTATION_RESEND_IMAGE", "0") == "1"
+
+# How much of a compacted turn stays in the summary
+SUMMARY_QUESTION_CHARS = 200
+SUMMARY_ANSWER_SENTENCES = 2
+
+
+def estimate_tokens(text):
+    """Rough token count (about 4 characters per token), good enough for budgeting."""
+    return len(text) // 4 + 1
+
+
+def _clip(text, max_chars):
+    text = " ".join(text.split())
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rsplit(" ", 1)[0] + "..."
+
+
+def _first_sentences(text, count):
+    sentences = []
+    for part in " ".join(text.split()).split(". "):
+        sentences.append(part.rstrip("."))
+        if len(sentences) == count:
+            break
+    return ". ".join(sentences) + "."
+
+
+class Consultation:
+    """
+    One patient's conversation about one image.
+
+    Args:
+        system_prompt (str): The doctor's instructions
+        model (str): The multimodal model to use
+        image_path (str): The uploaded image this consultation is about
+        image (PreparedImage): The prepared image, sent with the first question.
+            Only kept after the first answer with CONSULTATION_RESEND_IMAGE=1.
+    """
+
+    def __init__(self, system_prompt, model, image_path, image):
+        self.system_prompt = system_prompt
+        self.model = model
+        self.image_path = image_path
+        self.image = image
+        self.turns = []     # (question, answer) pairs sent verbatim
+        self.summary = []   # one line per compacted turn, oldest first
+        self.first_turn = None  # (normalized question, answer), kept through compaction
+
+    def __repr__(self):
+        return f"Consultation({len(self.turns)} turns, {len(self.summary)} summarized)"
+
+    def matches(self, image_path):
+        """True when a question about image_path continues this consultation."""
+        return image_path == self.image_path
+
+    @property
+    def is_first_turn(self):
+        return not self.turns and not self.summary
+
+    def repeat(self, question):
+        """
+        Returns:
+            str: The answer already given when question repeats the first or
+            the latest question, otherwise None
+        """
+        if self.first_turn is None:
+            return None
+        question = normalize_transcript(question)
+        if question == self.first_turn[0]:
+            return self.first_turn[1]
+        if normalize_transcript(self.turns[-1][0]) == question:
+            return self.turns[-1][1]
+        return None
+
+    # --- Prompt ---
+    def _system_message(self):
+        content = self.system_prompt
+        if self.summary:
+            content += "\n\nEarlier in this consultation:\n" + "\n".join(self.summary)
+        return {"role": "system", "content": content}
+
+    def history_tokens(self):
+        """Estimated tokens of the summary and the turns kept verbatim."""
+        return (sum(estimate_tokens(line) for line in self.summary)
+                + sum(estimate_tokens(question) + estimate_tokens(answer) for question, answer in self.turns))
+
+    def messages(self, question):
+        """
+        Returns:
+            list: Chat messages for a follow-up: system message (with the
+            summary), the recent turns and the new question
+        """
+        messages = [self._system_message()]
+        for earlier_question, answer in self.turns:
+            messages.append({"role": "user", "content": earlier_question})
+            messages.append({"role": "assistant", "content": answer})
+        if CONSULTATION_RESEND_IMAGE:
+            messages.append(_user_message(question, self.image.url, self.image.mime_type))
+        else:
+            messages.append({"role": "user", "content": question})
+        return messages
+
+    # --- History ---
+    def record(self, question, answer):
+        """Add a finished turn and compact the history if it is over budget."""
+        # A failed transcription is not part of the conversation
+        if question.lower().startswith("error"):
+            return
+        if self.first_turn is None:
+            self.first_turn = (normalize_transcript(question), answer)
+            if not CONSULTATION_RESEND_IMAGE:
+                # What the doctor saw is in the answer now, the data URL can go
+                self.image = None
+        self.turns.append((question, answer))
+        self._compact()
+
+    def _compact(self):
+        # The latest turn always stays verbatim
+        while len(self.turns) > 1 and self.history_tokens() > CONSULTATION_TOKEN_BUDGET:
+            question, answer = self.turns.pop(0)
+            self.summary.append(
+                f"- Patient: {_clip(question, SUMMARY_QUESTION_CHARS)} "
+                f"Doctor: {_first_sentences(answer, SUMMARY_ANSWER_SENTENCES)}"
+            )
+        # The first line holds what the doctor saw in the image, it is dropped last
+        while len(self.summary) > 1 and sum(map(estimate_tokens, self.summary)) > CONSULTATION_SUMMARY_TOKENS:
+            del self.summary[1]
+
+    # --- Asking ---
+    def ask(self, question):
+        """
+        Answer the patient's question in the context of this consultation.
+        The first question goes through diagnose (and its caches).
+
+        Returns:
+            str: The doctor's answer
+        """
+        answer = self.repeat(question)
+        if answer is not None:
+            return answer
+        if self.is_first_turn:
+            answer = diagnose(self.system_prompt, question, self.image, self.model)
+        else:
+            answer = complete(self.messages(question), self.model)
+        self.record(question, answer)
+        return answer
+
+    async def ask_async(self, question):
+        """Async version of ask."""
+        answer = self.repeat(question)
+        if answer is not None:
+            return answer
+        if self.is_first_turn:
+            answer = await diagnose_async(self.system_prompt, question, self.image, self.model)
+        else:
+            answer = await complete_async(self.messages(question), self.model)
+        self.record(question, answer)
+        return answer
+
+    def stream(self, question):
+        """
+        Streaming version of ask. The turn is recorded once the answer is complete.
+
+        Yields:
+            str: Pieces of the doctor's answer
+        """
+        answer = self.repeat(question)
+        if answer is not None:
+            yield answer
+            return
+        if self.is_first_turn:
+            tokens = stream_diagnosis(self.system_prompt, question, self.image, self.model)
+        else:
+            tokens = stream_completion(self.messages(question), self.model)
+        pieces = []
+        for piece in tokens:
+            pieces.append(piece)
+            yield piece
+        self.record(question, "".join(pieces))
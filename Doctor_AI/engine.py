@@ -0,0 +1,353 @@
+# Consultation engine
+#
+# The STT -> LLM -> TTS pipeline behind every front end: the Gradio UIs
+# (app.py, gradio_app.py) and the JSON/HTTP API (api.py) all call it.
+#
+# consult, consult_async and stream_consultation run one consultation and
+# return plain values. process_input, process_input_async and
+# process_input_streaming are the same calls wrapped as Gradio handlers, with
+# per-request timing (metrics.timed_request).
+
+import os
+import math
+import asyncio
+
+from startup import lazy_import, timed
+
+# Import core functions from other modules
+with timed("import doctor modules"):
+    from brain_of_the_doctor import prepare_image, check_image_size, ImageTooLargeError
+    from consultation import Consultation
+    from voice_of_the_patient import transcribe_with_groq, transcribe_with_groq_async
+    from voice_of_the_doctor import (get_doctor_voice_for_ui, get_doctor_voice_for_ui_async,
+                                     get_doctor_voice_bytes, get_doctor_voice_bytes_async, speak_sentences)
+    from pipeline import run_stages, run_stage, run_stages_async, run_stage_async
+    from output_store import OutputStore
+    from metrics import timed_request
+    from scheduler import UpstreamBusyError
+    from circuit_breaker import CircuitOpenError
+
+# --- Configuration ---
+# Create a dedicated folder for audio outputs
+OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "audio_outputs")
+# Unique file names plus a background reaper for old files (see output_store.py)
+OUTPUT_STORE = OutputStore(OUTPUT_DIR).start_reaper()
+
+# Hand the doctor's voice over as MP3 bytes instead of writing a file to
+# the output store and reading it back (set IN_MEMORY_AUDIO=0 to keep files)
+IN_MEMORY_AUDIO = os.getenv("IN_MEMORY_AUDIO", "1") == "1"
+
+# Stream the microphone and transcribe each utterance while the patient is
+# still speaking, see live_transcription.py (set LIVE_TRANSCRIPTION=1 to enable)
+LIVE_TRANSCRIPTION = os.getenv("LIVE_TRANSCRIPTION", "0") == "1"
+
+# Multimodal model for the analysis
+MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"
+
+# System prompt for the doctor
+system_prompt ="""You have to act as a professional doctor, i know you are not but this is for learning purpose. 
+            What's in this image?. Do you find anything wrong with it medically? 
+            If you make a differential, suggest some remedies for them. Donot add any numbers or special characters in 
+            your response. Your response should be in one long paragraph. Also always answer as if you are answering to a real person.
+            Donot say 'In the image I see' but say 'With what I see, I think you have ....'
+            Dont respond as an AI model in markdown, your answer should mimic that of an actual doctor not an AI bot, 
+            Keep your answer concise (max 5 sentences). No preamble, start your answer right away please"""
+
+
+# --- Core Processing Logic ---
+APOLOGY = "I apologize, but I encountered an error while analyzing your image. Please try again."
+
+
+def _wait_phrase(seconds):
+    """Roughly how long to wait, e.g. "about 20 seconds"."""
+    if seconds < 5:
+        return "a few seconds"
+    if seconds < 90:
+        return f"about {math.ceil(seconds / 5) * 5} seconds"
+    return f"about {math.ceil(seconds / 60)} minutes"
+
+
+def _apology(error):
+    """What the doctor says when the image couldn't be analyzed."""
+    if isinstance(error, ImageTooLargeError):
+        return f"Your image is too large for me to look at. {error} Please upload a smaller photo."
+    if isinstance(error, UpstreamBusyError):
+        return (f"I'm seeing a lot of patients right now and couldn't get to your image. "
+                f"Please try again in {_wait_phrase(error.expected_wait)}.")
+    if isinstance(error, CircuitOpenError):
+        return (f"I can't reach the analysis service at the moment. "
+                f"Please try again in {_wait_phrase(error.retry_in)}.")
+    return APOLOGY
+
+
+def _oversized_image(image_filepath):
+    """The ImageTooLargeError for an upload over the size limit, checked before any work starts."""
+    try:
+        check_image_size(image_filepath)
+    except ImageTooLargeError as e:
+        return e
+    except OSError:
+        # A missing file fails in prepare_image like before
+        pass
+    return None
+
+
+def consult(audio_filepath, image_filepath, live=None, consultation=None, speak=True):
+    """
+    Process the patient's audio and image inputs and generate a doctor's response
+
+    Args:
+        audio_filepath: Path to the patient's audio recording
+        image_filepath: Path to the patient's uploaded image
+        live: The session's LiveTranscriber in live transcription mode
+        consultation: The session's Consultation, a question about the same image is a follow-up
+        speak (bool): Generate the doctor's voice (False leaves it None)
+
+    Returns:
+        tuple: (transcript, doctor's answer, doctor's voice, image path, consultation),
+        the voice is MP3 bytes, a file path (IN_MEMORY_AUDIO=0) or None
+    """
+    # Ensure we have valid inputs
+    # In live mode the audio arrives as streamed chunks, transcribed on the way
+    live_speech = live is not None and live.has_speech()
+    if not audio_filepath and not live_speech:
+        return "No audio input detected.", "Please record your question for the doctor. I need to hear your symptoms to provide an assessment.", None, None, consultation
+
+    if not image_filepath:
+        return "Audio detected, but no image uploaded.", "I need both your audio description and a medical image to provide an accurate diagnosis. Please upload an image for me to analyze.", None, None, consultation
+
+    # Reject an oversized upload before the transcription is paid for
+    oversized = _oversized_image(image_filepath)
+    if oversized is not None:
+        return "Image too large.", _apology(oversized), None, None, consultation
+    
+    # Convert patient's speech to text and encode the image at the same time,
+    # the image doesn't depend on the transcript
+    # A question about the same image continues the consultation, the image
+    # was prepared (and sent) with its first question
+    follow_up = consultation is not None and consultation.matches(image_filepath)
+    stages = {"stt": (live.finish,) if live_speech else (transcribe_with_groq, audio_filepath)}
+    if not follow_up:
+        stages["image"] = (prepare_image, image_filepath)
+    prepared = run_stages(stages)
+
+    if prepared["stt"].ok:
+        speech_to_text_output = prepared["stt"].value
+    else:
+        print(f"Error transcribing speech: {prepared['stt'].error}")
+        speech_to_text_output = "Error transcribing your speech. Please try again."
+    
+    # Generate the doctor's response from the transcript and the encoded image
+    if not follow_up:
+        consultation = None
+        if prepared["image"].ok:
+            consultation = Consultation(system_prompt, MODEL,
+                                        image_filepath, prepared["image"].value)
+
+    if consultation is not None:
+        analysis = run_stage("llm", consultation.ask, speech_to_text_output)
+    else:
+        analysis = prepared["image"]
+
+    if analysis.ok:
+        doctor_response = analysis.value
+    else:
+        print(f"Error generating doctor response: {analysis.error}")
+        doctor_response = _apology(analysis.error)
+    
+    if not speak:
+        return speech_to_text_output, doctor_response, None, image_filepath, consultation
+
+    # Generate the doctor's voice response using our deep male voice
+    if IN_MEMORY_AUDIO:
+        voice = run_stage("tts", get_doctor_voice_bytes, doctor_response)
+        if not voice.ok or not voice.value:
+            print(f"Error generating voice: {voice.error or 'no audio'}")
+            return speech_to_text_output, doctor_response, None, image_filepath, consultation
+        return speech_to_text_output, doctor_response, voice.value, image_filepath, consultation
+
+    # Create a unique filename for this response
+    audio_output_path = OUTPUT_STORE.new_path("doctor_response")
+    voice = run_stage("tts", get_doctor_voice_for_ui, doctor_response, audio_output_path)
+
+    if not voice.ok:
+        print(f"Error generating voice: {voice.error}")
+        return speech_to_text_output, doctor_response, None, image_filepath, consultation
+
+    # Check if file was created successfully
+    if os.path.exists(audio_output_path):
+        return speech_to_text_output, doctor_response, audio_output_path, image_filepath, consultation
+    else:
+        print("Warning: Audio file not created")
+        return speech_to_text_output, doctor_response, None, image_filepath, consultation
+
+
+async def consult_async(audio_filepath, image_filepath, live=None, consultation=None, speak=True):
+    """
+    Async version of consult. Every network call runs on the shared
+    AsyncGroq pool, so one event loop can serve many consultations at once
+    without tying up a thread per request.
+    """
+    # In live mode the audio arrives as streamed chunks, transcribed on the way
+    live_speech = live is not None and live.has_speech()
+    if not audio_filepath and not live_speech:
+        return "No audio input detected.", "Please record your question for the doctor. I need to hear your symptoms to provide an assessment.", None, None, consultation
+
+    if not image_filepath:
+        return "Audio detected, but no image uploaded.", "I need both your audio description and a medical image to provide an accurate diagnosis. Please upload an image for me to analyze.", None, None, consultation
+
+    # Reject an oversized upload before the transcription is paid for
+    oversized = _oversized_image(image_filepath)
+    if oversized is not None:
+        return "Image too large.", _apology(oversized), None, None, consultation
+
+    follow_up = consultation is not None and consultation.matches(image_filepath)
+    stages = {"stt": asyncio.to_thread(live.finish) if live_speech else transcribe_with_groq_async(audio_filepath)}
+    if not follow_up:
+        stages["image"] = asyncio.to_thread(prepare_image, image_filepath)
+    prepared = await run_stages_async(stages)
+
+    if prepared["stt"].ok:
+        speech_to_text_output = prepared["stt"].value
+    else:
+        print(f"Error transcribing speech: {prepared['stt'].error}")
+        speech_to_text_output = "Error transcribing your speech. Please try again."
+
+    if not follow_up:
+        consultation = None
+        if prepared["image"].ok:
+            consultation = Consultation(system_prompt, MODEL,
+                                        image_filepath, prepared["image"].value)
+
+    if consultation is not None:
+        analysis = await run_stage_async("llm", consultation.ask_async(speech_to_text_output))
+    else:
+        analysis = prepared["image"]
+
+    if analysis.ok:
+        doctor_response = analysis.value
+    else:
+        print(f"Error generating doctor response: {analysis.error}")
+        doctor_response = _apology(analysis.error)
+
+    if not speak:
+        return speech_to_text_output, doctor_response, None, image_filepath, consultation
+
+    if IN_MEMORY_AUDIO:
+        voice = await run_stage_async("tts", get_doctor_voice_bytes_async(doctor_response))
+        if not voice.ok or not voice.value:
+            print(f"Error generating voice: {voice.error or 'no audio'}")
+            return speech_to_text_output, doctor_response, None, image_filepath, consultation
+        return speech_to_text_output, doctor_response, voice.value, image_filepath, consultation
+
+    audio_output_path = OUTPUT_STORE.new_path("doctor_response")
+    voice = await run_stage_async("tts", get_doctor_voice_for_ui_async(doctor_response, audio_output_path))
+
+    if not voice.ok:
+        print(f"Error generating voice: {voice.error}")
+        return speech_to_text_output, doctor_response, None, image_filepath, consultation
+
+    if os.path.exists(audio_output_path):
+        return speech_to_text_output, doctor_response, audio_output_path, image_filepath, consultation
+    else:
+        print("Warning: Audio file not created")
+        return speech_to_text_output, doctor_response, None, image_filepath, consultation
+
+
+def stream_consultation(audio_filepath, image_filepath, live=None, consultation=None, unchanged=None):
+    """
+    Streaming version of consult.
+
+    The doctor's answer is pushed out while the LLM is still writing it, and
+    every finished sentence is spoken as soon as it is ready.
+
+    Args:
+        unchanged: Yielded in place of the voice while no new sentence is
+            ready (the Gradio handler passes gr.update())
+
+    Yields:
+        tuple: Same fields as consult, the voice is one sentence of audio
+    """
+    # In live mode the audio arrives as streamed chunks, transcribed on the way
+    live_speech = live is not None and live.has_speech()
+    if not audio_filepath and not live_speech:
+        yield "No audio input detected.", "Please record your question for the doctor. I need to hear your symptoms to provide an assessment.", None, None, consultation
+        return
+
+    if not image_filepath:
+        yield "Audio detected, but no image uploaded.", "I need both your audio description and a medical image to provide an accurate diagnosis. Please upload an image for me to analyze.", None, None, consultation
+        return
+
+    oversized = _oversized_image(image_filepath)
+    if oversized is not None:
+        yield "Image too large.", _apology(oversized), None, None, consultation
+        return
+
+    # A question about the same image continues the consultation, the image
+    # was prepared (and sent) with its first question
+    follow_up = consultation is not None and consultation.matches(image_filepath)
+    stages = {"stt": (live.finish,) if live_speech else (transcribe_with_groq, audio_filepath)}
+    if not follow_up:
+        stages["image"] = (prepare_image, image_filepath)
+    prepared = run_stages(stages)
+
+    if prepared["stt"].ok:
+        speech_to_text_output = prepared["stt"].value
+    else:
+        print(f"Error transcribing speech: {prepared['stt'].error}")
+        speech_to_text_output = "Error transcribing your speech. Please try again."
+
+    if not follow_up:
+        consultation = None
+        if prepared["image"].ok:
+            consultation = Consultation(system_prompt, MODEL,
+                                        image_filepath, prepared["image"].value)
+
+    yield speech_to_text_output, "", None, image_filepath, consultation
+
+    if consultation is not None:
+        tokens = consultation.stream(speech_to_text_output)
+    else:
+        print(f"Error generating doctor response: {prepared['image'].error}")
+        tokens = [_apology(prepared["image"].error)]
+
+    # Without a prefix every sentence's audio stays in memory
+    output_prefix = None if IN_MEMORY_AUDIO else OUTPUT_STORE.new_prefix("doctor_response")
+    doctor_response = ""
+    try:
+        for doctor_response, audio_chunk in speak_sentences(tokens, output_prefix):
+            # Only touch the audio player when a new sentence is ready
+            yield speech_to_text_output, doctor_response, audio_chunk or unchanged, image_filepath, consultation
+    except Exception as e:
+        print(f"Error streaming doctor response: {e}")
+        if not doctor_response:
+            doctor_response = _apology(e)
+        yield speech_to_text_output, doctor_response, unchanged, image_filepath, consultation
+
+
+# --- Gradio handlers ---
+# In live mode the audio input holds streamed chunks, not a file, the
+# speech reaches the handlers through the LiveTranscriber instead
+@timed_request("process_input")
+def process_input(audio_filepath, image_filepath, live=None, consultation=None):
+    """consult as a Gradio handler."""
+    if LIVE_TRANSCRIPTION:
+        audio_filepath = None
+    return consult(audio_filepath, image_filepath, live, consultation)
+
+
+@timed_request("process_input_async")
+async def process_input_async(audio_filepath, image_filepath, live=None, consultation=None):
+    """consult_async as a Gradio handler."""
+    if LIVE_TRANSCRIPTION:
+        audio_filepath = None
+    return await consult_async(audio_filepath, image_filepath, live, consultation)
+
+
+@timed_request("process_input_streaming")
+def process_input_streaming(audio_filepath, image_filepath, live=None, consultation=None):
+    """stream_consultation as a Gradio generator, the audio player is only touched for new sentences."""
+    gr = lazy_import("gradio")
+    if LIVE_TRANSCRIPTION:
+        audio_filepath = None
+    yield from stream_consultation(audio_filepath, image_filepath, live, consultation, unchanged=gr.update())
@@ -1,182 +1,156 @@
-#voiceBot UI with Gradio
-import gradio as gr
-import os
-import time
-import shutil
-from pathlib import Path
-
-from brain_of_the_doctor import encode_image, analyze_image_with_query
-from voice_of_the_patient import transcribe_with_groq
-from voice_of_the_doctor import get_doctor_voice_for_ui
-
-# Create a dedicated folder for audio outputs
-OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "audio_outputs")
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-# System prompt for the doctor
-system_prompt ="""You have to act as a professional doctor, i know you are not but this is for learning purpose. 
-            What's in this image?. Do you find anything wrong with it medically? 
-            If you make a differential, suggest some remedies for them. Donot add any numbers or special characters in 
-            your response. Your response should be in one long paragraph. Also always answer as if you are answering to a real person.
-            Donot say 'In the image I see' but say 'With what I see, I think you have ....'
-            Dont respond as an AI model in markdown, your answer should mimic that of an actual doctor not an AI bot, 
-            Keep your answer concise (max 5 sentences). No preamble, start your answer right away please"""
-
-
-
-
-def process_input(audio_filepath, image_filepath):
-    """
-    Process the patient's audio and image inputs and generate a doctor's response
-    
-    Args:
-        audio_filepath: Path to the patient's audio recording
-        image_filepath: Path to the patient's uploaded image
-    """
-    # Create a timestamp for unique filenames
-    timestamp = int(time.time())
-    
-    # Ensure we have valid inputs
-    if not audio_filepath:
-        return "No audio input detected.", "Please record your question for the doctor. I need to hear your symptoms to provide an assessment.", None, None
-
-    if not image_filepath:
-        return "Audio detected, but no image uploaded.", "I need both your audio description and a medical image to provide an accurate diagnosis. Please upload an image for me to analyze.", None, None
-    
-    # Convert patient's speech to text
-    try:
-        speech_to_text_output = transcribe_with_groq(audio_filepath)
-    except Exception as e:
-        print(f"Error transcribing speech: {e}")
-        speech_to_text_output = "Error transcribing your speech. Please try again."
-    
-    # Handle the image input and generate doctor's response
-    try:
-        if image_filepath:
-            doctor_response = analyze_image_with_query(
-                query=system_prompt + speech_to_text_output,
-                encoded_image=encode_image(image_filepath),
-                model="meta-llama/llama-4-scout-17b-16e-instruct"
-            )
-        else:
-            doctor_response = "No image provided for me to analyze. Please upload an image for a proper diagnosis."
-    except Exception as e:
-        print(f"Error generating doctor response: {e}")
-        doctor_response = "I apologize, but I encountered an error while analyzing your image. Please try again."
-    
-    # Generate the doctor's voice response using our deep male voice
-    try:
-        # Create a unique filename for this response
-        audio_output_path = os.path.join(OUTPUT_DIR, f"doctor_response_{timestamp}.mp3")
-        
-        # Generate the voice
-        get_doctor_voice_for_ui(
-            text=doctor_response,
-            output_filepath=audio_output_path
-        )
-        
-        # Check if file was created successfully
-        if os.path.exists(audio_output_path):
-            return speech_to_text_output, doctor_response, audio_output_path, image_filepath
-        else:
-            print("Warning: Audio file not created")
-            return speech_to_text_output, doctor_response, None, image_filepath
-            
-    except Exception as e:
-        print(f"Error generating voice: {e}")
-        return speech_to_text_output, doctor_response, None, image_filepath
-
-
-def show_loading():
-    """Show the loading indicators while processing"""
-    return gr.update(visible=True), gr.update(visible=False)
-
-
-def hide_loading():
-    """Hide the loading indicators after processing"""
-    return gr.update(visible=False), gr.update(visible=True, elem_classes="fade-in")
-
-
-# Create the Gradio interface with the new modern UI
-with gr.Blocks(head='<link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.5.1/css/all.min.css">') as iface:
-    gr.Markdown("# MedMind AI: Virtual Doctor with Eyes and Ears")
-    with gr.Row(elem_classes="main-container"):
-        # Left Panel for Patient Inputs
-        with gr.Column(elem_classes="patient-panel"):
-            gr.HTML("""<div class="panel-header"><i class="fa-solid fa-user-plus"></i>Patient Input</div>
-                       <p class="panel-subheader">Describe your symptoms and upload a medical image.</p>""")
-            
-            with gr.Column(elem_classes="input-group"):
-                gr.Markdown("**1. Describe your symptoms**", elem_classes="label")
-                audio_input = gr.Microphone(
-                    type="filepath",
-                    label="Record Your Symptoms (Click the microphone)",
-                    elem_id="audio_input"
-                )
-            
-            with gr.Column(elem_classes="input-group"):
-                gr.Markdown("**2. Upload a clear medical image**", elem_classes="label")
-                image_input = gr.Image(
-                    type="filepath",
-                    label="Upload image for diagnosis",
-                    elem_classes="image-uploader"
-                )
-
-            submit_btn = gr.Button(
-                "Get Doctor's Diagnosis",
-                elem_classes="submit-button"
-            )
-
-        # Right Panel for Doctor's Consultation
-        with gr.Column(elem_classes="doctor-panel"):
-            with gr.Group(visible=False, elem_classes="loading-overlay") as loading_indicator:
-                gr.HTML("""<div class="loading-spinner"></div>
-                           <p class="loading-text">Consulting with Dr. AI...</p>""")
-
-            with gr.Column(visible=True, elem_classes="results-container") as results_container:
-                gr.HTML("""<div class="panel-header"><i class="fa-solid fa-stethoscope"></i>Doctor's Consultation</div>
-                           <p class="panel-subheader">Review the analysis and listen to the audio consultation.</p>""")
-                
-                with gr.Column(elem_classes="results-content"):
-                    with gr.Group(elem_classes="analyzed-image-container"):
-                        gr.Markdown("**Analyzed Image**")
-                        analyzed_image = gr.Image(label="", elem_classes="analyzed-image")
-                    
-                    with gr.Group(elem_classes="transcribed-text"):
-                        gr.Markdown("**Your Symptoms (Transcribed)**")
-                        speech_output = gr.Textbox(label="", lines=2)
-                    
-                    with gr.Group(elem_classes="doctor-analysis"):
-                        gr.Markdown("**Doctor's Analysis**")
-                        doctor_response = gr.Textbox(label="", lines=8)
-                    
-                    with gr.Group(elem_classes="audio-consultation"):
-                        gr.Markdown("**Audio Consultation**")
-                        voice_output = gr.Audio(label="", autoplay=True)
-
-    # Event handlers for UI interactions
-    submit_btn.click(
-        fn=show_loading,
-        outputs=[loading_indicator, results_container],
-    ).then(
-        fn=process_input,
-        inputs=[audio_input, image_input],
-        outputs=[speech_output, doctor_response, voice_output, analyzed_image],
-    ).then(
-        fn=hide_loading,
-        outputs=[loading_indicator, results_container],
-    )
-
-# Launch the app
-if __name__ == "__main__":
-    try:
-        iface.launch(
-            debug=True,
-            share=False,
-            inbrowser=True,
-            server_name="0.0.0.0",
-            server_port=7860
-        )
-    finally:
-        # Clean up any temporary files on exit
-        print("Cleaning up temporary files...")
\ No newline at end of file
+#voiceBot UI with Gradio
+import os
+import shutil
+from pathlib import Path
+
+from startup import lazy_import, timed, startup_report, warm_up
+
+# This script builds the UI at import, so gradio is needed right away.
+# Groq and the TTS engines are still imported on first use.
+gr = lazy_import("gradio")
+
+# The pipeline itself lives in engine.py, shared with the JSON API (api.py)
+with timed("import doctor modules"):
+    from engine import process_input_async, process_input_streaming, OUTPUT_STORE, LIVE_TRANSCRIPTION
+    import live_transcription
+    from server import SERVE_METRICS, MAX_REQUEST_BYTES, serve
+
+# Stream the doctor's answer and voice sentence by sentence (set STREAMING_MODE=0 to disable)
+STREAMING_MODE = os.getenv("STREAMING_MODE", "1") == "1"
+
+# How many consultations may run at the same time (async handlers share one event loop)
+CONCURRENCY_LIMIT = int(os.getenv("CONCURRENCY_LIMIT", "64"))
+# Consultations Gradio keeps waiting before it turns new ones away.
+# Calls to Groq and Edge-TTS are limited per upstream in scheduler.py.
+QUEUE_MAX_SIZE = int(os.getenv("QUEUE_MAX_SIZE", "256"))
+
+
+def show_loading():
+    """Show the loading indicators while processing"""
+    return gr.update(visible=True), gr.update(visible=False)
+
+
+def hide_loading():
+    """Hide the loading indicators after processing"""
+    return gr.update(visible=False), gr.update(visible=True, elem_classes="fade-in")
+
+
+# Create the Gradio interface with the new modern UI
+with gr.Blocks(head='<link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.5.1/css/all.min.css">') as iface:
+    gr.Markdown("# MedMind AI: Virtual Doctor with Eyes and Ears")
+    with gr.Row(elem_classes="main-container"):
+        # Left Panel for Patient Inputs
+        with gr.Column(elem_classes="patient-panel"):
+            gr.HTML("""<div class="panel-header"><i class="fa-solid fa-user-plus"></i>Patient Input</div>
+                       <p class="panel-subheader">Describe your symptoms and upload a medical image.</p>""")
+            
+            with gr.Column(elem_classes="input-group"):
+                gr.Markdown("**1. Describe your symptoms**", elem_classes="label")
+                audio_input = gr.Microphone(
+                    # Live mode streams chunks while the patient is still speaking
+                    type="numpy" if LIVE_TRANSCRIPTION else "filepath",
+                    streaming=LIVE_TRANSCRIPTION,
+                    label="Record Your Symptoms (Click the microphone)",
+                    elem_id="audio_input"
+                )
+                # The session's LiveTranscriber (live_transcription.py)
+                live_state = gr.State(None)
+            
+            with gr.Column(elem_classes="input-group"):
+                gr.Markdown("**2. Upload a clear medical image**", elem_classes="label")
+                image_input = gr.Image(
+                    type="filepath",
+                    label="Upload image for diagnosis",
+                    elem_classes="image-uploader"
+                )
+                # Follow-up questions about the same image continue this conversation (consultation.py)
+                consultation_state = gr.State(None)
+
+            submit_btn = gr.Button(
+                "Get Doctor's Diagnosis",
+                elem_classes="submit-button"
+            )
+
+        # Right Panel for Doctor's Consultation
+        with gr.Column(elem_classes="doctor-panel"):
+            with gr.Group(visible=False, elem_classes="loading-overlay") as loading_indicator:
+                gr.HTML("""<div class="loading-spinner"></div>
+                           <p class="loading-text">Consulting with Dr. AI...</p>""")
+
+            with gr.Column(visible=True, elem_classes="results-container") as results_container:
+                gr.HTML("""<div class="panel-header"><i class="fa-solid fa-stethoscope"></i>Doctor's Consultation</div>
+                           <p class="panel-subheader">Review the analysis and listen to the audio consultation.</p>""")
+                
+                with gr.Column(elem_classes="results-content"):
+                    with gr.Group(elem_classes="analyzed-image-container"):
+                        gr.Markdown("**Analyzed Image**")
+                        analyzed_image = gr.Image(label="", elem_classes="analyzed-image")
+                    
+                    with gr.Group(elem_classes="transcribed-text"):
+                        gr.Markdown("**Your Symptoms (Transcribed)**")
+                        speech_output = gr.Textbox(label="", lines=2)
+                    
+                    with gr.Group(elem_classes="doctor-analysis"):
+                        gr.Markdown("**Doctor's Analysis**")
+                        doctor_response = gr.Textbox(label="", lines=8)
+                    
+                    with gr.Group(elem_classes="audio-consultation"):
+                        gr.Markdown("**Audio Consultation**")
+                        voice_output = gr.Audio(label="", autoplay=True, streaming=STREAMING_MODE)
+
+    # Event handlers for UI interactions
+    if LIVE_TRANSCRIPTION:
+        # A new recording starts a new transcript. Every session streams its own
+        # microphone, so these don't share Gradio's default single worker.
+        audio_input.start_recording(fn=live_transcription.reset, inputs=live_state, outputs=live_state,
+                                    concurrency_limit=CONCURRENCY_LIMIT)
+        audio_input.clear(fn=live_transcription.reset, inputs=live_state, outputs=live_state,
+                          concurrency_limit=CONCURRENCY_LIMIT)
+        audio_input.stream(
+            fn=live_transcription.stream_chunk,
+            inputs=[audio_input, live_state],
+            outputs=live_state,
+            show_progress="hidden",
+            concurrency_limit=CONCURRENCY_LIMIT,
+        )
+
+    submit_btn.click(
+        fn=show_loading,
+        outputs=[loading_indicator, results_container],
+    ).then(
+        fn=process_input_streaming if STREAMING_MODE else process_input_async,
+        inputs=[audio_input, image_input, live_state, consultation_state],
+        outputs=[speech_output, doctor_response, voice_output, analyzed_image, consultation_state],
+        concurrency_limit=CONCURRENCY_LIMIT,
+    ).then(
+        fn=hide_loading,
+        outputs=[loading_indicator, results_container],
+    )
+
+iface.queue(max_size=QUEUE_MAX_SIZE)
+
+# Launch the app
+if __name__ == "__main__":
+    print(startup_report())
+    # Import the TTS engines and open the Groq pool while the server starts
+    warm_up()
+    try:
+        if SERVE_METRICS:
+            # Gradio mounted next to /metrics (SERVE_METRICS=0 for Gradio's own launcher)
+            serve(iface, server_name="0.0.0.0", server_port=7860, allowed_paths=[OUTPUT_STORE.root])
+        else:
+            iface.launch(
+                debug=True,
+                share=False,
+                inbrowser=True,
+                server_name="0.0.0.0",
+                server_port=7860,
+                # The output store may live outside the working directory (tmpfs backend)
+                allowed_paths=[OUTPUT_STORE.root],
+                # The same upload limit as the mounted server
+                max_file_size=MAX_REQUEST_BYTES,
+            )
+    finally:
+        # Clean up any temporary files on exit
+        print("Cleaning up temporary files...")
+        OUTPUT_STORE.close()
\ No newline at end of file
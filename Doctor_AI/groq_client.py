@@ -0,0 +1,160 @@
+# Shared Groq clients for the whole app
+#
+# brain_of_the_doctor and voice_of_the_patient used to build their own
+# httpx.Client and Groq client. Both now use the clients defined here, so
+# every STT and LLM call goes through one tuned connection pool, and async
+# handlers get an AsyncGroq client on the same settings. The clients are
+# built on first use, see get_client and get_async_client.
+#
+# An async client's connections belong to the event loop they were opened
+# on, so there is one AsyncGroq client per loop: the server's loop gets its
+# own (warmed up when the server starts, see server.py), and code that runs
+# asyncio.run in batch jobs or tests gets a fresh one instead of a client
+# attached to a loop that is gone.
+
+# step1: Setup GROQ API Key
+import os
+import asyncio
+import logging
+import threading
+from dotenv import load_dotenv
+
+from startup import lazy_import, timed
+
+logger = logging.getLogger(__name__)
+
+# Load environment variables from .env file
+# Try different methods to get the API key
+load_dotenv()
+GROQ_API_KEY = os.environ.get("GROQ_API_KEY") or os.environ.get("HF_GROQ_API_KEY")
+
+# If key is still not found and we're in development, try a fallback
+if not GROQ_API_KEY and os.path.exists(".env.local"):
+    with open(".env.local", "r") as f:
+        for line in f:
+            if line.startswith("GROQ_API_KEY="):
+                GROQ_API_KEY = line.split("=", 1)[1].strip().strip('"\'')
+                break
+
+
+# step2: Connection pool settings
+MAX_CONNECTIONS = int(os.getenv("GROQ_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("GROQ_MAX_KEEPALIVE_CONNECTIONS", "20"))
+KEEPALIVE_EXPIRY = float(os.getenv("GROQ_KEEPALIVE_EXPIRY", "60"))
+# Reconnect attempts after a failed connection (not after an error answer)
+HTTP_RETRIES = int(os.getenv("GROQ_HTTP_RETRIES", "1"))
+HTTP2 = os.getenv("GROQ_HTTP2", "0") == "1"
+# 429/503 answers are retried by scheduler.py, which also holds back every
+# queued call for the Retry-After time, so the SDK doesn't retry on its own
+SDK_RETRIES = int(os.getenv("GROQ_SDK_RETRIES", "0"))
+# Seconds to connect, and to wait for the next bytes of an answer. A dead
+# service fails within these instead of the SDK defaults, and the circuit
+# breaker in scheduler.py opens once enough calls failed.
+CONNECT_TIMEOUT = float(os.getenv("GROQ_CONNECT_TIMEOUT", "3"))
+READ_TIMEOUT = float(os.getenv("GROQ_READ_TIMEOUT", "30"))
+WRITE_TIMEOUT = float(os.getenv("GROQ_WRITE_TIMEOUT", "30"))
+# Waiting for a free connection in the pool
+POOL_TIMEOUT = float(os.getenv("GROQ_POOL_TIMEOUT", "10"))
+
+
+# step3: Create the clients on first use
+# Importing groq and httpx and building the pools is deferred so that the
+# app can start serving before any of it is needed.
+_client = None
+_async_clients = {}  # event loop (None outside of one) -> AsyncGroq
+_lock = threading.Lock()
+
+
+def _pool_settings():
+    global HTTP2
+    httpx = lazy_import("httpx")
+    if HTTP2:
+        try:
+            import h2  # noqa: F401  (httpx needs it for HTTP/2)
+        except ImportError:
+            logger.warning("GROQ_HTTP2=1 but the 'h2' package is not installed, using HTTP/1.1.")
+            HTTP2 = False
+
+    limits = httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT, write=WRITE_TIMEOUT, pool=POOL_TIMEOUT)
+    return httpx, limits, timeout
+
+
+def get_client():
+    """Returns the shared synchronous Groq client, building it on first use."""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                httpx, limits, timeout = _pool_settings()
+                groq = lazy_import("groq")
+                with timed("build Groq client"):
+                    # trust_env=False avoids proxy-related errors inside Docker.
+                    http_client = httpx.Client(
+                        transport=httpx.HTTPTransport(retries=HTTP_RETRIES, limits=limits, http2=HTTP2),
+                        timeout=timeout,
+                        trust_env=False,
+                    )
+                    # The SDK sends its own timeout with every request, so it is set here too
+                    _client = groq.Groq(
+                        api_key=GROQ_API_KEY,
+                        http_client=http_client,
+                        max_retries=SDK_RETRIES,
+                        timeout=timeout,
+                    )
+    return _client
+
+
+def _build_async_client():
+    httpx, limits, timeout = _pool_settings()
+    groq = lazy_import("groq")
+    with timed("build AsyncGroq client"):
+        http_client = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(retries=HTTP_RETRIES, limits=limits, http2=HTTP2),
+            timeout=timeout,
+            trust_env=False,
+        )
+        return groq.AsyncGroq(
+            api_key=GROQ_API_KEY,
+            http_client=http_client,
+            max_retries=SDK_RETRIES,
+            timeout=timeout,
+        )
+
+
+def get_async_client():
+    """
+    Returns the AsyncGroq client of the running event loop, building it on
+    first use there. Clients of loops that have been closed are dropped.
+    """
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    client = _async_clients.get(loop)
+    if client is None:
+        with _lock:
+            for closed in [other for other in _async_clients if other is not None and other.is_closed()]:
+                del _async_clients[closed]
+            client = _async_clients.get(loop)
+            if client is None:
+                client = _async_clients[loop] = _build_async_client()
+    return client
+
+
+def warm_up():
+    """Build the sync client and open a keep-alive connection to Groq."""
+    client = get_client()
+    if GROQ_API_KEY:
+        client.models.list()
+
+
+async def warm_up_async():
+    """Build the running loop's AsyncGroq client and open a keep-alive connection."""
+    client = get_async_client()
+    if GROQ_API_KEY:
+        await client.models.list()
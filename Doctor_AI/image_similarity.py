@@ -0,0 +1,172 @@
+# Near-duplicate consultation lookup
+#
+# The same affected area is often uploaded again with a slightly different
+# crop, compression or EXIF, which an exact-bytes cache never matches. Images
+# are reduced to a 64-bit difference hash (dHash) and kept in a BK-tree, so
+# every image within a small Hamming distance can be found without scanning
+# the whole index. A prior answer is reused only when the transcript is
+# similar enough too.
+
+import os
+import time
+import difflib
+import threading
+
+# Reuse thresholds: max differing bits out of 64, min transcript similarity (0..1)
+NEAR_DUPLICATE_MAX_DISTANCE = int(os.getenv("NEAR_DUPLICATE_MAX_DISTANCE", "6"))
+NEAR_DUPLICATE_MIN_TEXT_SIMILARITY = float(os.getenv("NEAR_DUPLICATE_MIN_TEXT_SIMILARITY", "0.9"))
+# Each generation of the index holds this many images, two generations are kept
+NEAR_DUPLICATE_GENERATION_SIZE = int(os.getenv("NEAR_DUPLICATE_GENERATION_SIZE", "1000"))
+
+
+def dhash(image, hash_size=8):
+    """
+    Difference hash of a Pillow image: shrink to (hash_size + 1) x hash_size
+    grayscale and record whether each pixel is brighter than its right neighbour.
+
+    Returns:
+        int: A hash_size * hash_size bit perceptual hash
+    """
+    small = image.convert("L").resize((hash_size + 1, hash_size))
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def text_similarity(a, b):
+    """Similarity of two normalized transcripts between 0 and 1."""
+    if a == b:
+        return 1.0
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+
+class BKTree:
+    """Burkhard-Keller tree over perceptual hashes with Hamming distance."""
+
+    def __init__(self):
+        self._root = None  # [hash, items, {distance: child}]
+        self.size = 0
+
+    def add(self, key, item):
+        self.size += 1
+        if self._root is None:
+            self._root = [key, [item], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming_distance(key, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, [item], {}]
+                return
+            node = child
+
+    def search(self, key, max_distance):
+        """
+        Returns:
+            list: (distance, item) pairs within max_distance of key
+        """
+        results = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(key, node[0])
+            if distance <= max_distance:
+                results.extend((distance, item) for item in node[1])
+            # Triangle inequality: only these children can hold matches
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return results
+
+
+class NearDuplicateIndex:
+    """
+    Recently analyzed consultations, searchable by image similarity.
+
+    BK-trees don't support deletion, so the index keeps two generations and
+    drops the older one when the current one is full, or older than ttl (every
+    entry of the older one has expired by then). Memory stays bounded at
+    2 * generation_size entries.
+
+    Entries expire after ttl seconds, like the answers in the response cache,
+    so a near-duplicate never brings back an answer the cache has dropped.
+    """
+
+    def __init__(self, max_distance=NEAR_DUPLICATE_MAX_DISTANCE,
+                 min_text_similarity=NEAR_DUPLICATE_MIN_TEXT_SIMILARITY,
+                 generation_size=NEAR_DUPLICATE_GENERATION_SIZE, ttl=3600.0):
+        self.max_distance = max_distance
+        self.min_text_similarity = min_text_similarity
+        self.generation_size = generation_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._current = BKTree()
+        self._current_started = time.monotonic()
+        self._previous = BKTree()
+        self._lock = threading.Lock()
+
+    def add(self, image_hash, transcript, context, answer):
+        """
+        Remember an analysis.
+
+        Args:
+            image_hash (int): Perceptual hash of the image
+            transcript (str): Normalized transcript
+            context (tuple): Must match exactly on lookup, e.g. (model, prompt hash)
+            answer (str): The doctor's answer
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._current.size >= self.generation_size or now - self._current_started > self.ttl:
+                self._previous, self._current = self._current, BKTree()
+                self._current_started = now
+            self._current.add(image_hash, (transcript, context, answer, now + self.ttl))
+
+    def find(self, image_hash, transcript, context):
+        """
+        Returns:
+            str: The answer of the closest matching consultation, or None
+        """
+        with self._lock:
+            candidates = self._current.search(image_hash, self.max_distance)
+            candidates += self._previous.search(image_hash, self.max_distance)
+
+        now = time.monotonic()
+        best, best_score = None, None
+        for distance, (known_transcript, known_context, answer, expires) in candidates:
+            if known_context != context or expires <= now:
+                continue
+            similarity = text_similarity(transcript, known_transcript)
+            if similarity < self.min_text_similarity:
+                continue
+            score = (distance, -similarity)
+            if best_score is None or score < best_score:
+                best, best_score = answer, score
+
+        with self._lock:
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return best
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": self._current.size + self._previous.size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,282 @@
+# Live transcription while the patient is still speaking
+#
+# With LIVE_TRANSCRIPTION=1 the microphone streams small chunks to the server
+# instead of delivering one file after the recording stops. LiveTranscriber
+# buffers the chunks, cuts them into utterances with an energy based voice
+# activity detector and sends every finished utterance to transcribe_with_groq
+# in the background. By the time the patient clicks submit most of the speech
+# is already transcribed, only the last utterance is still pending.
+#
+# The detector is deliberately simple: 30 ms frames, RMS energy against an
+# adaptive noise floor, a short pre-roll so word onsets aren't clipped, and a
+# segment ends after VAD_MIN_SILENCE seconds of silence (or is cut at
+# VAD_MAX_SEGMENT_SECONDS so one long monologue doesn't stay pending).
+#
+# The noise floor starts low (VAD_ENERGY_THRESHOLD / VAD_NOISE_RATIO), so a
+# patient who talks from the first frame is still heard. It follows silent
+# frames, and rises above that only when the quietest frame of the last
+# VAD_NOISE_WINDOW seconds is louder (a noisy room: speech has pauses, steady
+# noise has none), by at most VAD_NOISE_MAX_RISE per frame.
+#
+# A segment whose transcription fails is retried once. If it fails again the
+# transcript is made of the other segments, the error is only returned when
+# no segment could be transcribed.
+
+import os
+import uuid
+import wave
+import logging
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import scheduler
+from startup import lazy_import
+from voice_of_the_patient import transcribe_with_groq
+
+logger = logging.getLogger(__name__)
+
+VAD_FRAME_SECONDS = 0.03
+# Frames quieter than this RMS (full scale = 1.0) are always silence
+VAD_ENERGY_THRESHOLD = float(os.getenv("VAD_ENERGY_THRESHOLD", "0.01"))
+# A frame is speech when it is this many times louder than the noise floor
+VAD_NOISE_RATIO = float(os.getenv("VAD_NOISE_RATIO", "3"))
+VAD_NOISE_WINDOW = float(os.getenv("VAD_NOISE_WINDOW", "2"))
+VAD_NOISE_MAX_RISE = 1.05
+VAD_PRE_ROLL = 0.3
+VAD_MIN_SILENCE = float(os.getenv("VAD_MIN_SILENCE", "0.6"))
+# Utterances with less speech than this are noise (a cough, a click) and are dropped
+VAD_MIN_SPEECH = float(os.getenv("VAD_MIN_SPEECH", "0.25"))
+VAD_MAX_SEGMENT_SECONDS = float(os.getenv("VAD_MAX_SEGMENT_SECONDS", "20"))
+
+# Utterances transcribed at the same time across all sessions. The calls
+# still queue per upstream in scheduler.py.
+LIVE_TRANSCRIPTION_WORKERS = int(os.getenv("LIVE_TRANSCRIPTION_WORKERS", "8"))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=LIVE_TRANSCRIPTION_WORKERS,
+                                               thread_name_prefix="live-stt")
+    return _executor
+
+
+def _to_mono_float(samples):
+    """Gradio hands over int16 (or float) samples, mono or (n, channels)."""
+    np = lazy_import("numpy")
+    samples = np.asarray(samples)
+    if samples.ndim > 1:
+        samples = samples.mean(axis=1)
+    if samples.dtype.kind == "i":
+        return samples.astype(np.float32) / float(np.iinfo(samples.dtype).max)
+    if samples.dtype.kind == "u":
+        info = np.iinfo(samples.dtype)
+        middle = (info.max + 1) / 2.0
+        return (samples.astype(np.float32) - middle) / middle
+    return samples.astype(np.float32)
+
+
+def _write_wav(path, sample_rate, samples):
+    np = lazy_import("numpy")
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype("<i2")
+    with wave.open(path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm.tobytes())
+
+
+def _transcribe_segment(session_key, sample_rate, samples):
+    handle, path = tempfile.mkstemp(prefix="live_segment_", suffix=".wav")
+    os.close(handle)
+    try:
+        _write_wav(path, sample_rate, samples)
+        # Queued in the scheduler under the consultation it belongs to
+        with scheduler.session(session_key):
+            return transcribe_with_groq(path)
+    finally:
+        os.remove(path)
+
+
+def _segment_text(future):
+    """The segment's transcript, or an "ERROR: ..." message like transcribe_with_groq."""
+    try:
+        return future.result()
+    except Exception as e:
+        return f"ERROR: An error occurred during transcription: {e}"
+
+
+class LiveTranscriber:
+    """
+    Segments one streamed recording into utterances and transcribes each
+    finished utterance in the background. Kept in a gr.State per browser session.
+    """
+
+    def __init__(self, session_key=None):
+        self.session_key = session_key or f"live-{uuid.uuid4().hex[:12]}"
+        self.sample_rate = None
+        self._lock = threading.Lock()
+        self._pending = None        # samples not yet filling a whole frame
+        self._pre_roll = deque()    # recent silent frames, prepended to the next utterance
+        self._segment = []          # frames of the utterance being recorded
+        self._segment_speech = 0    # speech frames in it
+        self._silence = 0           # silent frames since the last speech frame
+        self._noise_floor = VAD_ENERGY_THRESHOLD / VAD_NOISE_RATIO
+        self._recent_energy = deque(maxlen=self._frames(VAD_NOISE_WINDOW))
+        self._futures = []          # (future, samples) per utterance, samples for a retry
+        self._result = None
+        self._closed = False
+
+    # --- Segmentation ---
+    def add_chunk(self, sample_rate, samples):
+        """Feed one streamed chunk, utterances it completes start transcribing right away."""
+        np = lazy_import("numpy")
+        with self._lock:
+            if self._closed:
+                return
+            if self.sample_rate is None:
+                self.sample_rate = int(sample_rate)
+            elif int(sample_rate) != self.sample_rate:
+                logger.warning(f"Ignoring chunk at {sample_rate} Hz in a {self.sample_rate} Hz recording")
+                return
+
+            samples = _to_mono_float(samples)
+            if self._pending is not None:
+                samples = np.concatenate((self._pending, samples))
+            frame_length = max(1, int(self.sample_rate * VAD_FRAME_SECONDS))
+            whole = len(samples) - len(samples) % frame_length
+            self._pending = samples[whole:]
+            for start in range(0, whole, frame_length):
+                self._add_frame(samples[start:start + frame_length])
+
+    def _frames(self, seconds):
+        return max(1, int(round(seconds / VAD_FRAME_SECONDS)))
+
+    def _is_speech(self, frame):
+        np = lazy_import("numpy")
+        energy = float(np.sqrt(np.mean(np.square(frame))))
+        self._recent_energy.append(energy)
+        threshold = max(VAD_ENERGY_THRESHOLD, VAD_NOISE_RATIO * self._noise_floor)
+        speech = energy > threshold
+        # Follow silent frames, while speaking only a window without a pause
+        # (steady noise) can pull the floor up
+        target = min(self._recent_energy) if speech else energy
+        floor = 0.95 * self._noise_floor + 0.05 * target
+        self._noise_floor = min(floor, self._noise_floor * VAD_NOISE_MAX_RISE)
+        return speech
+
+    def _add_frame(self, frame):
+        speech = self._is_speech(frame)
+        if not self._segment:
+            if not speech:
+                self._pre_roll.append(frame)
+                while len(self._pre_roll) > self._frames(VAD_PRE_ROLL):
+                    self._pre_roll.popleft()
+                return
+            self._segment = list(self._pre_roll)
+            self._pre_roll.clear()
+
+        self._segment.append(frame)
+        if speech:
+            self._segment_speech += 1
+            self._silence = 0
+        else:
+            self._silence += 1
+
+        if self._silence >= self._frames(VAD_MIN_SILENCE):
+            self._end_segment()
+        elif len(self._segment) >= self._frames(VAD_MAX_SEGMENT_SECONDS):
+            self._end_segment()
+
+    def _end_segment(self):
+        np = lazy_import("numpy")
+        frames, speech = self._segment, self._segment_speech
+        self._segment, self._segment_speech, self._silence = [], 0, 0
+        if speech < self._frames(VAD_MIN_SPEECH):
+            return
+        samples = np.concatenate(frames)
+        future = _get_executor().submit(_transcribe_segment, self.session_key, self.sample_rate, samples)
+        self._futures.append((future, samples))
+
+    # --- Results ---
+    def has_speech(self):
+        """True once an utterance has been detected in the recording."""
+        with self._lock:
+            return bool(self._futures) or self._segment_speech >= self._frames(VAD_MIN_SPEECH)
+
+    def finish(self):
+        """
+        Flush the last utterance and wait for every transcription, in order.
+        Calling it again returns the same result.
+
+        Returns:
+            str: The whole transcript, or an "ERROR: ..." message like transcribe_with_groq
+        """
+        with self._lock:
+            if self._result is not None:
+                return self._result
+            if not self._closed:
+                self._closed = True
+                if self._pending is not None and len(self._pending):
+                    self._segment.append(self._pending)
+                    self._pending = None
+                if self._segment:
+                    self._end_segment()
+            futures = list(self._futures)
+
+        texts, errors = [], []
+        for future, samples in futures:
+            text = _segment_text(future)
+            if text.startswith("ERROR"):
+                logger.warning(f"Retrying a live segment: {text}")
+                text = _segment_text(
+                    _get_executor().submit(_transcribe_segment, self.session_key, self.sample_rate, samples)
+                )
+            if text.startswith("ERROR"):
+                errors.append(text)
+            elif text.strip():
+                texts.append(text.strip())
+
+        if errors and texts:
+            logger.warning(f"{len(errors)} of {len(futures)} live segments could not be transcribed")
+        with self._lock:
+            self._result = " ".join(texts) if texts or not errors else errors[0]
+            return self._result
+
+    def close(self):
+        """Drop the recording, utterances not started yet are not transcribed."""
+        with self._lock:
+            self._closed = True
+            for future, _ in self._futures:
+                future.cancel()
+            # Nothing will be retried, let go of the audio
+            self._futures = []
+
+
+# --- Gradio event handlers ---
+def stream_chunk(chunk, live):
+    """
+    Audio .stream() handler: feed the chunk to the session's transcriber,
+    creating it on the first chunk of a recording.
+    """
+    if chunk is None:
+        return live
+    if live is None:
+        live = LiveTranscriber()
+    sample_rate, samples = chunk
+    live.add_chunk(sample_rate, samples)
+    return live
+
+
+def reset(live):
+    """Start a new recording (and forget the previous one)."""
+    if live is not None:
+        live.close()
+    return None
@@ -0,0 +1,195 @@
+# Local text-to-speech engine
+#
+# Speech is synthesized on this machine instead of by a third-party service,
+# so latency is predictable and the whole pipeline runs offline. Piper (an
+# ONNX voice on the CPU) is used when piper-tts is installed and PIPER_VOICE
+# points at a voice model, espeak-ng otherwise. Synthesis is CPU bound, so it
+# runs in a pool of worker processes where it can't block the TTS event loop
+# or hold the GIL. Each worker loads the Piper voice once and keeps it.
+#
+# voice_of_the_doctor registers this as the "local" engine, see TTS_ENGINES.
+#
+# This module is imported by the worker processes, keep its imports light.
+
+import os
+import sys
+import wave
+import types
+import shutil
+import tempfile
+import asyncio
+import logging
+import threading
+import subprocess
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Path to a Piper .onnx voice (its .onnx.json config must sit next to it)
+PIPER_VOICE = os.getenv("PIPER_VOICE")
+ESPEAK = shutil.which("espeak-ng") or shutil.which("espeak")
+ESPEAK_VOICE = os.getenv("ESPEAK_VOICE", "en-us+m3")
+ESPEAK_SPEED = int(os.getenv("ESPEAK_SPEED", "160"))
+FFMPEG = shutil.which("ffmpeg")
+# Worker processes, each one synthesizes one phrase at a time
+LOCAL_TTS_WORKERS = int(os.getenv("LOCAL_TTS_WORKERS", "2"))
+SYNTHESIS_TIMEOUT = 60
+
+_voice = None  # the Piper voice of this worker process
+
+
+def _init_worker(voice_path):
+    global _voice
+    if voice_path and importlib.util.find_spec("piper") is not None:
+        from piper import PiperVoice
+        _voice = PiperVoice.load(voice_path)
+
+
+def _write_wav(text, wav_path):
+    if _voice is not None:
+        with wave.open(wav_path, "wb") as wav_file:
+            # piper-tts renamed synthesize to synthesize_wav in 1.3
+            synthesize = getattr(_voice, "synthesize_wav", None) or _voice.synthesize
+            synthesize(text, wav_file)
+    elif ESPEAK:
+        subprocess.run(
+            [ESPEAK, "-v", ESPEAK_VOICE, "-s", str(ESPEAK_SPEED), "-w", wav_path, text],
+            capture_output=True, timeout=SYNTHESIS_TIMEOUT, check=True,
+        )
+    else:
+        raise RuntimeError("No local TTS engine: install piper-tts and set PIPER_VOICE, or install espeak-ng.")
+
+
+def synthesize(text, output_filepath):
+    """
+    Synthesize text to output_filepath. Runs inside a worker process.
+    The WAV is encoded to MP3 with ffmpeg unless the output is a .wav file.
+
+    Returns:
+        str: output_filepath
+    """
+    if output_filepath.lower().endswith(".wav"):
+        _write_wav(text, output_filepath)
+        return output_filepath
+
+    wav_path = output_filepath + ".wav"
+    try:
+        _write_wav(text, wav_path)
+        if FFMPEG:
+            subprocess.run(
+                [FFMPEG, "-nostdin", "-hide_banner", "-loglevel", "error", "-y", "-i", wav_path,
+                 "-codec:a", "libmp3lame", "-q:a", "4", "-f", "mp3", output_filepath],
+                capture_output=True, timeout=SYNTHESIS_TIMEOUT, check=True,
+            )
+        else:
+            # Browsers sniff the content, a WAV under an .mp3 name still plays
+            os.replace(wav_path, output_filepath)
+    finally:
+        if os.path.exists(wav_path):
+            os.remove(wav_path)
+    return output_filepath
+
+
+def synthesize_bytes(text):
+    """
+    Synthesize text and return the MP3 bytes. Runs inside a worker process,
+    the temporary file never leaves it.
+    """
+    handle, path = tempfile.mkstemp(suffix=".mp3")
+    os.close(handle)
+    try:
+        synthesize(text, path)
+        with open(path, "rb") as audio_file:
+            return audio_file.read()
+    finally:
+        os.remove(path)
+
+
+def available():
+    """True when Piper (with a voice) or espeak-ng can be used."""
+    piper = bool(PIPER_VOICE) and importlib.util.find_spec("piper") is not None
+    return piper or ESPEAK is not None
+
+
+def _ready():
+    return True
+
+
+_pool = None
+_lock = threading.Lock()
+
+
+def get_pool():
+    """The worker pool, started on first use."""
+    global _pool
+    if _pool is None:
+        with _lock:
+            if _pool is None:
+                # spawn, not fork: the parent has running threads (TTS loop, server)
+                pool = ProcessPoolExecutor(
+                    max_workers=LOCAL_TTS_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(PIPER_VOICE,),
+                )
+                _start_workers(pool)
+                _pool = pool
+    return _pool
+
+
+def _start_workers(pool):
+    # A spawned worker runs the parent's __main__ again. Under app.py or
+    # gradio_app.py that imports Gradio and engine (and its reaper thread), so
+    # the workers are started while __main__ is an empty module.
+    main = sys.modules["__main__"]
+    sys.modules["__main__"] = types.ModuleType("__main__")
+    try:
+        # One submit per worker, each starts a process when none is idle
+        for _ in range(LOCAL_TTS_WORKERS):
+            pool.submit(_ready)
+    finally:
+        sys.modules["__main__"] = main
+
+
+def submit(text, output_filepath):
+    """
+    Returns:
+        concurrent.futures.Future: Resolves to output_filepath once the worker is done
+    """
+    if not available():
+        raise RuntimeError("No local TTS engine: install piper-tts and set PIPER_VOICE, or install espeak-ng.")
+    return get_pool().submit(synthesize, text, output_filepath)
+
+
+def submit_bytes(text):
+    """
+    Returns:
+        concurrent.futures.Future: Resolves to the MP3 bytes
+    """
+    if not available():
+        raise RuntimeError("No local TTS engine: install piper-tts and set PIPER_VOICE, or install espeak-ng.")
+    return get_pool().submit(synthesize_bytes, text)
+
+
+async def synthesize_async(text, output_filepath):
+    """Synthesize in the worker pool without blocking the event loop."""
+    return await asyncio.wrap_future(submit(text, output_filepath))
+
+
+def warm_up():
+    """Start the worker processes (and load the Piper voice) ahead of the first phrase."""
+    if available():
+        pool = get_pool()
+        for future in [pool.submit(_ready) for _ in range(LOCAL_TTS_WORKERS)]:
+            future.result()
+
+
+if __name__ == "__main__":
+    # The workers don't see this script as __main__, submit the importable module's functions
+    import local_tts
+
+    print(f"Piper voice: {PIPER_VOICE or 'not set'}, espeak-ng: {ESPEAK or 'not found'}")
+    output_path = local_tts.submit("Hello, I am your doctor. How are you feeling today?", "local_tts_test.mp3").result()
+    print(f"Generated {output_path}")
@@ -0,0 +1,263 @@
+# Per-stage latency metrics for the consultation pipeline
+#
+# Stage durations are kept as Prometheus-style histograms, byte counts and
+# outcomes as counters, and render() produces the text exposition format for
+# the /metrics endpoint (see server.py). Each request also writes one
+# structured JSON log line with the timing of every stage it went through.
+
+import json
+import time
+import uuid
+import logging
+import functools
+import threading
+import contextvars
+import inspect
+
+logger = logging.getLogger("doctor.timing")
+
+# Seconds, from cache hits to slow LLM calls
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_format_labels(key + (('le', bound),))} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {series[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series[-1]}")
+        return lines
+
+
+class Gauge:
+    """A metric whose current values are read from collect() at render time."""
+
+    def __init__(self, name, help_text, collect):
+        self.name = name
+        self.help_text = help_text
+        self.collect = collect  # () -> {labels tuple: value}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        for key, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+STAGE_DURATION = Histogram("doctor_stage_duration_seconds", "Duration of each pipeline stage.")
+STAGE_OUTCOMES = Counter("doctor_stage_total", "Pipeline stage runs by outcome.")
+STAGE_BYTES = Counter("doctor_stage_bytes_total", "Bytes handled by each pipeline stage.")
+REQUEST_DURATION = Histogram("doctor_request_duration_seconds", "End-to-end duration of a consultation.")
+
+_registry = [STAGE_DURATION, STAGE_OUTCOMES, STAGE_BYTES, REQUEST_DURATION]
+
+
+def register(metric):
+    """Add another Counter or Histogram to the /metrics output."""
+    _registry.append(metric)
+    return metric
+
+
+def render():
+    """
+    Returns:
+        str: Every metric in the Prometheus text exposition format
+    """
+    lines = []
+    for metric in list(_registry):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Per-request timing ---
+_current_request = contextvars.ContextVar("doctor_request_timing", default=None)
+
+
+def current_request_id():
+    """The id of the request being handled in this context, or None."""
+    request = _current_request.get()
+    return request["request_id"] if request is not None else None
+
+
+def record_stage(stage, seconds, ok=True):
+    """Record one stage run in the histograms and in the current request's log."""
+    outcome = "ok" if ok else "error"
+    STAGE_DURATION.observe(seconds, stage=stage)
+    STAGE_OUTCOMES.inc(stage=stage, outcome=outcome)
+    request = _current_request.get()
+    if request is not None:
+        request["stages"][stage] = {"seconds": round(seconds, 4), "outcome": outcome}
+
+
+def record_bytes(stage, direction, size):
+    """Count bytes going into ("in") or out of ("out") a stage."""
+    STAGE_BYTES.inc(size, stage=stage, direction=direction)
+    request = _current_request.get()
+    if request is not None:
+        request["bytes"][f"{stage}_{direction}"] = request["bytes"].get(f"{stage}_{direction}", 0) + size
+
+
+class stage:
+    """Context manager that times a block as a pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record_stage(self.name, time.perf_counter() - self.start, ok=exc_type is None)
+        return False
+
+
+def _start_request(handler):
+    request = {"event": "consultation", "handler": handler, "request_id": uuid.uuid4().hex,
+               "stages": {}, "bytes": {}}
+    return request, time.perf_counter()
+
+
+def _finish_request(request, start, error=None):
+    total = time.perf_counter() - start
+    request["total_seconds"] = round(total, 4)
+    request["outcome"] = "error" if error else "ok"
+    REQUEST_DURATION.observe(total, handler=request["handler"])
+    logger.info(json.dumps(request))
+
+
+class request_scope:
+    """
+    Context manager version of timed_request for callers that need the
+    collected timings themselves. Yields the request record (stages, bytes,
+    and total_seconds once the block has ended).
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def __enter__(self):
+        self.request, self._start = _start_request(self.handler)
+        self._token = _current_request.set(self.request)
+        return self.request
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_request.reset(self._token)
+        _finish_request(self.request, self._start, exc)
+        return False
+
+
+def timed_request(handler):
+    """
+    Decorator for request handlers (plain, async or generator functions).
+    Collects the stage timings of one request and logs them as JSON when it ends.
+    """
+    def decorate(fn):
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def generator_wrapper(*args, **kwargs):
+                request, start = _start_request(handler)
+                generator = fn(*args, **kwargs)
+                error = None
+                try:
+                    while True:
+                        # Gradio may resume the generator on another thread
+                        token = _current_request.set(request)
+                        try:
+                            value = next(generator)
+                        except StopIteration:
+                            return
+                        finally:
+                            _current_request.reset(token)
+                        yield value
+                except BaseException as e:
+                    error = e
+                    raise
+                finally:
+                    generator.close()
+                    _finish_request(request, start, error)
+            return generator_wrapper
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                request, start = _start_request(handler)
+                token = _current_request.set(request)
+                error = None
+                try:
+                    return await fn(*args, **kwargs)
+                except BaseException as e:
+                    error = e
+                    raise
+                finally:
+                    _current_request.reset(token)
+                    _finish_request(request, start, error)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            request, start = _start_request(handler)
+            token = _current_request.set(request)
+            error = None
+            try:
+                return fn(*args, **kwargs)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                _current_request.reset(token)
+                _finish_request(request, start, error)
+        return wrapper
+
+    return decorate
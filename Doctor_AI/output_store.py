@@ -0,0 +1,134 @@
+# Managed store for generated audio files
+#
+# Every response gets a collision-free file name, and a background reaper
+# deletes files that are older than a maximum age or that push the store over
+# its total size quota (oldest first). Short-lived files can be kept on tmpfs
+# (/dev/shm) instead of the app's disk. Only files with the store's own
+# names are reaped, anything else in the folder (e.g. the sample responses
+# in audio_outputs/) is left alone.
+
+import os
+import re
+import time
+import uuid
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Defaults, overridable with environment variables
+OUTPUT_BACKEND = os.getenv("OUTPUT_BACKEND", "disk")  # disk or tmpfs
+OUTPUT_MAX_AGE = float(os.getenv("OUTPUT_MAX_AGE", "3600"))  # seconds
+OUTPUT_MAX_BYTES = int(os.getenv("OUTPUT_MAX_BYTES", str(500 * 1024 * 1024)))
+OUTPUT_REAP_INTERVAL = float(os.getenv("OUTPUT_REAP_INTERVAL", "60"))  # seconds
+
+# The stamp and random part new_prefix puts in every name
+OWN_NAME = re.compile(r"_\d{8}-\d{6}_[0-9a-f]{12}(?:[_.]|$)")
+
+
+def _tmpfs_root():
+    # /dev/shm is memory-backed on Linux, fall back to the system temp folder
+    base = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+    return os.path.join(base, "doctor_ai_outputs")
+
+
+class OutputStore:
+    """Folder of generated files with unique names, retention and a size quota."""
+
+    def __init__(self, root, backend=OUTPUT_BACKEND, max_age=OUTPUT_MAX_AGE,
+                 max_bytes=OUTPUT_MAX_BYTES, reap_interval=OUTPUT_REAP_INTERVAL):
+        self.backend = backend
+        self.root = _tmpfs_root() if backend == "tmpfs" else root
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.reap_interval = reap_interval
+        self._stop = threading.Event()
+        self._reaper = None
+        os.makedirs(self.root, exist_ok=True)
+
+    def new_prefix(self, prefix="doctor_response"):
+        """A unique path prefix, for callers that write several numbered files."""
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        return os.path.join(self.root, f"{prefix}_{stamp}_{uuid.uuid4().hex[:12]}")
+
+    def new_path(self, prefix="doctor_response", suffix=".mp3"):
+        """A unique file path, two requests in the same second never collide."""
+        return self.new_prefix(prefix) + suffix
+
+    def _files(self):
+        """(mtime, size, path) of the files this store created."""
+        files = []
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if not OWN_NAME.search(entry.name):
+                    continue
+                try:
+                    if entry.is_file(follow_symlinks=False):
+                        stat = entry.stat(follow_symlinks=False)
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+                except OSError:
+                    continue
+        return files
+
+    def reap(self):
+        """
+        Delete expired files, then the oldest files until the store fits its quota.
+
+        Returns:
+            tuple: (files removed, bytes freed)
+        """
+        now = time.time()
+        removed, freed = 0, 0
+        kept = []
+        total = 0
+        for mtime, size, path in sorted(self._files()):
+            if now - mtime > self.max_age:
+                if self._remove(path):
+                    removed, freed = removed + 1, freed + size
+                continue
+            kept.append((size, path))
+            total += size
+
+        # Oldest first until we are under the quota
+        for size, path in kept:
+            if total <= self.max_bytes:
+                break
+            if self._remove(path):
+                removed, freed = removed + 1, freed + size
+                total -= size
+
+        if removed:
+            logger.info(f"Output store: removed {removed} files ({freed} bytes) from {self.root}")
+        return removed, freed
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def _reap_forever(self):
+        while not self._stop.wait(self.reap_interval):
+            try:
+                self.reap()
+            except Exception as e:
+                logger.error(f"Output store reaper failed: {e}")
+
+    def start_reaper(self):
+        """Start the background reaper thread (once)."""
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap_forever, name="output-reaper", daemon=True)
+            self._reaper.start()
+        return self
+
+    def close(self):
+        """Stop the reaper and clean up. tmpfs files are short-lived, so they are all removed."""
+        self._stop.set()
+        if self.backend == "tmpfs":
+            for _, _, path in self._files():
+                self._remove(path)
+        else:
+            self.reap()
@@ -0,0 +1,205 @@
+# Concurrent stage executor for the consultation pipeline
+#
+# process_input is made of stages (speech-to-text, image encoding, LLM, TTS).
+# Stages that don't depend on each other are submitted together so they
+# overlap, and every stage is waited on with its own timeout. Errors and
+# timeouts come back as StageResult objects instead of being raised, so the
+# caller can decide what to show the patient for each stage in one place.
+#
+# A stage's timeout counts from when a worker starts it, not from when it was
+# submitted. Python threads can't be stopped: a stage that times out keeps
+# running in its worker until it returns, the caller just stops waiting for
+# it. Every stage name has its own pool, so piled-up STT calls can't take the
+# workers the image, LLM or TTS stages of the next requests need.
+
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Per-stage timeouts in seconds (override with environment variables)
+STAGE_TIMEOUTS = {
+    "stt": float(os.getenv("STT_TIMEOUT", "60")),
+    "image": float(os.getenv("IMAGE_TIMEOUT", "15")),
+    "llm": float(os.getenv("LLM_TIMEOUT", "90")),
+    "tts": float(os.getenv("TTS_TIMEOUT", "60")),
+}
+DEFAULT_TIMEOUT = 60.0
+
+# Workers per stage, enough for every consultation the UI admits at once
+# (CONCURRENCY_LIMIT) to run the stage together
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", os.getenv("CONCURRENCY_LIMIT", "64")))
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def _executor(name):
+    """The pool of stage name, started on first use."""
+    with _executors_lock:
+        if name not in _executors:
+            _executors[name] = ThreadPoolExecutor(
+                max_workers=PIPELINE_WORKERS,
+                thread_name_prefix=f"pipeline-{name}",
+            )
+        return _executors[name]
+
+
+class StageResult:
+    """Outcome of a single pipeline stage."""
+
+    def __init__(self, name, value=None, error=None, elapsed=0.0):
+        self.name = name
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        status = "ok" if self.ok else f"error={self.error!r}"
+        return f"StageResult({self.name}, {status}, {self.elapsed:.3f}s)"
+
+
+class _StageStart:
+    """Set by the worker when a stage starts, its deadline counts from there."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.at = None
+
+    def mark(self):
+        self.at = time.perf_counter()
+        self.event.set()
+
+
+def _timed(start, fn, args):
+    start.mark()
+    value = fn(*args)
+    return value, time.perf_counter() - start.at
+
+
+def run_stages(stages, timeouts=None):
+    """
+    Run independent pipeline stages concurrently.
+
+    Args:
+        stages (dict): Maps a stage name to a (function, *args) tuple
+        timeouts (dict): Optional per-stage timeouts in seconds, on top of STAGE_TIMEOUTS
+
+    Returns:
+        dict: Maps each stage name to its StageResult
+    """
+    timeouts = {**STAGE_TIMEOUTS, **(timeouts or {})}
+    started = time.perf_counter()
+    futures = {}
+    for name, spec in stages.items():
+        start = _StageStart()
+        # Copy the context so stages can add to the caller's request timing log
+        futures[name] = start, _executor(name).submit(
+            contextvars.copy_context().run, _timed, start, spec[0], spec[1:]
+        )
+
+    results = {}
+    for name, (start, future) in futures.items():
+        timeout = timeouts.get(name, DEFAULT_TIMEOUT)
+        # Waiting for a free worker is bounded by the timeout as well
+        queued = max(0.0, timeout - (time.perf_counter() - started))
+        if not start.event.wait(queued) and future.cancel():
+            error = TimeoutError(f"Stage '{name}' found no free worker in {timeout:.0f}s")
+            results[name] = StageResult(name, error=error, elapsed=time.perf_counter() - started)
+        else:
+            start.event.wait()
+            remaining = max(0.0, timeout - (time.perf_counter() - start.at))
+            try:
+                value, elapsed = future.result(timeout=remaining)
+                results[name] = StageResult(name, value=value, elapsed=elapsed)
+            except FutureTimeoutError:
+                # The stage keeps running in its worker, only the wait is over
+                error = TimeoutError(f"Stage '{name}' timed out after {timeout:.0f}s")
+                results[name] = StageResult(name, error=error, elapsed=time.perf_counter() - start.at)
+            except Exception as e:
+                results[name] = StageResult(name, error=e, elapsed=time.perf_counter() - start.at)
+
+        metrics.record_stage(name, results[name].elapsed, results[name].ok)
+        if not results[name].ok:
+            logger.error(f"Pipeline stage '{name}' failed: {results[name].error}")
+
+    return results
+
+
+def run_stage(name, fn, *args, timeout=None):
+    """
+    Run a single stage with its timeout.
+
+    Returns:
+        StageResult: The outcome of the stage
+    """
+    return run_stages({name: (fn, *args)}, {name: timeout} if timeout else None)[name]
+
+
+async def _timed_async(awaitable):
+    start = time.perf_counter()
+    value = await awaitable
+    return value, time.perf_counter() - start
+
+
+async def run_stages_async(stages, timeouts=None):
+    """
+    Async counterpart of run_stages for handlers running on an event loop.
+    A stage that runs out of time is cancelled.
+
+    Args:
+        stages (dict): Maps a stage name to an awaitable
+        timeouts (dict): Optional per-stage timeouts in seconds, on top of STAGE_TIMEOUTS
+
+    Returns:
+        dict: Maps each stage name to its StageResult
+    """
+    timeouts = {**STAGE_TIMEOUTS, **(timeouts or {})}
+    names = list(stages)
+    started = time.perf_counter()
+    outcomes = await asyncio.gather(
+        *(asyncio.wait_for(_timed_async(stages[name]), timeouts.get(name, DEFAULT_TIMEOUT)) for name in names),
+        return_exceptions=True,
+    )
+
+    results = {}
+    for name, outcome in zip(names, outcomes):
+        if isinstance(outcome, asyncio.TimeoutError):
+            timeout = timeouts.get(name, DEFAULT_TIMEOUT)
+            error = TimeoutError(f"Stage '{name}' timed out after {timeout:.0f}s")
+            results[name] = StageResult(name, error=error, elapsed=time.perf_counter() - started)
+        elif isinstance(outcome, BaseException):
+            if isinstance(outcome, asyncio.CancelledError):
+                raise outcome
+            results[name] = StageResult(name, error=outcome, elapsed=time.perf_counter() - started)
+        else:
+            value, elapsed = outcome
+            results[name] = StageResult(name, value=value, elapsed=elapsed)
+
+        metrics.record_stage(name, results[name].elapsed, results[name].ok)
+        if not results[name].ok:
+            logger.error(f"Pipeline stage '{name}' failed: {results[name].error}")
+
+    return results
+
+
+async def run_stage_async(name, awaitable, timeout=None):
+    """
+    Await a single stage with its timeout.
+
+    Returns:
+        StageResult: The outcome of the stage
+    """
+    results = await run_stages_async({name: awaitable}, {name: timeout} if timeout else None)
+    return results[name]
@@ -0,0 +1,159 @@
+# In-memory result cache with TTL, LRU eviction and request coalescing
+#
+# get_or_compute makes sure that concurrent callers asking for the same key
+# share one computation: the first caller runs it, everyone else waits for
+# its result. Failures are handed to every waiter but never cached. When the
+# first caller is cancelled or interrupted, the computation is abandoned and
+# one of the waiters runs it again; the cancellation stays with its caller.
+
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class _Abandoned(Exception):
+    """The caller running the computation was cancelled, waiters claim the key again."""
+
+
+class ResultCache:
+    """Bounded LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, max_entries=512, ttl=3600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value), oldest first
+        self._in_flight = {}  # key -> Future of the running computation
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        # Caller holds the lock
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return False, None
+        self._entries.move_to_end(key)
+        return True, value
+
+    def get(self, key, default=None):
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                self.hits += 1
+                return value
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _claim(self, key):
+        """
+        Returns:
+            tuple: (found, value, future, owner). When owner is True the caller
+            must compute the value and resolve the future.
+        """
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                self.hits += 1
+                return True, value, None, False
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return False, None, future, False
+            self.misses += 1
+            future = Future()
+            self._in_flight[key] = future
+            return False, None, future, True
+
+    def _resolve(self, key, future, value=None, error=None, keep=None):
+        with self._lock:
+            self._in_flight.pop(key, None)
+        if error is None:
+            if keep is None or keep(value):
+                self.put(key, value)
+            future.set_result(value)
+        else:
+            future.set_exception(error)
+
+    def get_or_compute(self, key, compute, keep=None):
+        """
+        Return the cached value for key, computing it with compute() on a miss.
+        Concurrent calls for the same key share one computation.
+
+        Args:
+            keep (callable): value -> bool, a value it rejects is handed to the
+                waiters but not cached
+        """
+        while True:
+            found, value, future, owner = self._claim(key)
+            if found:
+                return value
+            if owner:
+                break
+            try:
+                return future.result()
+            except _Abandoned:
+                continue
+        try:
+            value = compute()
+        except Exception as e:
+            self._resolve(key, future, error=e)
+            raise
+        except BaseException:
+            self._resolve(key, future, error=_Abandoned())
+            raise
+        self._resolve(key, future, value, keep=keep)
+        return value
+
+    async def get_or_compute_async(self, key, compute, keep=None):
+        """
+        Async version of get_or_compute, compute() must return an awaitable.
+        Waiters can be on other threads or event loops.
+        """
+        while True:
+            found, value, future, owner = self._claim(key)
+            if found:
+                return value
+            if owner:
+                break
+            try:
+                # Shielded, a cancelled waiter must not cancel the shared future
+                waiting = asyncio.wrap_future(future)
+                waiting.add_done_callback(lambda done: done.cancelled() or done.exception())
+                return await asyncio.shield(waiting)
+            except _Abandoned:
+                continue
+        try:
+            value = await compute()
+        except Exception as e:
+            self._resolve(key, future, error=e)
+            raise
+        except BaseException:
+            # Cancelled (e.g. a timeout or a client disconnect), not a failure of compute
+            self._resolve(key, future, error=_Abandoned())
+            raise
+        self._resolve(key, future, value, keep=keep)
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "in_flight": len(self._in_flight),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+            }
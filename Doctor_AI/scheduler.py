@@ -0,0 +1,490 @@
+# Admission control and fair scheduling of upstream calls
+#
+# Every call to Groq (STT and LLM) and to Edge-TTS goes through an Upstream.
+# It caps how many calls are in flight and spaces them out with a token
+# bucket. Free slots are handed out round-robin across sessions, so one
+# consultation that needs many TTS calls cannot starve the others. When an
+# upstream answers 429 (or 503), the whole upstream pauses for the Retry-After
+# time and the call is queued again, instead of every waiting request failing
+# at once. Queues are bounded: a call that would wait too long is rejected
+# right away with the expected wait. Each upstream also has a circuit breaker
+# (circuit_breaker.py): while the service is failing, calls fail fast with
+# CircuitOpenError instead of joining the queue.
+
+import os
+import time
+import asyncio
+import itertools
+import threading
+import contextvars
+import email.utils
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+import metrics
+from circuit_breaker import CircuitBreaker, STATE_VALUES, is_failure, status_code
+
+# Calls in flight, calls per second (0 = no rate limit) and burst size per upstream
+UPSTREAM_LIMITS = {
+    "stt": (int(os.getenv("STT_CONCURRENCY", "8")), float(os.getenv("STT_RATE_LIMIT", "0")), int(os.getenv("STT_BURST", "8"))),
+    "llm": (int(os.getenv("LLM_CONCURRENCY", "8")), float(os.getenv("LLM_RATE_LIMIT", "0")), int(os.getenv("LLM_BURST", "8"))),
+    "tts": (int(os.getenv("TTS_CONCURRENCY", "16")), float(os.getenv("TTS_RATE_LIMIT", "0")), int(os.getenv("TTS_BURST", "16"))),
+}
+# Calls waiting per upstream, and the longest expected wait (seconds) a new call accepts
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "64"))
+SCHEDULER_MAX_WAIT = float(os.getenv("SCHEDULER_MAX_WAIT", "60"))
+# Retries after 429/503, with exponential backoff when there is no Retry-After
+SCHEDULER_MAX_RETRIES = int(os.getenv("SCHEDULER_MAX_RETRIES", "3"))
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+RETRY_STATUSES = (429, 503)
+
+QUEUE_WAIT = metrics.register(metrics.Histogram(
+    "doctor_upstream_queue_seconds", "Time calls waited for an upstream slot."))
+REJECTED = metrics.register(metrics.Counter(
+    "doctor_upstream_rejected_total", "Calls rejected because the upstream queue was full."))
+RETRIED = metrics.register(metrics.Counter(
+    "doctor_upstream_retries_total", "Calls retried after a rate limit or overload answer."))
+
+
+class UpstreamBusyError(RuntimeError):
+    """The upstream queue is full, or the expected wait is over SCHEDULER_MAX_WAIT."""
+
+    def __init__(self, upstream, expected_wait):
+        self.upstream = upstream
+        self.expected_wait = expected_wait
+        super().__init__(
+            f"The {upstream} service is busy (expected wait about {expected_wait:.1f}s), please try again shortly."
+        )
+
+
+# --- Sessions ---
+_session = contextvars.ContextVar("doctor_session", default=None)
+
+
+def current_session():
+    """The session calls are queued under: set with session(), else the current request."""
+    key = _session.get()
+    if key is None:
+        key = metrics.current_request_id() or "anonymous"
+    return key
+
+
+class session:
+    """Context manager that queues the calls made inside it under one session key."""
+
+    def __init__(self, key):
+        self.key = key
+
+    def __enter__(self):
+        self._token = _session.set(self.key)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _session.reset(self._token)
+        return False
+
+
+def bind_session(coro):
+    """
+    Wrap a coroutine so it runs under the caller's session, for coroutines
+    handed to another thread's event loop (e.g. the TTS loop).
+    """
+    key = current_session()
+
+    async def run():
+        token = _session.set(key)
+        try:
+            return await coro
+        finally:
+            _session.reset(token)
+
+    return run()
+
+
+# --- Rate limiting ---
+class TokenBucket:
+    """Allows `rate` calls per second on average with bursts of up to `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+
+    def take(self, now):
+        """
+        Take a token if one is available. Not thread safe, the Upstream lock
+        protects it.
+
+        Returns:
+            float: 0 when a token was taken, else seconds until the next one
+        """
+        if self.rate <= 0:
+            return 0.0
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+
+def retry_delay(error, attempt):
+    """
+    How long to back off after a failed call.
+
+    Returns:
+        float: Seconds to wait before retrying, or None if the error is not retryable
+    """
+    if getattr(error, "status_code", None) not in RETRY_STATUSES:
+        return None
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    delay = None
+    try:
+        if headers.get("retry-after-ms"):
+            delay = float(headers["retry-after-ms"]) / 1000
+        elif headers.get("retry-after"):
+            value = headers["retry-after"]
+            try:
+                delay = float(value)
+            except ValueError:
+                # HTTP-date form
+                delay = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        delay = None
+    if delay is None:
+        delay = RETRY_BASE_DELAY * 2 ** attempt
+    return min(max(delay, 0.0), RETRY_MAX_DELAY)
+
+
+# --- Upstreams ---
+class Upstream:
+    """Concurrency limit, rate limit and fair queue in front of one upstream service."""
+
+    def __init__(self, name, concurrency, rate=0.0, burst=1, max_queue=SCHEDULER_MAX_QUEUE,
+                 max_wait=SCHEDULER_MAX_WAIT, max_retries=SCHEDULER_MAX_RETRIES):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.active = 0
+        self.waiting = 0
+        self._bucket = TokenBucket(rate, burst)
+        self._queues = OrderedDict()  # session -> deque of Futures, next session first
+        self._paused_until = 0.0
+        self._service_time = None  # moving average of how long a call holds its slot
+        self._timer = None
+        self._lock = threading.Lock()
+        self.breaker = CircuitBreaker(name)
+
+    # Everything ending in _locked expects the caller to hold self._lock
+    def _expected_wait_locked(self):
+        now = time.monotonic()
+        wait = 0.0
+        if self.active >= self.concurrency:
+            wait = (self.waiting + 1) / self.concurrency * (self._service_time or 1.0)
+        if self._bucket.rate > 0:
+            wait = max(wait, self.waiting / self._bucket.rate)
+        return max(0.0, self._paused_until - now) + wait
+
+    def _admit_delay_locked(self):
+        now = time.monotonic()
+        if self._paused_until > now:
+            return self._paused_until - now
+        return self._bucket.take(now)
+
+    def _dispatch_locked(self):
+        while self.waiting and self.active < self.concurrency:
+            delay = self._admit_delay_locked()
+            if delay > 0:
+                self._wake_after_locked(delay)
+                return
+            future = self._next_waiter_locked()
+            if future.set_running_or_notify_cancel():
+                self.active += 1
+                future.set_result(None)
+
+    def _next_waiter_locked(self):
+        # Round-robin: the served session moves to the back of the line
+        key, queue = next(iter(self._queues.items()))
+        future = queue.popleft()
+        if queue:
+            self._queues.move_to_end(key)
+        else:
+            del self._queues[key]
+        self.waiting -= 1
+        return future
+
+    def _wake_after_locked(self, delay):
+        if self._timer is None:
+            self._timer = threading.Timer(delay, self._on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            self._dispatch_locked()
+
+    def _enqueue(self, key):
+        """
+        Returns:
+            Future: Resolves when the caller holds a slot, or None if it got one right away
+        """
+        with self._lock:
+            if not self.waiting and self.active < self.concurrency and self._admit_delay_locked() == 0:
+                self.active += 1
+                return None
+            expected_wait = self._expected_wait_locked()
+            if self.waiting >= self.max_queue or expected_wait > self.max_wait:
+                REJECTED.inc(upstream=self.name)
+                raise UpstreamBusyError(self.name, expected_wait)
+            future = Future()
+            self._queues.setdefault(key, deque()).append(future)
+            self.waiting += 1
+            self._dispatch_locked()
+            return future
+
+    def _abandon(self, future):
+        """Withdraw a waiter that was cancelled, or give back its slot if it already got one."""
+        with self._lock:
+            if future.cancel():
+                for key, queue in self._queues.items():
+                    if future in queue:
+                        queue.remove(future)
+                        if not queue:
+                            del self._queues[key]
+                        self.waiting -= 1
+                        break
+                return
+        self.release()
+
+    def acquire(self):
+        """Block until a slot is free. Raises UpstreamBusyError when the queue is full."""
+        start = time.perf_counter()
+        future = self._enqueue(current_session())
+        if future is not None:
+            future.result()
+        QUEUE_WAIT.observe(time.perf_counter() - start, upstream=self.name)
+
+    async def acquire_async(self):
+        """Async version of acquire, waiting does not block the event loop."""
+        start = time.perf_counter()
+        future = self._enqueue(current_session())
+        if future is not None:
+            try:
+                await asyncio.shield(asyncio.wrap_future(future))
+            except asyncio.CancelledError:
+                self._abandon(future)
+                raise
+        QUEUE_WAIT.observe(time.perf_counter() - start, upstream=self.name)
+
+    def release(self, held=None):
+        """Give back a slot, held is how long it was used (seconds)."""
+        with self._lock:
+            self.active -= 1
+            if held is not None:
+                self._service_time = held if self._service_time is None else 0.8 * self._service_time + 0.2 * held
+            self._dispatch_locked()
+
+    def pause(self, seconds):
+        """Hold back every queued call for `seconds`, e.g. after a 429."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _admit(self):
+        """
+        Check the circuit, then wait for a slot.
+
+        Returns:
+            bool: True when the call is a half-open probe of the circuit
+        """
+        probe = self.breaker.allow()
+        try:
+            self.acquire()
+        except BaseException:
+            self.breaker.cancel(probe)
+            raise
+        return probe
+
+    async def _admit_async(self):
+        probe = self.breaker.allow()
+        try:
+            await self.acquire_async()
+        except BaseException:
+            self.breaker.cancel(probe)
+            raise
+        return probe
+
+    def _report(self, probe, error=None):
+        if error is None:
+            self.breaker.record(True, probe)
+        elif is_failure(error):
+            self.breaker.record(False, probe, error)
+        elif status_code(error) is not None:
+            # A 4xx still means the service answered
+            self.breaker.record(True, probe)
+        else:
+            # A local error says nothing about the upstream
+            self.breaker.cancel(probe)
+
+    def _should_retry(self, error, attempt):
+        delay = retry_delay(error, attempt)
+        if delay is None or attempt >= self.max_retries:
+            return False
+        RETRIED.inc(upstream=self.name, status=error.status_code)
+        self.pause(delay)
+        return True
+
+    def call(self, compute):
+        """
+        Run compute() while holding a slot, retrying after 429/503 answers.
+        compute must be safe to call again.
+        """
+        for attempt in itertools.count():
+            probe = self._admit()
+            start = time.perf_counter()
+            try:
+                result = compute()
+            except Exception as e:
+                self._report(probe, e)
+                if not self._should_retry(e, attempt):
+                    raise
+            except BaseException:
+                self.breaker.cancel(probe)
+                raise
+            else:
+                self._report(probe)
+                return result
+            finally:
+                self.release(time.perf_counter() - start)
+
+    async def call_async(self, compute):
+        """Async version of call, compute() must return an awaitable."""
+        for attempt in itertools.count():
+            probe = await self._admit_async()
+            start = time.perf_counter()
+            try:
+                result = await compute()
+            except Exception as e:
+                self._report(probe, e)
+                if not self._should_retry(e, attempt):
+                    raise
+            except BaseException:
+                # Cancelled, the call says nothing about the upstream
+                self.breaker.cancel(probe)
+                raise
+            else:
+                self._report(probe)
+                return result
+            finally:
+                self.release(time.perf_counter() - start)
+
+    def stream(self, compute):
+        """
+        Iterate over compute() while holding a slot. A 429/503 is retried
+        only if nothing was yielded yet.
+        """
+        for attempt in itertools.count():
+            probe = self._admit()
+            start = time.perf_counter()
+            started = False
+            try:
+                for item in compute():
+                    started = True
+                    yield item
+            except Exception as e:
+                self._report(probe, e)
+                if started or not self._should_retry(e, attempt):
+                    raise
+            except BaseException:
+                # The consumer stopped early
+                self.breaker.cancel(probe)
+                raise
+            else:
+                self._report(probe)
+                return
+            finally:
+                self.release(time.perf_counter() - start)
+
+    def expected_wait(self):
+        """Seconds a call made now is expected to wait for a slot."""
+        with self._lock:
+            return self._expected_wait_locked()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active": self.active,
+                "waiting": self.waiting,
+                "sessions": len(self._queues),
+                "paused_for": round(max(0.0, self._paused_until - time.monotonic()), 3),
+                "expected_wait": round(self._expected_wait_locked(), 3),
+            }
+
+
+UPSTREAMS = {
+    name: Upstream(name, concurrency, rate, burst)
+    for name, (concurrency, rate, burst) in UPSTREAM_LIMITS.items()
+}
+
+
+def call(upstream, compute):
+    """Run compute() through the named upstream ("stt", "llm" or "tts")."""
+    return UPSTREAMS[upstream].call(compute)
+
+
+async def call_async(upstream, compute):
+    return await UPSTREAMS[upstream].call_async(compute)
+
+
+def stream(upstream, compute):
+    return UPSTREAMS[upstream].stream(compute)
+
+
+def expected_wait():
+    """
+    Returns:
+        float: Expected wait of a new consultation, the sum over all upstreams
+    """
+    return sum(upstream.expected_wait() for upstream in UPSTREAMS.values())
+
+
+def health():
+    """
+    Returns:
+        dict: Queue and circuit breaker state of every upstream
+    """
+    return {
+        name: {**upstream.stats(), "circuit": upstream.breaker.stats()}
+        for name, upstream in UPSTREAMS.items()
+    }
+
+
+def _upstream_gauges():
+    return {
+        (("upstream", name), ("state", state)): value
+        for name, upstream in UPSTREAMS.items()
+        for state, value in upstream.stats().items()
+        if state != "sessions"
+    }
+
+
+metrics.register(metrics.Gauge("doctor_upstream", "In-flight, waiting, pause and expected wait per upstream.",
+                               _upstream_gauges))
+
+
+def _circuit_gauges():
+    gauges = {}
+    for name, upstream in UPSTREAMS.items():
+        stats = upstream.breaker.stats()
+        gauges[(("upstream", name), ("field", "state"))] = STATE_VALUES[stats["state"]]
+        for field in ("failure_rate", "opened", "rejected"):
+            gauges[(("upstream", name), ("field", field))] = stats[field]
+    return gauges
+
+
+metrics.register(metrics.Gauge("doctor_circuit", "Circuit breaker per upstream (state: 0 closed, 1 half-open, 2 open).",
+                               _circuit_gauges))
@@ -0,0 +1,105 @@
+# ASGI server that hosts the Gradio UI next to the operational endpoints
+#
+# Gradio is mounted at "/" of a FastAPI app, which also serves /metrics in the
+# Prometheus text format, the queue and circuit breaker state of every
+# upstream at /upstreams, and the JSON API under /v1 (api.py, SERVE_API=0 to
+# leave it out). Both launch scripts use serve() unless SERVE_METRICS=0, in
+# which case they fall back to Gradio's own launch().
+#
+# On startup the server loop's AsyncGroq client opens its connection pool,
+# the sync client is warmed up by startup.warm_up.
+#
+# Requests whose Content-Length is over MAX_REQUEST_BYTES (UI uploads and API
+# calls alike) are turned away with 413 before their body is read.
+
+import os
+import asyncio
+import logging
+
+import metrics
+import scheduler
+import groq_client
+from startup import lazy_import
+
+logger = logging.getLogger(__name__)
+
+SERVE_METRICS = os.getenv("SERVE_METRICS", "1") == "1"
+SERVE_API = os.getenv("SERVE_API", "1") == "1"
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(64 * 1024 * 1024)))
+
+
+class RequestSizeLimit:
+    """ASGI middleware: 413 for a request that announces a body over max_bytes."""
+
+    def __init__(self, app, max_bytes=MAX_REQUEST_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            length = dict(scope["headers"]).get(b"content-length", b"")
+            if length.isdigit() and int(length) > self.max_bytes:
+                responses = lazy_import("fastapi.responses")
+                response = responses.JSONResponse(
+                    {"status": "error", "error": f"Request is over the {self.max_bytes} byte limit."},
+                    status_code=413,
+                )
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+async def _warm_up_async_client():
+    try:
+        await groq_client.warm_up_async()
+    except Exception as e:
+        logger.warning(f"Warm-up could not reach Groq from the server loop: {e}")
+
+
+def create_server(blocks, allowed_paths=None):
+    """
+    Build the FastAPI app with /metrics, the JSON API and the Gradio UI mounted at "/".
+
+    Args:
+        blocks: The Gradio Blocks to mount, None for the API alone
+        allowed_paths (list): Extra folders Gradio may serve files from
+
+    Returns:
+        FastAPI: The ASGI application
+    """
+    fastapi = lazy_import("fastapi")
+    responses = lazy_import("fastapi.responses")
+
+    app = fastapi.FastAPI()
+    app.add_middleware(RequestSizeLimit, max_bytes=MAX_REQUEST_BYTES)
+
+    @app.on_event("startup")
+    async def warm_up_async_client():
+        # The async handlers' AsyncGroq client belongs to this loop, open its pool here
+        if os.getenv("DOCTOR_WARMUP", "1") == "1":
+            app.state.warm_up = asyncio.get_running_loop().create_task(_warm_up_async_client())
+
+    @app.get("/metrics")
+    def metrics_endpoint():
+        return responses.PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+    @app.get("/upstreams")
+    def upstreams_endpoint():
+        # Queue and circuit breaker state of Groq STT, the LLM and TTS
+        return scheduler.health()
+
+    # Registered before Gradio, whose mount at "/" would catch everything else
+    if SERVE_API or blocks is None:
+        import api
+        app.include_router(api.create_router(), prefix="/v1")
+
+    if blocks is None:
+        return app
+    gr = lazy_import("gradio")
+    return gr.mount_gradio_app(app, blocks, path="/", allowed_paths=allowed_paths)
+
+
+def serve(blocks, server_name="0.0.0.0", server_port=7860, allowed_paths=None):
+    """Run the UI, the API and /metrics with uvicorn (blocks until the server stops)."""
+    uvicorn = lazy_import("uvicorn")
+    uvicorn.run(create_server(blocks, allowed_paths), host=server_name, port=server_port)
@@ -0,0 +1,130 @@
+# Cold-start helpers
+#
+# Heavy modules (gradio, groq, httpx, edge_tts, gtts, Pillow) are imported on
+# first use through lazy_import, which also records how long each import
+# took. warm_up can do that work in a background thread right after the
+# server starts, and startup_report prints the breakdown.
+
+import os
+import time
+import logging
+import importlib
+import threading
+
+logger = logging.getLogger(__name__)
+
+PROCESS_START = time.perf_counter()
+
+# Modules the app needs for a consultation, imported by warm_up
+HEAVY_MODULES = ("httpx", "groq", "edge_tts", "gtts", "PIL.Image")
+
+_timings = {}  # label -> seconds
+_lock = threading.Lock()
+
+
+def record(label, seconds):
+    """Remember how long a startup step took (the first time only)."""
+    with _lock:
+        _timings.setdefault(label, seconds)
+
+
+def lazy_import(name):
+    """
+    Import a module on first use and time it.
+
+    Args:
+        name (str): Dotted module name
+
+    Returns:
+        module: The imported module
+    """
+    # Already imported modules are a cheap dict lookup in importlib
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    elapsed = time.perf_counter() - start
+    if elapsed > 0.001:
+        record(f"import {name}", elapsed)
+    return module
+
+
+class timed:
+    """Context manager that records the duration of a startup step."""
+
+    def __init__(self, label):
+        self.label = label
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.label, time.perf_counter() - self.start)
+        return False
+
+
+def startup_report():
+    """
+    Returns:
+        str: Startup steps sorted by duration, plus total time since startup began
+    """
+    with _lock:
+        items = sorted(_timings.items(), key=lambda item: item[1], reverse=True)
+    lines = [f"Startup report ({time.perf_counter() - PROCESS_START:.3f}s since startup began):"]
+    for label, seconds in items:
+        lines.append(f"  {seconds * 1000:8.1f} ms  {label}")
+    return "\n".join(lines)
+
+
+def _warm_up():
+    for name in HEAVY_MODULES:
+        try:
+            lazy_import(name)
+        except ImportError as e:
+            logger.warning(f"Warm-up could not import {name}: {e}")
+
+    # Build the shared clients and open their connection pools
+    try:
+        import groq_client
+        with timed("open Groq connection pool"):
+            groq_client.warm_up()
+    except Exception as e:
+        logger.warning(f"Warm-up could not reach Groq: {e}")
+
+    # Start the local TTS workers when the local engine is configured
+    try:
+        import voice_of_the_doctor
+        if "local" in voice_of_the_doctor.TTS_ENGINES:
+            with timed("start local TTS workers"):
+                voice_of_the_doctor.local_tts.warm_up()
+    except Exception as e:
+        logger.warning(f"Warm-up could not start the local TTS engine: {e}")
+
+    # Load the local Whisper model, if it is installed and may be used
+    try:
+        import voice_of_the_patient
+        voice_of_the_patient.stt_router.warm_up()
+    except Exception as e:
+        logger.warning(f"Warm-up could not load the local speech model: {e}")
+
+    logger.info(startup_report())
+
+
+def warm_up(background=True):
+    """
+    Import the heavy modules and open the connection pools ahead of the
+    first request. Disabled with DOCTOR_WARMUP=0.
+
+    Args:
+        background (bool): Run in a daemon thread instead of blocking
+
+    Returns:
+        threading.Thread: The warm-up thread, or None
+    """
+    if os.getenv("DOCTOR_WARMUP", "1") != "1":
+        return None
+    if not background:
+        _warm_up()
+        return None
+    thread = threading.Thread(target=_warm_up, name="doctor-warm-up", daemon=True)
+    thread.start()
+    return thread
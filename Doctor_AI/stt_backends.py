@@ -0,0 +1,304 @@
+# Speech-to-text backends
+#
+# transcribe_with_groq used to call the Groq Whisper endpoint directly. The
+# transcription now goes through an STTRouter that picks one of these backends:
+#
+# - GroqBackend: whisper-large-v3 on Groq (the default)
+# - LocalWhisperBackend: faster-whisper on the CPU with int8 weights, loaded
+#   once and kept warm. Optional, used only when faster-whisper is installed.
+#
+# Short recordings go to the local model: they skip a network round trip and
+# don't count against the Groq rate limits. Longer ones go to Groq, unless
+# Groq keeps failing or its queue is long, in which case the router switches
+# to the local model. A backend that fails hands over to the next one.
+
+import os
+import time
+import wave
+import asyncio
+import logging
+import shutil
+import threading
+import subprocess
+import importlib.util
+
+import metrics
+import scheduler
+from groq_client import GROQ_API_KEY, get_client, get_async_client
+from startup import lazy_import, timed
+
+logger = logging.getLogger(__name__)
+
+# auto (route per recording), groq or local
+STT_BACKEND = os.getenv("STT_BACKEND", "auto").lower()
+GROQ_STT_MODEL = "whisper-large-v3"
+
+# Local model: a faster-whisper size (tiny.en, base.en, small.en, ...) or a model folder
+LOCAL_STT_MODEL = os.getenv("LOCAL_STT_MODEL", "base.en")
+LOCAL_STT_COMPUTE_TYPE = os.getenv("LOCAL_STT_COMPUTE_TYPE", "int8")
+LOCAL_STT_THREADS = int(os.getenv("LOCAL_STT_THREADS", "4"))
+# Transcriptions running on the local model at the same time
+LOCAL_STT_WORKERS = int(os.getenv("LOCAL_STT_WORKERS", "1"))
+
+# Routing: recordings up to this many seconds go to the local model
+LOCAL_STT_MAX_SECONDS = float(os.getenv("LOCAL_STT_MAX_SECONDS", "15"))
+# Use the local model for everything while Groq's expected queue wait is longer than this
+LOCAL_STT_MAX_GROQ_WAIT = float(os.getenv("LOCAL_STT_MAX_GROQ_WAIT", "5"))
+# A backend that failed this many times in a row is skipped for STT_UNHEALTHY_COOLDOWN seconds
+STT_UNHEALTHY_AFTER = int(os.getenv("STT_UNHEALTHY_AFTER", "3"))
+STT_UNHEALTHY_COOLDOWN = float(os.getenv("STT_UNHEALTHY_COOLDOWN", "30"))
+
+FFPROBE = shutil.which("ffprobe")
+
+
+def audio_duration(audio_path):
+    """
+    Returns:
+        float: Length of the recording in seconds, or None if it can't be read
+    """
+    try:
+        with wave.open(audio_path, "rb") as recording:
+            return recording.getnframes() / float(recording.getframerate())
+    except (wave.Error, EOFError, OSError):
+        pass
+    if FFPROBE:
+        try:
+            result = subprocess.run(
+                [FFPROBE, "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", audio_path],
+                capture_output=True, timeout=10, check=True, text=True,
+            )
+            return float(result.stdout.strip())
+        except (subprocess.SubprocessError, OSError, ValueError):
+            pass
+    return None
+
+
+class STTBackend:
+    """
+    A speech-to-text engine. Subclasses implement transcribe and may override
+    transcribe_async (the default runs transcribe in a worker thread).
+    """
+
+    name = "backend"
+    model = ""
+
+    def __init__(self):
+        self.failures = 0
+        self.last_failure = 0.0
+
+    def available(self):
+        """False when the backend can't be used at all (missing key or package)."""
+        return True
+
+    def healthy(self):
+        if self.failures < STT_UNHEALTHY_AFTER:
+            return True
+        return time.monotonic() - self.last_failure > STT_UNHEALTHY_COOLDOWN
+
+    def record(self, ok):
+        if ok:
+            self.failures = 0
+        else:
+            self.failures += 1
+            self.last_failure = time.monotonic()
+
+    def transcribe(self, audio_path):
+        """
+        Returns:
+            str: The transcript of the recording
+        """
+        raise NotImplementedError
+
+    async def transcribe_async(self, audio_path):
+        return await asyncio.to_thread(self.transcribe, audio_path)
+
+
+class GroqBackend(STTBackend):
+    """Whisper on Groq, through the shared client and the "stt" upstream scheduler."""
+
+    name = "groq"
+    model = GROQ_STT_MODEL
+
+    def __init__(self, prepare_audio):
+        super().__init__()
+        # prepare_audio(path) -> (filename, bytes), see voice_of_the_patient
+        self.prepare_audio = prepare_audio
+
+    def available(self):
+        return bool(GROQ_API_KEY)
+
+    def healthy(self):
+        # While the circuit is open the call would fail fast, try the local model first
+        return super().healthy() and not scheduler.UPSTREAMS["stt"].breaker.is_open()
+
+    def transcribe(self, audio_path):
+        upload = self.prepare_audio(audio_path)
+        transcription = scheduler.call("stt", lambda: get_client().audio.transcriptions.create(
+            file=upload,
+            model=self.model,
+        ))
+        return transcription.text
+
+    async def transcribe_async(self, audio_path):
+        upload = await asyncio.to_thread(self.prepare_audio, audio_path)
+        transcription = await scheduler.call_async("stt", lambda: get_async_client().audio.transcriptions.create(
+            file=upload,
+            model=self.model,
+        ))
+        return transcription.text
+
+
+class LocalWhisperBackend(STTBackend):
+    """faster-whisper on the CPU. The model is loaded on first use and then kept."""
+
+    name = "local"
+
+    def __init__(self, model=LOCAL_STT_MODEL, compute_type=LOCAL_STT_COMPUTE_TYPE,
+                 threads=LOCAL_STT_THREADS, workers=LOCAL_STT_WORKERS):
+        super().__init__()
+        self.model = model
+        self.compute_type = compute_type
+        self.threads = threads
+        self._model = None
+        self._load_error = None
+        self._installed = importlib.util.find_spec("faster_whisper") is not None
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(max(1, workers))
+
+    def available(self):
+        return self._installed and self._load_error is None
+
+    def load(self):
+        """Load the model (once). Returns it, or None if it can't be loaded."""
+        if self._model is None and self.available():
+            with self._lock:
+                if self._model is None and self._load_error is None:
+                    try:
+                        faster_whisper = lazy_import("faster_whisper")
+                        with timed(f"load local Whisper model {self.model}"):
+                            self._model = faster_whisper.WhisperModel(
+                                self.model, device="cpu", compute_type=self.compute_type,
+                                cpu_threads=self.threads,
+                            )
+                    except Exception as e:
+                        logger.warning(f"Local Whisper model {self.model} could not be loaded: {e}")
+                        self._load_error = e
+        return self._model
+
+    def transcribe(self, audio_path):
+        model = self.load()
+        if model is None:
+            raise RuntimeError(f"Local Whisper model is not available: {self._load_error}")
+        with self._slots:
+            segments, _ = model.transcribe(audio_path, beam_size=1, vad_filter=True)
+            # segments is a generator, the decoding happens while joining
+            return " ".join(segment.text.strip() for segment in segments)
+
+
+class STTRouter:
+    """Picks a backend for each recording and falls back to the next on failure."""
+
+    def __init__(self, groq, local, mode=STT_BACKEND):
+        self.groq = groq
+        self.local = local
+        self.mode = mode
+
+    def _prefer_local(self, audio_path):
+        if not self.groq.available() or not self.groq.healthy():
+            return True
+        if scheduler.UPSTREAMS["stt"].expected_wait() > LOCAL_STT_MAX_GROQ_WAIT:
+            return True
+        duration = audio_duration(audio_path)
+        return duration is not None and duration <= LOCAL_STT_MAX_SECONDS
+
+    def choose(self, audio_path):
+        """
+        Returns:
+            list: Backends to try for this recording, best first (empty if none is usable)
+        """
+        if self.mode == "groq":
+            order = [self.groq]
+        elif self.mode == "local":
+            order = [self.local]
+        elif self.local.available() and self._prefer_local(audio_path):
+            order = [self.local, self.groq]
+        else:
+            order = [self.groq, self.local]
+        usable = [backend for backend in order if backend.available()]
+        # Unhealthy backends go last rather than being dropped
+        return sorted(usable, key=lambda backend: not backend.healthy())
+
+    def transcribe(self, audio_path, backends=None):
+        """Transcribe with the chosen backends, the first one that succeeds wins."""
+        return self.transcribe_with(audio_path, backends)[1]
+
+    async def transcribe_async(self, audio_path, backends=None):
+        return (await self.transcribe_with_async(audio_path, backends))[1]
+
+    def transcribe_with(self, audio_path, backends=None):
+        """
+        Like transcribe, but also says which backend answered.
+
+        Returns:
+            tuple: (backend, text)
+        """
+        error = None
+        for backend in backends or self.choose(audio_path):
+            start = time.perf_counter()
+            try:
+                text = backend.transcribe(audio_path)
+            except Exception as e:
+                self._failed(backend, e, start)
+                error = e
+                continue
+            self._succeeded(backend, start)
+            return backend, text
+        raise error or RuntimeError("No speech-to-text backend is available.")
+
+    async def transcribe_with_async(self, audio_path, backends=None):
+        error = None
+        for backend in backends or self.choose(audio_path):
+            start = time.perf_counter()
+            try:
+                text = await backend.transcribe_async(audio_path)
+            except Exception as e:
+                self._failed(backend, e, start)
+                error = e
+                continue
+            self._succeeded(backend, start)
+            return backend, text
+        raise error or RuntimeError("No speech-to-text backend is available.")
+
+    def _succeeded(self, backend, start):
+        backend.record(True)
+        metrics.record_stage(f"stt_{backend.name}", time.perf_counter() - start)
+
+    def _failed(self, backend, error, start):
+        backend.record(False)
+        metrics.record_stage(f"stt_{backend.name}", time.perf_counter() - start, ok=False)
+        logger.warning(f"{backend.name} transcription failed: {error}")
+
+    def warm_up(self):
+        """Load the local model ahead of the first request when it may be used."""
+        if self.mode != "groq" and self.local.available():
+            self.local.load()
+
+
+# Try every backend on the sample recording, e.g.
+#   LOCAL_STT_MODEL=tiny.en python stt_backends.py patient_voice_test_for_patient.wav
+if __name__ == "__main__":
+    import sys
+    from voice_of_the_patient import prepare_audio
+
+    audio_filepath = sys.argv[1] if len(sys.argv) > 1 else "patient_voice_test_for_patient.wav"
+    print(f"Duration: {audio_duration(audio_filepath)}s")
+    for backend in (LocalWhisperBackend(), GroqBackend(prepare_audio)):
+        if not backend.available():
+            print(f"{backend.name}: not available")
+            continue
+        start = time.perf_counter()
+        try:
+            print(f"{backend.name} ({backend.model}): {backend.transcribe(audio_filepath)!r} "
+                  f"in {time.perf_counter() - start:.2f}s")
+        except Exception as e:
+            print(f"{backend.name} failed: {e}")
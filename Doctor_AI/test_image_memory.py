@@ -0,0 +1,129 @@
+"""
+Memory accounting for the image upload path
+============================================
+Checks with tracemalloc that preparing an uploaded image stays within a
+fixed budget per request, whatever the size of the upload:
+
+1. An upload over IMAGE_MAX_UPLOAD_BYTES is rejected before it is read
+2. A large photo is decoded from the file, it is never in memory as a whole
+3. An image sent as uploaded is base64 encoded straight into its data URL
+4. Every request reuses that data URL instead of copying it
+
+Run with pytest: python -m pytest test_image_memory.py
+"""
+
+import os
+import io
+import tempfile
+import tracemalloc
+
+import pytest
+
+from brain_of_the_doctor import (
+    ImageTooLargeError, ENCODE_CHUNK_SIZE, HASH_CHUNK_SIZE, IMAGE_MAX_UPLOAD_BYTES, IMAGE_MAX_INLINE_BYTES,
+    prepare_image, _build_messages, _pillow,
+)
+
+# Allocations besides the image itself (logging, metrics, small buffers)
+OVERHEAD_BYTES = 256 * 1024
+
+
+def _peak(function, *args):
+    """Run function and return (result, peak bytes allocated while it ran)."""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        result = function(*args)
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+def _temporary_file(suffix, data=None, size=None):
+    handle, path = tempfile.mkstemp(suffix=suffix)
+    with os.fdopen(handle, "wb") as file:
+        if data is not None:
+            file.write(data)
+        else:
+            # Sparse, the test itself doesn't hold size bytes
+            file.truncate(size)
+    return path
+
+
+def _photo(width, height):
+    """A JPEG of noise (hardly compressible, so the upload is large)."""
+    Image = _pillow()[0]
+    image = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=95)
+    return buffer.getvalue()
+
+
+def _check_raises(function, *args):
+    try:
+        function(*args)
+    except ImageTooLargeError as e:
+        return e
+    raise AssertionError(f"{function.__name__} did not raise ImageTooLargeError")
+
+
+def test_oversized_upload_is_rejected_before_reading():
+    path = _temporary_file(".jpg", size=IMAGE_MAX_UPLOAD_BYTES + 1)
+    try:
+        _, peak = _peak(_check_raises, prepare_image, path)
+        assert peak < OVERHEAD_BYTES, f"rejecting the upload allocated {peak} bytes"
+    finally:
+        os.remove(path)
+
+
+def test_large_photo_is_not_held_in_memory():
+    pytest.importorskip("PIL")
+    path = _temporary_file(".jpg", _photo(4000, 3000))
+    try:
+        prepare_image(path)  # warm up Pillow's plugins and codecs
+        image, peak = _peak(prepare_image, path)
+        # The data URL, one transient copy of it, the re-encoded JPEG and the hash buffer
+        budget = 2 * len(image.url) + image.encoded_bytes + HASH_CHUNK_SIZE + OVERHEAD_BYTES
+        assert peak <= budget, f"peak {peak} bytes, budget {budget} bytes"
+        assert peak < image.original_bytes, (
+            f"peak {peak} bytes for a {image.original_bytes} byte upload"
+        )
+    finally:
+        os.remove(path)
+
+
+def test_upload_is_encoded_straight_into_the_data_url():
+    # Not an image Pillow can decode, so it is sent as uploaded
+    size = IMAGE_MAX_INLINE_BYTES - 1
+    path = _temporary_file(".jpg", os.urandom(size))
+    try:
+        image, peak = _peak(prepare_image, path)
+        assert image.url.startswith("data:image/jpeg;base64,")
+        assert image.encoded_bytes == size
+        # The URL and the bytearray it is decoded from, plus one chunk in flight
+        budget = 2 * len(image.url) + 2 * ENCODE_CHUNK_SIZE + OVERHEAD_BYTES
+        assert peak <= budget, f"peak {peak} bytes, budget {budget} bytes"
+    finally:
+        os.remove(path)
+
+
+def test_undecodable_upload_over_inline_limit_is_rejected():
+    path = _temporary_file(".jpg", os.urandom(IMAGE_MAX_INLINE_BYTES + 1))
+    try:
+        _check_raises(prepare_image, path)
+    finally:
+        os.remove(path)
+
+
+def test_requests_share_the_data_url():
+    path = _temporary_file(".jpg", os.urandom(64 * 1024))
+    try:
+        image = prepare_image(path)
+    finally:
+        os.remove(path)
+    messages, peak = _peak(_build_messages, "Is this a rash?", image.url, image.mime_type, "You are a doctor.")
+    assert messages[-1]["content"][1]["image_url"]["url"] is image.url
+    assert peak < len(image.url), f"building the messages allocated {peak} bytes"
+
@@ -0,0 +1,125 @@
+"""
+Live transcription segmentation
+===============================
+Feeds synthetic microphone streams to LiveTranscriber, with the Groq call
+replaced by a stub, and checks what becomes an utterance:
+
+1. Speech from the very first frame is detected (no calibration silence needed)
+2. Leading silence and a steady noisy room don't hide or invent speech
+3. A segment that fails to transcribe is retried, and the other segments
+   are kept when it fails again
+
+Run with pytest: python -m pytest test_live_transcription.py
+"""
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import live_transcription
+from live_transcription import LiveTranscriber
+
+SAMPLE_RATE = 16000
+CHUNK_SECONDS = 0.1  # Gradio streams about this much audio per event
+
+
+def _tone(seconds, amplitude):
+    t = np.arange(int(SAMPLE_RATE * seconds)) / SAMPLE_RATE
+    return amplitude * np.sin(2 * np.pi * 220 * t)
+
+
+def _noise(seconds, rms, seed=0):
+    return np.random.default_rng(seed).normal(0.0, rms, int(SAMPLE_RATE * seconds))
+
+
+def _words(count, amplitude=0.15, word=0.35, gap=0.15):
+    """count words of speech with short pauses, shorter than VAD_MIN_SILENCE."""
+    parts = []
+    for _ in range(count):
+        parts += [_tone(word, amplitude), np.zeros(int(SAMPLE_RATE * gap))]
+    return np.concatenate(parts)
+
+
+def _feed(live, samples):
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16)
+    step = int(SAMPLE_RATE * CHUNK_SECONDS)
+    for start in range(0, len(pcm), step):
+        live.add_chunk(SAMPLE_RATE, pcm[start:start + step])
+
+
+@pytest.fixture
+def segments(monkeypatch):
+    """Replaces the Groq call, every utterance is transcribed as its length."""
+    durations = []
+
+    def transcribe(session_key, sample_rate, samples):
+        durations.append(len(samples) / sample_rate)
+        return f"[{len(samples) / sample_rate:.1f}s]"
+
+    monkeypatch.setattr(live_transcription, "_transcribe_segment", transcribe)
+    return durations
+
+
+def test_speech_from_the_first_frame_is_heard(segments):
+    live = LiveTranscriber()
+    _feed(live, np.concatenate([_words(10), np.zeros(SAMPLE_RATE)]))
+    assert live.has_speech()
+    assert live.finish()
+    assert len(segments) == 1 and segments[0] > 4.5
+
+
+def test_leading_silence_gives_the_same_utterance(segments):
+    live = LiveTranscriber()
+    _feed(live, np.concatenate([np.zeros(SAMPLE_RATE // 2), _words(10), np.zeros(SAMPLE_RATE)]))
+    assert live.finish()
+    assert len(segments) == 1 and segments[0] > 4.5
+
+
+def test_noisy_room_is_learned_and_speech_still_heard(segments):
+    live = LiveTranscriber()
+    noise = _noise(9, 0.02)
+    speech = np.concatenate([np.zeros(4 * SAMPLE_RATE), _words(6), np.zeros(2 * SAMPLE_RATE)])
+    _feed(live, noise[:len(speech)] + speech)
+    live.finish()
+    # At most a short stretch at the start is taken for speech before the floor catches up
+    assert [duration for duration in segments if duration > 2.5], segments
+    assert len(segments) <= 2, segments
+    assert live._noise_floor > 0.015
+
+
+def test_failed_segment_is_retried(monkeypatch):
+    calls = []
+
+    def transcribe(session_key, sample_rate, samples):
+        calls.append(len(samples))
+        if len(calls) == 1:
+            raise RuntimeError("connection reset")
+        return "my cheek itches"
+
+    monkeypatch.setattr(live_transcription, "_transcribe_segment", transcribe)
+    live = LiveTranscriber()
+    _feed(live, np.concatenate([_words(4), np.zeros(SAMPLE_RATE)]))
+    assert live.finish() == "my cheek itches"
+    assert len(calls) == 2
+
+
+def test_other_segments_are_kept_when_one_fails(monkeypatch):
+    def transcribe(session_key, sample_rate, samples):
+        # The second utterance is longer and always fails
+        if len(samples) > 2 * sample_rate:
+            return "ERROR: An error occurred during transcription: 500"
+        return "it started last week"
+
+    monkeypatch.setattr(live_transcription, "_transcribe_segment", transcribe)
+    live = LiveTranscriber()
+    silence = np.zeros(SAMPLE_RATE)
+    _feed(live, np.concatenate([_words(2), silence, _words(6), silence]))
+    assert live.finish() == "it started last week"
+
+
+def test_error_is_returned_when_nothing_was_transcribed(monkeypatch):
+    monkeypatch.setattr(live_transcription, "_transcribe_segment",
+                        lambda *args: "ERROR: Groq API key is not configured.")
+    live = LiveTranscriber()
+    _feed(live, np.concatenate([_words(3), np.zeros(SAMPLE_RATE)]))
+    assert live.finish() == "ERROR: Groq API key is not configured."
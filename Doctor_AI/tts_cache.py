@@ -0,0 +1,232 @@
+# Content-addressed file caches
+#
+# FileCache stores files on disk under a key the caller derives from their
+# content. An in-memory index keeps them in least-recently-used order so the
+# cache can be held under a maximum size in bytes, and files older than
+# max_age (when set) are dropped on lookup.
+#
+# TTSCache holds the doctor's generated speech, keyed by the SHA-256 of
+# everything that affects how it sounds (text, voice, rate, pitch, volume and
+# TTS engine). voice_of_the_patient keeps its transcripts in a FileCache too.
+
+import os
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class FileCache:
+    """
+    Size-bounded LRU cache of files.
+
+    Args:
+        name (str): What the cache holds, used in log messages
+    """
+
+    def __init__(self, cache_dir, max_bytes, suffix, max_age=None, name="file"):
+        self.name = name
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.max_age = max_age  # seconds since the file was stored, None for no limit
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._index = OrderedDict()  # key -> size in bytes, oldest first
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def _load_index(self):
+        # Rebuild the index from disk, oldest modification time first
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, name[:-len(self.suffix)], stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._total_bytes += size
+        self._evict()
+
+    def _evict(self):
+        # Caller holds the lock (or is the constructor)
+        while self._total_bytes > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path_for(key))
+            except OSError:
+                pass
+
+    def get(self, *keys):
+        """
+        Look up a cached file.
+
+        Args:
+            keys (str): One or more cache keys, in order of preference
+
+        Returns:
+            str: Path of the cached file, or None on a miss
+        """
+        with self._lock:
+            for key in keys:
+                if key not in self._index:
+                    continue
+                path = self.path_for(key)
+                try:
+                    stored = os.path.getmtime(path)
+                except OSError:
+                    # Removed behind our back
+                    self._total_bytes -= self._index.pop(key)
+                    continue
+                if self.max_age is not None and time.time() - stored > self.max_age:
+                    self._total_bytes -= self._index.pop(key)
+                    self.evictions += 1
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    continue
+                self._index.move_to_end(key)
+                self.hits += 1
+                return path
+            self.misses += 1
+        return None
+
+    def put(self, key, source_path):
+        """
+        Store a copy of a freshly generated file.
+
+        Returns:
+            str: Path of the cached file, or None if it could not be stored
+        """
+        try:
+            size = os.path.getsize(source_path)
+        except OSError:
+            return None
+        if size == 0 or size > self.max_bytes:
+            return None
+
+        return self._store(key, size, lambda tmp_path: shutil.copyfile(source_path, tmp_path))
+
+    def put_bytes(self, key, data):
+        """
+        Store content that was generated in memory.
+
+        Returns:
+            str: Path of the cached file, or None if it could not be stored
+        """
+        if not data or len(data) > self.max_bytes:
+            return None
+
+        def write(tmp_path):
+            with open(tmp_path, "wb") as cache_file:
+                cache_file.write(data)
+
+        return self._store(key, len(data), write)
+
+    def _store(self, key, size, write):
+        # write(tmp_path) creates the file, it is then moved into place atomically
+        path = self.path_for(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not store an entry in the {self.name} cache: {e}")
+            return None
+
+        with self._lock:
+            if key in self._index:
+                self._total_bytes -= self._index.pop(key)
+            self._index[key] = size
+            self._total_bytes += size
+            self._evict()
+        return path
+
+    def read(self, *keys):
+        """
+        Returns:
+            bytes: The cached content for the first key that hits, or None on a miss
+        """
+        path = self.get(*keys)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as cache_file:
+                return cache_file.read()
+        except OSError:
+            # Evicted between the lookup and the read
+            return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._index),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class TTSCache(FileCache):
+    """Size-bounded LRU cache of synthesized audio files."""
+
+    def __init__(self, cache_dir, max_bytes=200 * 1024 * 1024, suffix=".mp3", max_age=None):
+        super().__init__(cache_dir, max_bytes, suffix, max_age, name="TTS")
+
+    @staticmethod
+    def make_key(text, voice, rate, pitch, volume, engine):
+        """Hash everything that changes the generated audio."""
+        material = "\x1f".join([text, voice, rate, pitch, volume, engine])
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def materialize(self, keys, output_filepath):
+        """
+        Make a cached file available at output_filepath without any TTS call.
+        The file is hard-linked when possible and copied otherwise.
+
+        Args:
+            keys (list): Cache keys, in order of preference
+            output_filepath (str): Where the audio is expected
+
+        Returns:
+            str: output_filepath on a hit, None on a miss
+        """
+        path = self.get(*keys)
+        if path is None:
+            return None
+        if os.path.abspath(path) == os.path.abspath(output_filepath):
+            return output_filepath
+        try:
+            if os.path.lexists(output_filepath):
+                os.remove(output_filepath)
+            try:
+                os.link(path, output_filepath)
+            except OSError:
+                # Different filesystem or no hard-link support
+                shutil.copyfile(path, output_filepath)
+        except OSError as e:
+            logger.warning(f"Could not reuse cached audio: {e}")
+            return None
+        return output_filepath
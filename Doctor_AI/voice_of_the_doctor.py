@@ -1,145 +1,628 @@
-# if you dont use pipenv uncomment the following:
-# from dotenv import load_dotenv
-# load_dotenv()
-
-import asyncio
-import edge_tts
-from gtts import gTTS
-import os
-
-# Configuration for the doctor's voice
-DOCTOR_VOICE = "en-US-GuyNeural"
-VOICE_RATE = "-4%"
-VOICE_PITCH = "+0Hz"
-VOICE_VOLUME = "+0%"
-
-async def _main_tts(text, output_filepath):
-    """Asynchronous function to handle TTS generation."""
-    try:
-        # Attempt to use the high-quality Edge-TTS voice
-        communicate = edge_tts.Communicate(text, DOCTOR_VOICE, rate=VOICE_RATE, pitch=VOICE_PITCH, volume=VOICE_VOLUME)
-        await communicate.save(output_filepath)
-        print(f"Successfully generated Edge TTS speech to {output_filepath}")
-        return output_filepath, None
-    except Exception as e:
-        # If Edge-TTS fails, fall back to the more stable gTTS
-        print(f"Error generating Edge TTS speech: {e}")
-        print("Using gTTS fallback for speech generation.")
-        try:
-            tts = gTTS(text=text, lang='en', slow=False)
-            tts.save(output_filepath)
-            print(f"Successfully generated gTTS speech to {output_filepath}")
-            return output_filepath, None
-        except Exception as gtts_error:
-            error_message = f"gTTS fallback also failed: {gtts_error}"
-            print(error_message)
-            return None, error_message
-
-def text_to_speech(text, output_filepath):
-    """
-    Synchronous wrapper to run the async TTS function.
-    This creates and manages the necessary asyncio event loop.
-    """
-    try:
-        return asyncio.run(_main_tts(text, output_filepath))
-    except Exception as e:
-        error_message = f"An error occurred in the TTS process: {e}"
-        print(error_message)
-        return None, error_message
-
-def generate_doctor_voice(text: str, output_filepath: str = "current_doctor_response.mp3"):
-    """
-    Generate speech using Edge TTS with a guaranteed deep male voice.
-    
-    Args:
-        text (str): The text to convert to speech
-        output_filepath (str): Where to save the generated audio
-        
-    Returns:
-        str: Path to the generated audio file
-    """
-    output_path, error = text_to_speech(text, output_filepath)
-    if error:
-        print(f"Failed to generate speech: {error}")
-    return output_path
-
-def speak_as_doctor(text: str):
-    """
-    Makes the doctor speak with a deep male voice.
-    
-    Args:
-        text (str): The text to be spoken
-        
-    Returns:
-        bool: True if successful, False otherwise
-    """
-    print(f"Doctor AI (Deep Male Voice): {text}")
-    
-    # Generate speech with Edge TTS
-    output_path = generate_doctor_voice(text)
-    
-    if not output_path or not os.path.exists(output_path):
-        print("Failed to generate doctor's voice.")
-        return False
-    
-    try:
-        # Play the generated speech
-        from playsound import playsound
-        playsound(output_path)
-        return True
-    except Exception as e:
-        print(f"Error playing audio: {e}")
-        return False
-
-def get_doctor_voice_for_ui(text: str, output_filepath: str = "doctor_response.mp3"):
-    """
-    Generate speech for the doctor's response for the UI.
-    Uses guaranteed deep male voice.
-    
-    Args:
-        text (str): The text to be spoken
-        output_filepath (str): The path where to save the file
-        
-    Returns:
-        str: Path to the audio file for the UI
-    """
-    print(f"Generating doctor voice for UI: {text[:50]}...")
-    
-    # Generate speech with Edge TTS - don't play it automatically for UI
-    output_path = generate_doctor_voice(text, output_filepath)
-    
-    if not output_path or not os.path.exists(output_path):
-        print("Failed to generate doctor's voice for UI.")
-        # Use a simple fallback in case of failure
-        from gtts import gTTS
-        try:
-            audioobj = gTTS(text=text, lang="en", tld="co.uk", slow=True)
-            audioobj.save(output_filepath)
-            print(f"Used gTTS fallback for UI audio")
-            return output_filepath
-        except:
-            print("All TTS methods failed.")
-            return None
-    
-    return output_path
-
-# --- Legacy functions for compatibility ---
-def generate_speech(text: str, output_filepath: str):
-    """Legacy function for compatibility"""
-    return generate_doctor_voice(text, output_filepath)
-
-def text_to_speech_with_gtts(input_text, output_filepath):
-    """Legacy function for compatibility"""
-    return generate_doctor_voice(input_text, output_filepath)
-
-def text_to_speech_with_gtts_old(input_text, output_filepath):
-    """Legacy function for compatibility"""
-    return generate_doctor_voice(input_text, output_filepath)
-
-# --- Main execution for testing ---
-if __name__ == "__main__":
-    test_message = "Hello, I am Doctor Jones. I will analyze your symptoms and provide medical advice based on what I see."
-    print("\n=== Doctor AI Voice System Test ===")
-    
-    print("\nGenerating and playing doctor's voice:")
+# if you dont use pipenv uncomment the following:
+# from dotenv import load_dotenv
+# load_dotenv()
+
+import asyncio
+import io
+import os
+import re
+import time
+import queue
+import threading
+import contextvars
+from collections import deque
+
+import local_tts
+import metrics
+import scheduler
+from startup import lazy_import
+from tts_cache import TTSCache
+
+# Configuration for the doctor's voice
+DOCTOR_VOICE = "en-US-GuyNeural"
+VOICE_RATE = "-4%"
+VOICE_PITCH = "+0Hz"
+VOICE_VOLUME = "+0%"
+# Seconds to open the Edge-TTS websocket, and to wait for its next message
+EDGE_CONNECT_TIMEOUT = int(os.getenv("EDGE_CONNECT_TIMEOUT", "5"))
+EDGE_RECEIVE_TIMEOUT = int(os.getenv("EDGE_RECEIVE_TIMEOUT", "15"))
+
+# How many phrases synthesize_many renders at the same time
+TTS_BATCH_CONCURRENCY = int(os.getenv("TTS_BATCH_CONCURRENCY", "4"))
+
+# Cache of generated speech, so identical text never hits the TTS service twice
+TTS_CACHE_ENABLED = os.getenv("TTS_CACHE", "1") == "1"
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "audio_cache"))
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+# Only the primary engine's speech (the first of TTS_ENGINES) is cached and
+# served from the cache. A fallback's speech (gTTS while Edge is down) is used
+# for that answer only, the next request tries the primary engine again.
+# The cache touches the disk, the TTS loop calls these with asyncio.to_thread.
+
+tts_cache = TTSCache(TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES) if TTS_CACHE_ENABLED else None
+
+def _cache_key(text, engine):
+    return TTSCache.make_key(text, DOCTOR_VOICE, VOICE_RATE, VOICE_PITCH, VOICE_VOLUME, engine)
+
+def _cacheable(engine):
+    return tts_cache is not None and engine == TTS_ENGINES[0]
+
+def _remember(text, engine, output_filepath):
+    """Store freshly generated speech in the TTS cache."""
+    if _cacheable(engine):
+        with metrics.stage("file_write"):
+            tts_cache.put(_cache_key(text, engine), output_filepath)
+
+def _remember_bytes(text, engine, audio):
+    if _cacheable(engine):
+        with metrics.stage("file_write"):
+            tts_cache.put_bytes(_cache_key(text, engine), audio)
+
+def _from_cache_bytes(text):
+    """The cached speech as bytes, None on a miss."""
+    if tts_cache is None:
+        return None
+    with metrics.stage("tts_cache"):
+        return tts_cache.read(_cache_key(text, TTS_ENGINES[0]))
+
+def _from_cache(text, output_filepath):
+    """Serve speech from the TTS cache, returns None on a miss."""
+    if tts_cache is None:
+        return None
+    with metrics.stage("tts_cache"):
+        return tts_cache.materialize([_cache_key(text, TTS_ENGINES[0])], output_filepath)
+
+# --- Hedged synthesis ---
+# Every phrase gets a latency budget. The primary engine starts right away,
+# the next engine in TTS_ENGINES is started as a hedge if the first hasn't
+# finished after TTS_HEDGE_DELAY seconds (or at once when it fails). The first
+# engine to finish wins, the others are cancelled, and when the deadline
+# passes we give up instead of trying one engine after another.
+TTS_ENGINES = tuple(engine.strip() for engine in os.getenv("TTS_ENGINES", "edge,gtts").split(",") if engine.strip())
+TTS_HEDGE_DELAY = float(os.getenv("TTS_HEDGE_DELAY", "2.5"))
+TTS_DEADLINE = float(os.getenv("TTS_DEADLINE", "20"))
+
+def _discard(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def _communicate(text):
+    # edge_tts and gtts are imported on first use to keep startup fast
+    edge_tts = lazy_import("edge_tts")
+    return edge_tts.Communicate(text, DOCTOR_VOICE, rate=VOICE_RATE, pitch=VOICE_PITCH, volume=VOICE_VOLUME,
+                                connect_timeout=EDGE_CONNECT_TIMEOUT, receive_timeout=EDGE_RECEIVE_TIMEOUT)
+
+async def _edge_engine(text, output_filepath):
+    # A fresh Communicate per attempt, the scheduler may retry after a 429
+    await scheduler.call_async("tts", lambda: _communicate(text).save(output_filepath))
+
+async def _edge_bytes(text):
+    async def collect():
+        audio = bytearray()
+        async for chunk in _communicate(text).stream():
+            if chunk["type"] == "audio":
+                audio.extend(chunk["data"])
+        return bytes(audio)
+
+    return await scheduler.call_async("tts", collect)
+
+async def _gtts_engine(text, output_filepath):
+    abandoned = threading.Event()
+
+    def save():
+        lazy_import("gtts").gTTS(text=text, lang='en', slow=False).save(output_filepath)
+        # A blocking thread can't be cancelled, drop its file if nobody wants it
+        if abandoned.is_set():
+            _discard(output_filepath)
+
+    try:
+        await asyncio.to_thread(save)
+    except asyncio.CancelledError:
+        abandoned.set()
+        raise
+
+async def _gtts_bytes(text):
+    def render():
+        buffer = io.BytesIO()
+        lazy_import("gtts").gTTS(text=text, lang='en', slow=False).write_to_fp(buffer)
+        return buffer.getvalue()
+
+    return await asyncio.to_thread(render)
+
+async def _local_engine(text, output_filepath):
+    # Piper or espeak-ng in a worker process (see local_tts.py)
+    future = local_tts.submit(text, output_filepath)
+    try:
+        await asyncio.wrap_future(future)
+    except asyncio.CancelledError:
+        # A running worker can't be interrupted, drop its file once it is done
+        future.add_done_callback(lambda _: _discard(output_filepath))
+        raise
+
+async def _local_bytes(text):
+    return await asyncio.wrap_future(local_tts.submit_bytes(text))
+
+# Engine name -> coroutine function(text, output_filepath).
+# "local" needs no network, use TTS_ENGINES=local,edge to make it the primary
+# or TTS_ENGINES=edge,gtts,local to keep it as the last fallback.
+TTS_ENGINE_FUNCTIONS = {
+    "edge": _edge_engine,
+    "gtts": _gtts_engine,
+    "local": _local_engine,
+}
+# Engine name -> coroutine function(text) returning the MP3 bytes
+TTS_BYTES_FUNCTIONS = {
+    "edge": _edge_bytes,
+    "gtts": _gtts_bytes,
+    "local": _local_bytes,
+}
+
+async def _run_engine(engine, text, part_path=None):
+    """Run one engine into part_path, or in memory when part_path is None (returns the bytes)."""
+    start = time.perf_counter()
+    audio = None
+    try:
+        if part_path is None:
+            audio = await TTS_BYTES_FUNCTIONS[engine](text)
+            if not audio:
+                raise RuntimeError("no audio received")
+        else:
+            await TTS_ENGINE_FUNCTIONS[engine](text, part_path)
+    except asyncio.CancelledError:
+        # The hedge lost or the deadline passed, not an engine failure
+        if part_path is not None:
+            _discard(part_path)
+        raise
+    except Exception:
+        metrics.record_stage(f"tts_{engine}", time.perf_counter() - start, ok=False)
+        if part_path is not None:
+            _discard(part_path)
+        raise
+    metrics.record_stage(f"tts_{engine}", time.perf_counter() - start)
+    metrics.record_bytes(f"tts_{engine}", "out", len(audio) if audio is not None else os.path.getsize(part_path))
+    return audio
+
+async def _hedge(start_engine, deadline=None):
+    """
+    Run the engines in TTS_ENGINES hedged, see the comment above.
+
+    Args:
+        start_engine (callable): engine name -> coroutine doing the synthesis
+        deadline (float): Seconds before giving up, defaults to TTS_DEADLINE
+
+    Returns:
+        tuple: (winning engine, its result, None) or (None, None, error message)
+    """
+    loop = asyncio.get_running_loop()
+    budget = TTS_DEADLINE if deadline is None else deadline
+    give_up_at = loop.time() + budget
+    waiting = list(TTS_ENGINES)
+    running = {}  # task -> engine
+    errors = []
+    next_start = loop.time()
+    try:
+        while running or waiting:
+            now = loop.time()
+            if now >= give_up_at:
+                break
+            if waiting and (now >= next_start or not running):
+                engine = waiting.pop(0)
+                running[asyncio.ensure_future(start_engine(engine))] = engine
+                next_start = now + TTS_HEDGE_DELAY
+                continue
+
+            wake_at = min(give_up_at, next_start) if waiting else give_up_at
+            done, _ = await asyncio.wait(running, timeout=max(0.0, wake_at - now),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                engine = running.pop(task)
+                if task.exception() is None:
+                    return engine, task.result(), None
+                print(f"Error generating {engine} speech: {task.exception()}")
+                errors.append(f"{engine}: {task.exception()}")
+                # Don't wait out the hedge delay after a failure
+                next_start = loop.time()
+    finally:
+        for task in running:
+            task.cancel()
+
+    if running or waiting:
+        error_message = f"No speech within the {budget:g}s TTS deadline"
+    else:
+        error_message = "All TTS engines failed"
+    if errors:
+        error_message += f" ({'; '.join(errors)})"
+    print(error_message)
+    return None, None, error_message
+
+async def _main_tts(text, output_filepath, deadline=None):
+    """
+    Asynchronous function to handle TTS generation.
+    Runs the engines hedged and gives up after `deadline` seconds (TTS_DEADLINE).
+
+    Returns:
+        tuple: (output path, None) on success, (None, error message) otherwise
+    """
+    def start_engine(engine):
+        # Each engine writes its own file, the winner's is moved into place
+        return _run_engine(engine, text, f"{output_filepath}.{engine}.part")
+
+    engine, _, error = await _hedge(start_engine, deadline)
+    if error:
+        return None, error
+    os.replace(f"{output_filepath}.{engine}.part", output_filepath)
+    print(f"Successfully generated {engine} speech to {output_filepath}")
+    await asyncio.to_thread(_remember, text, engine, output_filepath)
+    return output_filepath, None
+
+async def _main_tts_bytes(text, deadline=None):
+    """
+    In-memory version of _main_tts, nothing is written to disk except the cache.
+
+    Returns:
+        tuple: (MP3 bytes, None) on success, (None, error message) otherwise
+    """
+    engine, audio, error = await _hedge(lambda engine: _run_engine(engine, text), deadline)
+    if error:
+        return None, error
+    print(f"Successfully generated {engine} speech in memory ({len(audio)} bytes)")
+    await asyncio.to_thread(_remember_bytes, text, engine, audio)
+    return audio, None
+
+# --- Persistent TTS event loop ---
+class _TTSLoop:
+    """A long-lived event loop on its own thread that owns all TTS work."""
+
+    def __init__(self):
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def _ensure_running(self):
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="doctor-tts-loop", daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def run(self, coro):
+        """Schedule a coroutine on the TTS loop, returns a concurrent.futures.Future."""
+        # Keep the caller's session so TTS calls are queued fairly per consultation
+        return asyncio.run_coroutine_threadsafe(scheduler.bind_session(coro), self._ensure_running())
+
+_tts_loop = _TTSLoop()
+
+async def _generate(text, output_filepath, deadline=None):
+    """Serve the speech from the cache or synthesize it, runs on the TTS loop."""
+    cached_path = await asyncio.to_thread(_from_cache, text, output_filepath)
+    if cached_path:
+        return cached_path
+
+    # The old file may be a hard link into the cache, never write through it
+    if os.path.lexists(output_filepath):
+        os.remove(output_filepath)
+
+    output_path, error = await _main_tts(text, output_filepath, deadline)
+    if error:
+        print(f"Failed to generate speech: {error}")
+    return output_path
+
+async def _generate_bytes(text, deadline=None):
+    """In-memory version of _generate, runs on the TTS loop."""
+    audio = await asyncio.to_thread(_from_cache_bytes, text)
+    if audio:
+        return audio
+
+    audio, error = await _main_tts_bytes(text, deadline)
+    if error:
+        print(f"Failed to generate speech: {error}")
+    return audio
+
+def submit_bytes(text: str, deadline: float = None):
+    """
+    Like submit, but the speech is kept in memory instead of written to a file.
+
+    Returns:
+        concurrent.futures.Future: Resolves to the MP3 bytes, or None on failure
+    """
+    return _tts_loop.run(_generate_bytes(text, deadline))
+
+def submit(text: str, output_filepath: str = "current_doctor_response.mp3", deadline: float = None):
+    """
+    Queue speech generation on the persistent TTS loop. Safe to call from any
+    thread, including from inside another running event loop.
+
+    Args:
+        text (str): The text to convert to speech
+        output_filepath (str): Where to save the generated audio
+        deadline (float): Latency budget in seconds, defaults to TTS_DEADLINE
+
+    Returns:
+        concurrent.futures.Future: Resolves to the audio path, or None on failure
+    """
+    return _tts_loop.run(_generate(text, output_filepath, deadline))
+
+def synthesize_many(texts, output_dir: str = ".", concurrency: int = None):
+    """
+    Pre-render many phrases at once, at most `concurrency` at the same time.
+    Files are named after the text, so rendering the same phrase twice is cheap.
+
+    Args:
+        texts (list): The phrases to convert to speech
+        output_dir (str): Folder for the generated audio files
+        concurrency (int): Parallel jobs, defaults to TTS_BATCH_CONCURRENCY
+
+    Returns:
+        list: Audio paths in the same order as texts, None where synthesis failed
+    """
+    semaphore_size = concurrency or TTS_BATCH_CONCURRENCY
+    unique_texts = list(dict.fromkeys(texts))
+
+    async def render_all():
+        semaphore = asyncio.Semaphore(semaphore_size)
+
+        async def render(text):
+            output_filepath = os.path.join(output_dir, f"doctor_phrase_{_cache_key(text, 'edge')[:16]}.mp3")
+            async with semaphore:
+                return await _generate(text, output_filepath)
+
+        return await asyncio.gather(*(render(text) for text in unique_texts))
+
+    os.makedirs(output_dir, exist_ok=True)
+    paths = dict(zip(unique_texts, _tts_loop.run(render_all()).result()))
+    return [paths[text] for text in texts]
+
+def text_to_speech(text, output_filepath):
+    """
+    Synchronous wrapper to run the async TTS function.
+    The work runs on the persistent TTS event loop instead of a new loop per call.
+    """
+    try:
+        return _tts_loop.run(_main_tts(text, output_filepath)).result()
+    except Exception as e:
+        error_message = f"An error occurred in the TTS process: {e}"
+        print(error_message)
+        return None, error_message
+
+def generate_doctor_voice(text: str, output_filepath: str = "current_doctor_response.mp3"):
+    """
+    Generate speech using Edge TTS with a guaranteed deep male voice.
+    
+    Args:
+        text (str): The text to convert to speech
+        output_filepath (str): Where to save the generated audio
+        
+    Returns:
+        str: Path to the generated audio file
+    """
+    try:
+        return submit(text, output_filepath).result()
+    except Exception as e:
+        print(f"Failed to generate speech: {e}")
+        return None
+
+def speak_as_doctor(text: str):
+    """
+    Makes the doctor speak with a deep male voice.
+    
+    Args:
+        text (str): The text to be spoken
+        
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    print(f"Doctor AI (Deep Male Voice): {text}")
+    
+    # Generate speech with Edge TTS
+    output_path = generate_doctor_voice(text)
+    
+    if not output_path or not os.path.exists(output_path):
+        print("Failed to generate doctor's voice.")
+        return False
+    
+    try:
+        # Play the generated speech
+        from playsound import playsound
+        playsound(output_path)
+        return True
+    except Exception as e:
+        print(f"Error playing audio: {e}")
+        return False
+
+def get_doctor_voice_for_ui(text: str, output_filepath: str = "doctor_response.mp3"):
+    """
+    Generate speech for the doctor's response for the UI.
+    Uses guaranteed deep male voice.
+    
+    Args:
+        text (str): The text to be spoken
+        output_filepath (str): The path where to save the file
+        
+    Returns:
+        str: Path to the audio file for the UI
+    """
+    print(f"Generating doctor voice for UI: {text[:50]}...")
+    
+    # Generate speech with Edge TTS - don't play it automatically for UI
+    # The engines are already hedged within the TTS deadline, no extra fallback here
+    output_path = generate_doctor_voice(text, output_filepath)
+    
+    if not output_path or not os.path.exists(output_path):
+        print("Failed to generate doctor's voice for UI.")
+        return None
+    
+    return output_path
+
+async def _voice_for_ui(text, output_filepath):
+    output_path = await _generate(text, output_filepath)
+    if output_path and os.path.exists(output_path):
+        return output_path
+
+    print("Failed to generate doctor's voice for UI.")
+    return None
+
+async def get_doctor_voice_for_ui_async(text: str, output_filepath: str = "doctor_response.mp3"):
+    """
+    Async version of get_doctor_voice_for_ui for async request handlers.
+    The work runs on the persistent TTS loop, the caller's loop only awaits it.
+
+    Returns:
+        str: Path to the audio file for the UI, or None if every TTS method failed
+    """
+    return await asyncio.wrap_future(_tts_loop.run(_voice_for_ui(text, output_filepath)))
+
+def get_doctor_voice_bytes(text: str):
+    """
+    In-memory version of get_doctor_voice_for_ui, for handing the audio to
+    Gradio without writing and reading back a file.
+
+    Returns:
+        bytes: The MP3 audio, or None if every TTS engine failed
+    """
+    print(f"Generating doctor voice for UI: {text[:50]}...")
+    try:
+        return submit_bytes(text).result()
+    except Exception as e:
+        print(f"Failed to generate speech: {e}")
+        return None
+
+async def get_doctor_voice_bytes_async(text: str):
+    """Async version of get_doctor_voice_bytes."""
+    return await asyncio.wrap_future(submit_bytes(text))
+
+# --- Sentence-by-sentence streaming ---
+# A sentence ends at . ! or ? followed by whitespace. Very short pieces are
+# merged into the next sentence so we don't send "Dr." to the TTS on its own.
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+MIN_SENTENCE_CHARS = 25
+
+def split_sentences(token_stream):
+    """
+    Cut a stream of text pieces at sentence boundaries.
+
+    Args:
+        token_stream (iterable): Pieces of text, e.g. streamed LLM tokens
+
+    Yields:
+        str: Complete sentences, the last one may be unterminated
+    """
+    buffer = ""
+    for token in token_stream:
+        buffer += token
+        parts = SENTENCE_END.split(buffer)
+        # The last part is still being written
+        buffer = parts.pop()
+        pending = ""
+        for part in parts:
+            pending = f"{pending} {part}".strip()
+            if len(pending) >= MIN_SENTENCE_CHARS:
+                yield pending
+                pending = ""
+        if pending:
+            buffer = f"{pending} {buffer}"
+    if buffer.strip():
+        yield buffer.strip()
+
+def _read_sentences(token_stream, events, stop):
+    """Cut token_stream into sentences on its own thread, every sentence becomes an event."""
+    def tokens():
+        for token in token_stream:
+            # The listener went away, stop reading the LLM's answer
+            if stop.is_set():
+                return
+            yield token
+
+    try:
+        for sentence in split_sentences(tokens()):
+            events.put(("sentence", sentence))
+        events.put(("end", None))
+    except Exception as e:
+        events.put(("error", e))
+    finally:
+        close = getattr(token_stream, "close", None)
+        if close is not None:
+            close()
+
+def speak_sentences(token_stream, output_prefix=None):
+    """
+    Speak a streamed answer one sentence at a time.
+
+    Every complete sentence is sent to the TTS as soon as it is available, while
+    the rest of the answer keeps streaming in. The answer is read on a
+    separate thread, so a sentence's audio is handed back as soon as it is
+    ready, not when the LLM finishes the next sentence.
+
+    Args:
+        token_stream (iterable): Pieces of the doctor's answer
+        output_prefix (str): Path prefix for the per-sentence audio files,
+            None to keep the audio in memory
+
+    Yields:
+        tuple: (text_so_far, audio), audio is a file path (or MP3 bytes without
+        output_prefix) and None when only the text changed
+    """
+    text = ""
+    pending = deque()
+    # New sentences, the end of the answer and finished audio, in arrival order
+    events = queue.Queue()
+    stop = threading.Event()
+
+    def ready_audio():
+        # Hand audio back strictly in sentence order
+        while pending and pending[0].done():
+            audio = pending.popleft().result()
+            if audio:
+                yield text, audio
+
+    # The copied context keeps the request's timing log and scheduler session
+    reader = threading.Thread(
+        target=contextvars.copy_context().run, args=(_read_sentences, token_stream, events, stop),
+        name="speak-sentences", daemon=True,
+    )
+    reader.start()
+    index = 0
+    finished = False
+    try:
+        while not finished or pending:
+            kind, value = events.get()
+            if kind == "sentence":
+                text = f"{text} {value}".strip()
+                # Synthesized on the TTS loop while the LLM keeps talking
+                if output_prefix is None:
+                    future = submit_bytes(value)
+                else:
+                    future = submit(value, f"{output_prefix}_{index:02d}.mp3")
+                index += 1
+                future.add_done_callback(lambda _: events.put(("audio", None)))
+                pending.append(future)
+                yield text, None
+            elif kind == "end":
+                finished = True
+            elif kind == "error":
+                raise value
+            yield from ready_audio()
+    finally:
+        stop.set()
+
+# --- Legacy functions for compatibility ---
+def generate_speech(text: str, output_filepath: str):
+    """Legacy function for compatibility"""
+    return generate_doctor_voice(text, output_filepath)
+
+def text_to_speech_with_gtts(input_text, output_filepath):
+    """Legacy function for compatibility"""
+    return generate_doctor_voice(input_text, output_filepath)
+
+def text_to_speech_with_gtts_old(input_text, output_filepath):
+    """Legacy function for compatibility"""
+    return generate_doctor_voice(input_text, output_filepath)
+
+# --- Main execution for testing ---
+if __name__ == "__main__":
+    test_message = "Hello, I am Doctor Jones. I will analyze your symptoms and provide medical advice based on what I see."
+    print("\n=== Doctor AI Voice System Test ===")
+    
+    print("\nGenerating and playing doctor's voice:")
     speak_as_doctor(test_message)
\ No newline at end of file
@@ -1,70 +1,255 @@
-#step1 : Setup Audio recorder (ffmpeg & portaudio)
-
-import os
-import logging
-import httpx
-from groq import Groq
-from dotenv import load_dotenv
-
-# Configure logging
-logging.basicConfig(level=logging.INFO,format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
-
-# Load environment variables
-load_dotenv()
-
-GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-
-# Explicitly create an httpx client that does NOT trust the environment's proxy settings.
-# This is a robust way to avoid proxy-related issues inside Docker.
-transport = httpx.HTTPTransport(retries=2)
-http_client = httpx.Client(transport=transport, trust_env=False)
-
-client = Groq(
-    api_key=GROQ_API_KEY,
-    http_client=http_client,
-)
-
-def transcribe_with_groq(audio_path):
-    """
-    Transcribes the given audio file using the Groq API.
-    """
-    stt_model = "whisper-large-v3"
-    if not GROQ_API_KEY:
-        logger.error("GROQ_API_KEY not found.")
-        return "ERROR: Groq API key is not configured."
-
-    if not audio_path or not os.path.exists(audio_path):
-        logger.warning(f"No audio path provided or file does not exist: {audio_path}")
-        return "ERROR: No audio file submitted or file not found."
-
-    try:
-        with open(audio_path, "rb") as file:
-            transcription = client.audio.transcriptions.create(
-                file=(os.path.basename(audio_path), file.read()),
-                model=stt_model,
-            )
-        logger.info("Transcription successful.")
-        return transcription.text
-    except Exception as e:
-        logger.error(f"An error occurred during transcription: {e}")
-        return f"ERROR: An error occurred during transcription: {e}"
-
-# Test the complete workflow
-if __name__ == "__main__":
-    try:
-        audio_filepath="patient_voice_test_for_patient.wav"
-        
-        # Transcribe the recorded audio
-        patient_text = transcribe_with_groq(audio_filepath)
-        
-        if patient_text:
-            print(f"\nPatient said: {patient_text}")
-        else:
-            print("Failed to transcribe audio")
-            
-    except FileNotFoundError:
-        print(f"Audio file {audio_filepath} not found. Make sure recording completed successfully.")
-    except Exception as e:
-        logger.error(f"An error occurred: {e}")
-
+#step1 : Setup Audio recorder (ffmpeg & portaudio)
+
+import os
+import shutil
+import asyncio
+import hashlib
+import logging
+import subprocess
+
+from result_cache import ResultCache
+from tts_cache import FileCache
+from stt_backends import STTRouter, GroqBackend, LocalWhisperBackend
+import metrics
+
+# Configure logging
+logging.basicConfig(level=logging.INFO,format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+#step2 : Prepare the recording for upload
+# Whisper only needs 16 kHz mono, so microphone captures (often 44.1/48 kHz
+# stereo WAV) are downmixed, resampled and compressed with ffmpeg first.
+AUDIO_SAMPLE_RATE = 16000
+AUDIO_UPLOAD_FORMAT = os.getenv("AUDIO_UPLOAD_FORMAT", "flac")  # flac or opus
+AUDIO_MAX_UPLOAD_BYTES = int(os.getenv("AUDIO_MAX_UPLOAD_BYTES", str(25 * 1024 * 1024)))
+FFMPEG = shutil.which("ffmpeg")
+
+# ffmpeg output options and file extension for each upload format
+AUDIO_CODECS = {
+    "flac": (["-c:a", "flac", "-f", "flac"], ".flac"),
+    "opus": (["-c:a", "libopus", "-b:a", "24k", "-application", "voip", "-f", "ogg"], ".ogg"),
+}
+
+
+class AudioTooLargeError(ValueError):
+    """The recording is still over AUDIO_MAX_UPLOAD_BYTES after transcoding."""
+
+
+def _transcode(audio_path, upload_format):
+    options, extension = AUDIO_CODECS[upload_format]
+    command = [
+        FFMPEG, "-nostdin", "-hide_banner", "-loglevel", "error",
+        "-i", audio_path,
+        "-ac", "1", "-ar", str(AUDIO_SAMPLE_RATE),
+        *options, "pipe:1",
+    ]
+    result = subprocess.run(command, capture_output=True, timeout=60, check=True)
+    return result.stdout, extension
+
+
+def prepare_audio(audio_path):
+    """
+    Downmix to mono, resample to 16 kHz and encode as FLAC or Opus before upload.
+    The original file is used when ffmpeg is missing or transcoding doesn't help.
+
+    Args:
+        audio_path (str): Path to the patient's recording
+
+    Returns:
+        tuple: (filename, audio bytes) ready for the transcription API
+    """
+    filename = os.path.basename(audio_path)
+    stem = os.path.splitext(filename)[0]
+    original_size = os.path.getsize(audio_path)
+
+    data = None
+    if FFMPEG:
+        # Try the configured format first, Opus is the smaller fallback
+        formats = [AUDIO_UPLOAD_FORMAT] + [name for name in ("opus",) if name != AUDIO_UPLOAD_FORMAT]
+        for upload_format in formats:
+            try:
+                encoded, extension = _transcode(audio_path, upload_format)
+            except (subprocess.SubprocessError, OSError, KeyError) as e:
+                logger.warning(f"Could not transcode audio to {upload_format}: {e}")
+                continue
+            if encoded and len(encoded) < original_size:
+                data, filename = encoded, stem + extension
+            if data is not None and len(data) <= AUDIO_MAX_UPLOAD_BYTES:
+                break
+
+    if data is None:
+        with open(audio_path, "rb") as file:
+            data = file.read()
+
+    if len(data) > AUDIO_MAX_UPLOAD_BYTES:
+        raise AudioTooLargeError(
+            f"Recording is {len(data)} bytes after transcoding, the limit is {AUDIO_MAX_UPLOAD_BYTES} bytes."
+        )
+
+    logger.info(f"Audio prepared: {original_size} -> {len(data)} bytes ({filename})")
+    metrics.record_bytes("stt", "in", original_size)
+    metrics.record_bytes("stt", "out", len(data))
+    return filename, data
+
+#step3 : Transcription cache
+# Resubmitting the same recording (e.g. after changing only the image) skips
+# the Whisper round trip. Keys are a hash of the audio bytes plus the model
+# of the preferred backend. Only that backend's transcripts are cached, a
+# fallback's answer serves its own request but isn't kept under the key.
+TRANSCRIPT_CACHE_ENABLED = os.getenv("TRANSCRIPT_CACHE", "1") == "1"
+TRANSCRIPT_CACHE_DIR = os.getenv("TRANSCRIPT_CACHE_DIR")  # optional disk persistence
+TRANSCRIPT_CACHE_TTL = float(os.getenv("TRANSCRIPT_CACHE_TTL", str(24 * 3600)))
+# The disk store is a FileCache like the TTS cache: LRU by size, plus the TTL
+TRANSCRIPT_CACHE_DIR_MAX_BYTES = int(os.getenv("TRANSCRIPT_CACHE_DIR_MAX_BYTES", str(20 * 1024 * 1024)))
+HASH_CHUNK_SIZE = 1024 * 1024
+
+transcript_cache = ResultCache(
+    max_entries=int(os.getenv("TRANSCRIPT_CACHE_MAX_ENTRIES", "1024")),
+    ttl=TRANSCRIPT_CACHE_TTL,
+) if TRANSCRIPT_CACHE_ENABLED else None
+
+transcript_store = FileCache(
+    TRANSCRIPT_CACHE_DIR, TRANSCRIPT_CACHE_DIR_MAX_BYTES, suffix=".txt", max_age=TRANSCRIPT_CACHE_TTL,
+    name="transcript",
+) if TRANSCRIPT_CACHE_ENABLED and TRANSCRIPT_CACHE_DIR else None
+
+
+def audio_fingerprint(audio_path, stt_model):
+    """SHA-256 of the audio content and the model, read in chunks."""
+    digest = hashlib.sha256(stt_model.encode("utf-8") + b"\0")
+    with open(audio_path, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _load_transcript(key):
+    if transcript_store is None:
+        return None
+    data = transcript_store.read(key)
+    return data.decode("utf-8") if data is not None else None
+
+
+def _save_transcript(key, text):
+    if transcript_store is not None:
+        transcript_store.put_bytes(key, text.encode("utf-8"))
+
+
+def _cached_transcription(key, model, compute):
+    """
+    Memory cache, then disk, then compute(). Failures are never cached, and
+    neither is a transcript that another backend than model produced.
+
+    Args:
+        compute (callable): Returns (model that answered, text)
+    """
+    def load_or_compute():
+        text = _load_transcript(key)
+        if text is not None:
+            return model, text
+        answered, text = compute()
+        if answered == model:
+            _save_transcript(key, text)
+        return answered, text
+
+    return transcript_cache.get_or_compute(key, load_or_compute, keep=lambda result: result[0] == model)[1]
+
+
+async def _cached_transcription_async(key, model, compute):
+    async def load_or_compute():
+        text = await asyncio.to_thread(_load_transcript, key)
+        if text is not None:
+            return model, text
+        answered, text = await compute()
+        if answered == model:
+            await asyncio.to_thread(_save_transcript, key, text)
+        return answered, text
+
+    result = await transcript_cache.get_or_compute_async(key, load_or_compute, keep=lambda result: result[0] == model)
+    return result[1]
+
+
+#step4 : Speech-to-text backend
+# Groq Whisper, or a local CPU model for short recordings (see stt_backends.py)
+stt_router = STTRouter(GroqBackend(prepare_audio), LocalWhisperBackend())
+
+
+def transcribe_with_groq(audio_path):
+    """
+    Transcribes the given audio file with the backend stt_router picks:
+    Groq Whisper, or the local model when it is installed and suits the recording.
+    """
+    if not audio_path or not os.path.exists(audio_path):
+        logger.warning(f"No audio path provided or file does not exist: {audio_path}")
+        return "ERROR: No audio file submitted or file not found."
+
+    backends = stt_router.choose(audio_path)
+    if not backends:
+        logger.error("GROQ_API_KEY not found.")
+        return "ERROR: Groq API key is not configured."
+
+    def compute():
+        backend, text = stt_router.transcribe_with(audio_path, backends)
+        return backend.model, text
+
+    try:
+        if transcript_cache is None:
+            _, text = compute()
+        else:
+            model = backends[0].model
+            text = _cached_transcription(audio_fingerprint(audio_path, model), model, compute)
+        logger.info("Transcription successful.")
+        return text
+    except Exception as e:
+        logger.error(f"An error occurred during transcription: {e}")
+        return f"ERROR: An error occurred during transcription: {e}"
+
+async def transcribe_with_groq_async(audio_path):
+    """
+    Async version of transcribe_with_groq, Groq calls run on the shared AsyncGroq pool.
+    """
+    if not audio_path or not os.path.exists(audio_path):
+        logger.warning(f"No audio path provided or file does not exist: {audio_path}")
+        return "ERROR: No audio file submitted or file not found."
+
+    # Reading the duration may start ffprobe, keep it off the event loop
+    backends = await asyncio.to_thread(stt_router.choose, audio_path)
+    if not backends:
+        logger.error("GROQ_API_KEY not found.")
+        return "ERROR: Groq API key is not configured."
+
+    async def compute():
+        backend, text = await stt_router.transcribe_with_async(audio_path, backends)
+        return backend.model, text
+
+    try:
+        if transcript_cache is None:
+            _, text = await compute()
+        else:
+            model = backends[0].model
+            key = await asyncio.to_thread(audio_fingerprint, audio_path, model)
+            text = await _cached_transcription_async(key, model, compute)
+        logger.info("Transcription successful.")
+        return text
+    except Exception as e:
+        logger.error(f"An error occurred during transcription: {e}")
+        return f"ERROR: An error occurred during transcription: {e}"
+
+# Test the complete workflow
+if __name__ == "__main__":
+    try:
+        audio_filepath="patient_voice_test_for_patient.wav"
+        
+        # Transcribe the recorded audio
+        patient_text = transcribe_with_groq(audio_filepath)
+        
+        if patient_text:
+            print(f"\nPatient said: {patient_text}")
+        else:
+            print("Failed to transcribe audio")
+            
+    except FileNotFoundError:
+        print(f"Audio file {audio_filepath} not found. Make sure recording completed successfully.")
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+